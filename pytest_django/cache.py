@@ -0,0 +1,80 @@
+"""Helpers for state that pytest-django keeps between test runs.
+
+Everything is stored below the pytest cache directory (``.cache``) so it can
+be wiped together with the rest of the pytest cache.
+"""
+
+import os
+import re
+
+import py
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def get_cache_dir(config, *names):
+    """Return the pytest-django cache directory, creating it if needed.
+
+    *names* are joined to the directory to get a sub directory.
+    """
+    cache = getattr(config, 'cache', None)
+    if cache is not None:
+        path = cache.makedir('pytest-django')
+    else:
+        # The cache provider is available since pytest 2.8.
+        rootdir = getattr(config, 'rootdir', None) or py.path.local()
+        path = rootdir.join('.cache', 'pytest-django')
+    return path.join(*names).ensure(dir=True)
+
+
+def cache_filename(name):
+    """Turn *name* (e.g. a database name or path) into a safe file name."""
+    return re.sub(r'[^\w.-]+', '_', name).strip('_')
+
+
+class FileLock(object):
+    """A lock which is shared by all processes using the same lock file.
+
+    This is used to coordinate xdist workers, e.g. to make sure only one of
+    them creates a database while the others wait for it. The lock is
+    released by the operating system if the process holding it dies.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._fd = None
+
+    def acquire(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            return
+
+        while True:
+            try:
+                msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+            except IOError:
+                # LK_LOCK gives up after 10 seconds, keep waiting.
+                continue
+            return
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, 0)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
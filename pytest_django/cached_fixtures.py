@@ -0,0 +1,648 @@
+"""Fixtures whose database rows are captured once and inserted again later.
+
+Fixtures which build many objects through the ORM, e.g. a thousand users,
+run their Python code for every test which uses them. The first time a
+fixture decorated with :func:`django_db_cached_fixture` is used, it runs as
+usual and the rows it creates are captured: the statements it executes are
+observed through the cursor manager of the _django_cursor_wrapper fixture to
+find the tables it writes to, and the model instances it saved (and the
+rows of their many-to-many relations) are fetched again once it is done.
+Later uses insert the captured rows in bulk, like the objects of fixture
+files, and return the result of the fixture with its model instances
+fetched from the database again.
+
+The captured rows are kept in the pytest cache directory, keyed by the
+source of the fixture and the schema of the test database.
+
+The executed statements themselves are not replayed: where sequences are
+not rolled back with the test transaction, like on PostgreSQL, the rows
+would get other primary keys and the foreign keys in the recorded
+statements would point to the wrong rows. For the same reason, the objects
+created by other fixtures may have other primary keys in a later test:
+foreign keys to model instances passed to the fixture are changed to their
+current values, and the captured rows are only used if all other rows they
+refer to are unchanged.
+"""
+
+from __future__ import with_statement
+
+import collections
+import hashlib
+import inspect
+import json
+import os
+import re
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import pytest
+
+from . import report
+from .cache import cache_filename, get_cache_dir
+from .db_fixtures import (INSERT_BATCH_SIZE, can_load_fixtures_in_bulk,
+                          finish_loading, save_objects)
+from .db_reset import get_written_tables
+from .schema_cache import get_schema_key
+
+REPORT_SECTION = 'cached fixtures'
+
+# Bumped whenever the format of the captured rows changes.
+CACHED_FIXTURE_VERSION = 2
+
+# How many primary keys are looked up at once, SQLite allows 999 parameters.
+PK_BATCH_SIZE = 500
+
+_DELETE_RE = re.compile(r'\s*(?:DELETE|TRUNCATE)\b', re.IGNORECASE)
+
+# A model instance in the result of a captured fixture.
+_InstanceRef = collections.namedtuple('_InstanceRef',
+                                      'app_label model_name pk')
+
+
+class NotCacheable(Exception):
+    """Raised when the rows created by a fixture cannot be captured."""
+
+
+class CachedFixtureStats(object):
+    def __init__(self):
+        self.recorded = 0
+        self.replayed = 0
+        self.time_saved = 0.0
+
+    def add_to_report(self):
+        if not (self.recorded or self.replayed):
+            return
+        report.add_entry(REPORT_SECTION, 'fixtures recorded',
+                         str(self.recorded))
+        report.add_entry(REPORT_SECTION, 'fixtures replayed',
+                         str(self.replayed))
+        report.add_timing(REPORT_SECTION, 'saved by replaying fixtures',
+                          self.time_saved)
+
+
+cached_fixture_stats = CachedFixtureStats()
+
+# Maps cache keys to pickled captures, and the names of fixtures which
+# cannot be captured to the reason.
+_captures = {}
+_not_cacheable = {}
+_schema_keys = {}
+
+
+def _get_model_key(model):
+    return model._meta.app_label, model._meta.model_name
+
+
+def _get_model(model_key):
+    from django.apps import apps
+
+    return apps.get_model(*model_key)
+
+
+def _map_values(value, func):
+    """Apply *func* to *value*, or to the items of lists, tuples, sets and
+    dicts."""
+    if type(value) in (list, tuple, set, frozenset):
+        return type(value)(_map_values(item, func) for item in value)
+    if type(value) is dict:
+        return dict((key, _map_values(item, func))
+                    for key, item in value.items())
+    return func(value)
+
+
+def _encode_instance(value):
+    from django.db.models import Model
+
+    if isinstance(value, Model) and value.pk is not None:
+        return _InstanceRef(value._meta.app_label, value._meta.model_name,
+                            value.pk)
+    return value
+
+
+def _iter_instances(value):
+    """Yield the saved model instances in *value*, or in its lists, tuples
+    and dicts, in a stable order.
+
+    Sets are not looked into, the order of their items may change.
+    """
+    from django.db.models import Model
+
+    if isinstance(value, Model):
+        if value.pk is not None:
+            yield value
+        return
+    if type(value) in (list, tuple):
+        items = value
+    elif type(value) is dict:
+        items = [value[key] for key in sorted(value, key=repr)]
+    else:
+        return
+    for item in items:
+        for instance in _iter_instances(item):
+            yield instance
+
+
+def _get_values(instance):
+    return dict((field.attname, getattr(instance, field.attname))
+                for field in instance._meta.concrete_fields)
+
+
+def _get_foreign_keys(model):
+    """Return the concrete foreign keys of *model* and the fields they
+    refer to."""
+    return [(field, field.related_fields[0][1])
+            for field in model._meta.concrete_fields
+            if field.is_relation and (field.many_to_one or field.one_to_one)
+            and len(field.related_fields) == 1]
+
+
+def _iter_unique_keys(model, values):
+    """Yield the unique fields of *model* with the ``(model key, attname,
+    value)`` tuples which identify the row *values* by them."""
+    for field in model._meta.concrete_fields:
+        value = values[field.attname]
+        if not field.unique or value is None:
+            continue
+        try:
+            hash(value)
+        except TypeError:
+            continue
+        yield field, (_get_model_key(field.model), field.attname, value)
+
+
+def _get_row(key, alias):
+    """Return the field values of the row identified by *key*, or None."""
+    model = _get_model(key[0])
+    for instance in model._base_manager.using(alias).filter(
+            **{key[1]: key[2]}):
+        return _get_values(instance)
+    return None
+
+
+def _get_pk_key(ref):
+    pk = _get_model(ref[:2])._meta.pk
+    return _get_model_key(pk.model), pk.attname, ref.pk
+
+
+def _iter_batches(values, size=PK_BATCH_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class FixtureCapture(object):
+    """Captures the rows created on the database *alias* by a fixture.
+
+    The instance is registered as SQL observer with the cursor manager and
+    connected to the post_save and m2m_changed signals while the fixture
+    runs.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.problem = None
+        self._tables = set()
+        self._models = []
+        self._pks = {}
+
+    def _set_problem(self, problem):
+        if self.problem is None:
+            self.problem = problem
+
+    def _add(self, model, pks):
+        if model not in self._pks:
+            self._models.append(model)
+            self._pks[model] = set()
+        self._pks[model].update(pks)
+
+    def __call__(self, sql, db, params=None, many=False):
+        tables = get_written_tables(sql)
+        if tables == []:
+            return
+        if db.alias != self.alias:
+            self._set_problem("it writes to the database '%s'" % db.alias)
+        elif tables is None:
+            self._set_problem('it executes statements other than INSERT '
+                              'and UPDATE')
+        elif _DELETE_RE.match(sql):
+            self._set_problem('it deletes rows')
+        else:
+            self._tables.update(tables)
+
+    def post_save(self, sender, instance, created, using=None, **kwargs):
+        if using != self.alias:
+            return
+        meta = instance._meta
+        if created:
+            # The rows of parent models are inserted without a signal.
+            for parent in meta.get_parent_list():
+                self._add(parent, [getattr(instance, parent._meta.pk.attname)])
+            self._add(meta.concrete_model, [instance.pk])
+        elif instance.pk not in self._pks.get(meta.concrete_model, ()):
+            self._set_problem('it changes rows which it did not create')
+
+    def m2m_changed(self, sender, instance, action, model, pk_set,
+                    using=None, **kwargs):
+        from django.db.models import Q
+
+        if (using != self.alias or action != 'post_add' or not pk_set or
+                not sender._meta.auto_created):
+            # The rows of other intermediate models are saved with post_save.
+            return
+
+        fields = [field for field in sender._meta.concrete_fields
+                  if field.is_relation]
+        condition = None
+        for source, target in ((fields[0], fields[1]),
+                               (fields[1], fields[0])):
+            if (isinstance(instance, source.related_model) and
+                    issubclass(model, target.related_model)):
+                q = Q(**{source.attname: instance.pk,
+                         target.attname + '__in': list(pk_set)})
+                condition = q if condition is None else condition | q
+        if condition is not None:
+            self._add(sender, sender._base_manager.using(self.alias).filter(
+                condition).values_list('pk', flat=True))
+
+    def get_capture(self, result, duration, arguments):
+        """Return the captured rows and the encoded *result*.
+
+        *arguments* are the keyword arguments the fixture was called with.
+        Raises :exc:`NotCacheable` if the fixture did something which
+        cannot be captured.
+        """
+        if self.problem is not None:
+            raise NotCacheable(self.problem)
+        missing = self._tables - set(model._meta.db_table
+                                     for model in self._models)
+        if missing:
+            raise NotCacheable('it writes to %s without saving model '
+                               'instances' % ', '.join(sorted(missing)))
+
+        rows = []
+        for model in self._models:
+            values = []
+            for pks in _iter_batches(self._pks[model]):
+                for instance in model._base_manager.using(self.alias).filter(
+                        pk__in=pks).order_by('pk'):
+                    values.append(_get_values(instance))
+            rows.append((_get_model_key(model), values))
+
+        argument_values = []
+        known = set()
+        for instance in _iter_instances(arguments):
+            model = instance._meta.concrete_model
+            argument_values.append((_get_model_key(model),
+                                    _get_values(instance)))
+            known.update(key for field, key in _iter_unique_keys(
+                model, argument_values[-1][1]))
+        for model_key, values in rows:
+            model = _get_model(model_key)
+            for row in values:
+                known.update(key for field, key in _iter_unique_keys(
+                    model, row))
+
+        # The other rows the captured rows and the result refer to.
+        references = set()
+        for model_key, values in rows:
+            for field, target in _get_foreign_keys(_get_model(model_key)):
+                for row in values:
+                    if row[field.attname] is not None:
+                        references.add((_get_model_key(target.model),
+                                        target.attname, row[field.attname]))
+        encoded_result = _map_values(result, _encode_instance)
+
+        def collect(value):
+            if isinstance(value, _InstanceRef):
+                references.add(_get_pk_key(value))
+            return value
+        _map_values(encoded_result, collect)
+
+        return {
+            'rows': rows,
+            'result': encoded_result,
+            'duration': duration,
+            'arguments': argument_values,
+            'references': [(key, _get_row(key, self.alias))
+                           for key in sorted(references - known, key=repr)],
+        }
+
+
+def _exists(model, pks, alias):
+    manager = model._base_manager.using(alias)
+    for batch in _iter_batches(pks):
+        if manager.filter(pk__in=batch).exists():
+            return True
+    return False
+
+
+def _insert_rows(connection, model, rows):
+    """Insert *rows* (field values by attribute name) into the table of
+    *model* with one executemany() per batch."""
+    fields = model._meta.local_concrete_fields
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join(qn(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)))
+
+    cursor = connection.cursor()
+    try:
+        for batch in _iter_batches(rows, INSERT_BATCH_SIZE):
+            cursor.executemany(sql, [
+                [field.get_db_prep_save(row[field.attname], connection)
+                 for field in fields]
+                for row in batch])
+    finally:
+        cursor.close()
+
+
+def _needs_orm(model):
+    # E.g. geometry fields, which need special placeholders.
+    return any(hasattr(field, 'get_placeholder')
+               for field in model._meta.local_concrete_fields)
+
+
+def _get_argument_mapping(argument_values, arguments):
+    """Map the ``(model key, attname, value)`` tuples of the unique fields
+    of the model instances the fixture was captured with to the values of
+    the instances in *arguments*.
+
+    Returns None if *arguments* hold other model instances.
+    """
+    instances = list(_iter_instances(arguments))
+    if len(instances) != len(argument_values):
+        return None
+
+    mapping = {}
+    for (model_key, values), instance in zip(argument_values, instances):
+        model = instance._meta.concrete_model
+        if _get_model_key(model) != model_key:
+            return None
+        for field, key in _iter_unique_keys(model, values):
+            mapping[key] = getattr(instance, field.attname)
+    return mapping
+
+
+def _remap_rows(model, rows, mapping):
+    """Return *rows* with their foreign keys changed according to
+    *mapping*."""
+    foreign_keys = [(field.attname, _get_model_key(target.model),
+                     target.attname)
+                    for field, target in _get_foreign_keys(model)]
+    if not (mapping and foreign_keys):
+        return rows
+
+    remapped = []
+    for row in rows:
+        row = dict(row)
+        for attname, target_key, target_attname in foreign_keys:
+            key = (target_key, target_attname, row[attname])
+            if key in mapping:
+                row[attname] = mapping[key]
+        remapped.append(row)
+    return remapped
+
+
+def _get_instances(result, captured, mapping, alias):
+    """Return the model instances referred to by *result*, by reference.
+
+    Instances of captured rows are created from the captured field values,
+    other ones are fetched from the database, with their primary keys
+    changed according to *mapping*.
+    """
+    refs = set()
+
+    def collect(value):
+        if isinstance(value, _InstanceRef):
+            refs.add(value)
+        return value
+    _map_values(result, collect)
+
+    instances = {}
+    missing = {}
+    models = {}
+    for ref in refs:
+        if ref[:2] not in models:
+            models[ref[:2]] = _get_model(ref[:2])
+        model = models[ref[:2]]
+        pk = mapping.get(_get_pk_key(ref), ref.pk)
+        attnames, rows = captured.get(
+            _get_model_key(model._meta.concrete_model), (None, {}))
+        if pk in rows:
+            instances[ref] = model.from_db(
+                alias, attnames, [rows[pk][attname] for attname in attnames])
+        else:
+            missing.setdefault(ref[:2], {})[pk] = ref
+
+    for model_key, refs_by_pk in missing.items():
+        manager = _get_model(model_key)._base_manager.using(alias)
+        for batch in _iter_batches(refs_by_pk):
+            for pk, instance in manager.in_bulk(batch).items():
+                instances[refs_by_pk[pk]] = instance
+    return instances
+
+
+def replay_capture(capture, alias, arguments):
+    """Insert the captured rows and return the result of the fixture.
+
+    *arguments* are the keyword arguments the fixture would be called with,
+    the foreign keys to their model instances are changed to the current
+    values. Returns None instead of ``(result,)`` if some of the rows exist
+    already, e.g. because another fixture created them, or if other rows
+    the captured ones refer to changed.
+    """
+    from django.db import connections, transaction
+
+    mapping = _get_argument_mapping(capture['arguments'], arguments)
+    if mapping is None:
+        return None
+    for key, values in capture['references']:
+        if _get_row(key, alias) != values:
+            return None
+
+    connection = connections[alias]
+    models = []
+    captured = {}
+    for model_key, rows in capture['rows']:
+        model = _get_model(model_key)
+        rows = _remap_rows(model, rows, mapping)
+        pk_attname = model._meta.pk.attname
+        if _exists(model, [row[pk_attname] for row in rows], alias):
+            return None
+        models.append((model, rows))
+        captured[model_key] = (
+            [field.attname for field in model._meta.concrete_fields],
+            dict((row[pk_attname], row) for row in rows))
+
+    with transaction.atomic(using=alias):
+        with connection.constraint_checks_disabled():
+            for model, rows in models:
+                if _needs_orm(model):
+                    save_objects([(model, row, {}) for row in rows], alias)
+                else:
+                    _insert_rows(connection, model, rows)
+        finish_loading(connection, [model for model, rows in models])
+
+    instances = _get_instances(capture['result'], captured, mapping, alias)
+
+    def fetch(value):
+        if isinstance(value, _InstanceRef):
+            return instances[value]
+        return value
+    return (_map_values(capture['result'], fetch),)
+
+
+def _get_fixture_name(function):
+    return '%s.%s' % (function.__module__, function.__name__)
+
+
+def _get_cache_key(function, connection):
+    try:
+        source = inspect.getsource(function)
+    except (IOError, TypeError):
+        raise NotCacheable('its source code is not available')
+
+    if connection.alias not in _schema_keys:
+        _schema_keys[connection.alias] = get_schema_key(connection)
+    key = {
+        'version': CACHED_FIXTURE_VERSION,
+        'fixture': _get_fixture_name(function),
+        'source': source,
+        'schema': _schema_keys[connection.alias],
+    }
+    return hashlib.sha1(
+        json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _cache_file(config, name, key):
+    return get_cache_dir(config, 'cached-fixtures').join(
+        '%s-%s.pickle' % (cache_filename(name), key))
+
+
+def _save_capture(path, data):
+    # Captures of older versions of the fixture are no longer needed.
+    for old_path in path.dirpath().listdir(
+            '%s-*.pickle' % path.basename.rsplit('-', 1)[0]):
+        old_path.remove()
+
+    # Write to a temporary file first, other xdist workers may be reading.
+    tmp_path = path.new(basename='%s.%d.tmp' % (path.basename, os.getpid()))
+    tmp_path.write(data, 'wb')
+    tmp_path.rename(path)
+
+
+def _load_capture(key, path):
+    if key not in _captures and path.check():
+        _captures[key] = path.read('rb')
+    data = _captures.get(key)
+    if data is None:
+        return None
+    try:
+        return pickle.loads(data)
+    except Exception:
+        return None
+
+
+def _set_not_cacheable(name, reason):
+    _not_cacheable[name] = reason
+    report.add_entry(REPORT_SECTION, 'not cached: %s' % name, reason)
+
+
+def _record(function, kwargs, alias, cursor_manager):
+    from django.db.models.signals import m2m_changed, post_save
+
+    capture = FixtureCapture(alias)
+    start = time.time()
+    cursor_manager.add_observer(capture)
+    post_save.connect(capture.post_save)
+    m2m_changed.connect(capture.m2m_changed)
+    try:
+        result = function(**kwargs)
+    finally:
+        m2m_changed.disconnect(capture.m2m_changed)
+        post_save.disconnect(capture.post_save)
+        cursor_manager.remove_observer(capture)
+    return result, capture, time.time() - start
+
+
+def get_fixture_result(config, function, kwargs, cursor_manager):
+    """Return the result of the fixture *function*, from the cache if
+    possible."""
+    from django.db import DEFAULT_DB_ALIAS, connections
+
+    name = _get_fixture_name(function)
+    if name in _not_cacheable or not can_load_fixtures_in_bulk():
+        return function(**kwargs)
+    try:
+        key = _get_cache_key(function, connections[DEFAULT_DB_ALIAS])
+    except NotCacheable as e:
+        _set_not_cacheable(name, str(e))
+        return function(**kwargs)
+
+    path = _cache_file(config, name, key)
+    capture = _load_capture(key, path)
+    if capture is not None:
+        start = time.time()
+        replayed = replay_capture(capture, DEFAULT_DB_ALIAS, kwargs)
+        if replayed is not None:
+            cached_fixture_stats.replayed += 1
+            cached_fixture_stats.time_saved += (capture['duration'] -
+                                                (time.time() - start))
+            return replayed[0]
+        return function(**kwargs)
+
+    result, capture, duration = _record(function, kwargs, DEFAULT_DB_ALIAS,
+                                        cursor_manager)
+    try:
+        captured = capture.get_capture(result, duration, kwargs)
+    except NotCacheable as e:
+        _set_not_cacheable(name, str(e))
+        return result
+    try:
+        data = pickle.dumps(captured, 2)
+    except Exception:
+        _set_not_cacheable(name, 'its result cannot be pickled')
+        return result
+
+    _captures[key] = data
+    _save_capture(path, data)
+    cached_fixture_stats.recorded += 1
+    return result
+
+
+def _get_argnames(function):
+    try:
+        return inspect.getfullargspec(function).args
+    except AttributeError:
+        # Python 2
+        return inspect.getargspec(function).args
+
+
+def django_db_cached_fixture(function):
+    """Decorator for fixtures whose database rows are cached.
+
+    The decorated function is turned into a function scoped fixture which
+    uses the database. The rows it creates the first time it is used are
+    inserted again for later uses, without running it.
+    """
+    if inspect.isgeneratorfunction(function):
+        raise ValueError('%s: cached fixtures cannot be generators.'
+                         % _get_fixture_name(function))
+    argnames = _get_argnames(function)
+
+    def cached_fixture(request, _django_cursor_wrapper):
+        request.getfuncargvalue('db')
+        kwargs = dict((argname, request.getfuncargvalue(argname))
+                      for argname in argnames)
+        return get_fixture_result(request.config, function, kwargs,
+                                  _django_cursor_wrapper)
+
+    cached_fixture.__name__ = function.__name__
+    cached_fixture.__doc__ = function.__doc__
+    cached_fixture.__module__ = function.__module__
+    return pytest.fixture(cached_fixture)
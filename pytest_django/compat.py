@@ -16,7 +16,10 @@ _runner = DjangoTestRunner(verbosity=pytest.config.option.verbose,
                            interactive=False)
 
 
-setup_databases = _runner.setup_databases
+try:
+    from django.test.runner import setup_databases
+except ImportError:
+    setup_databases = _runner.setup_databases
 
 teardown_databases = _runner.teardown_databases
 
@@ -0,0 +1,298 @@
+"""Functions to copy a test database that has already been set up.
+
+Copying a migrated database is a lot cheaper than running all migrations
+again, which is what every xdist worker would do otherwise.
+"""
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+
+def can_clone_test_db(connection):
+    """Return True if the test database of *connection* can be cloned."""
+    if connection.vendor in ('postgresql', 'mysql'):
+        return True
+
+    if connection.vendor == 'sqlite':
+        test_db_name = connection.creation._get_test_db_name()
+        return not is_in_memory_db(test_db_name)
+
+    return False
+
+
+def is_in_memory_db(name):
+    return name == ':memory:' or 'mode=memory' in name
+
+
+def clone_test_db(connection, source_name, target_name):
+    """Create the database *target_name* as a copy of *source_name*.
+
+    An existing *target_name* database is replaced. Nobody must be connected
+    to *source_name* while it is copied.
+    """
+    if connection.vendor == 'postgresql':
+        _clone_postgresql(connection, source_name, target_name)
+    elif connection.vendor == 'mysql':
+        _clone_mysql(connection, source_name, target_name)
+    elif connection.vendor == 'sqlite':
+        _clone_sqlite(source_name, target_name)
+    else:
+        raise NotImplementedError('pytest-django cannot clone %s databases'
+                                  % connection.vendor)
+
+
+def drop_test_db(connection, name):
+    """Drop the database *name* if it exists.
+
+    *connection* is only used to connect to the database server, it may be
+    connected to a different database.
+    """
+    if connection.vendor == 'sqlite':
+        if not is_in_memory_db(name) and os.path.exists(name):
+            os.remove(name)
+        return
+
+    nodb_connection = _nodb_connection(connection)
+    try:
+        cursor = _raw_cursor(nodb_connection)
+        cursor.execute('DROP DATABASE IF EXISTS %s'
+                       % connection.ops.quote_name(name))
+    finally:
+        nodb_connection.close()
+
+
+def _nodb_connection(connection):
+    """Return a new connection to the server, but not to a database."""
+    try:
+        # Django 1.7+
+        return connection._nodb_connection
+    except AttributeError:
+        settings_dict = connection.settings_dict.copy()
+        if connection.vendor == 'postgresql':
+            settings_dict['NAME'] = 'postgres'
+        else:
+            settings_dict['NAME'] = ''
+        return connection.__class__(settings_dict, alias='__no_db__')
+
+
+def _raw_cursor(connection):
+    """Return a DB-API cursor which bypasses pytest-django's cursor wrapper.
+
+    This allows the functions in this module to be used while database
+    access is blocked, e.g. from background threads.
+    """
+    if hasattr(connection, 'ensure_connection'):
+        connection.ensure_connection()
+        return connection.connection.cursor()
+    # Django < 1.6
+    return connection._cursor()
+
+
+def _clone_postgresql(connection, source_name, target_name):
+    qn = connection.ops.quote_name
+    nodb_connection = _nodb_connection(connection)
+    try:
+        cursor = _raw_cursor(nodb_connection)
+        cursor.execute('DROP DATABASE IF EXISTS %s' % qn(target_name))
+        cursor.execute('CREATE DATABASE %s WITH TEMPLATE %s'
+                       % (qn(target_name), qn(source_name)))
+    finally:
+        nodb_connection.close()
+
+
+def _mysql_args(executable, settings_dict, db_name):
+    options = settings_dict.get('OPTIONS', {})
+    user = options.get('user', settings_dict.get('USER'))
+    password = options.get('passwd', settings_dict.get('PASSWORD'))
+    host = options.get('host', settings_dict.get('HOST'))
+    port = options.get('port', settings_dict.get('PORT'))
+    defaults_file = options.get('read_default_file')
+
+    args = [executable]
+    # --defaults-file must be the first argument.
+    if defaults_file:
+        args.append('--defaults-file=%s' % defaults_file)
+    if user:
+        args.append('--user=%s' % user)
+    if password:
+        args.append('--password=%s' % password)
+    if host:
+        if '/' in host:
+            args.append('--socket=%s' % host)
+        else:
+            args.append('--host=%s' % host)
+    if port:
+        args.append('--port=%s' % port)
+    args.append(db_name)
+    return args
+
+
+def _clone_mysql(connection, source_name, target_name):
+    qn = connection.ops.quote_name
+    nodb_connection = _nodb_connection(connection)
+    try:
+        cursor = _raw_cursor(nodb_connection)
+        cursor.execute('DROP DATABASE IF EXISTS %s' % qn(target_name))
+        cursor.execute('CREATE DATABASE %s' % qn(target_name))
+    finally:
+        nodb_connection.close()
+
+    settings_dict = connection.settings_dict
+    dump_proc = subprocess.Popen(
+        _mysql_args('mysqldump', settings_dict, source_name),
+        stdout=subprocess.PIPE)
+    load_proc = subprocess.Popen(
+        _mysql_args('mysql', settings_dict, target_name),
+        stdin=dump_proc.stdout)
+    # Allow mysqldump to receive a SIGPIPE if mysql exits.
+    dump_proc.stdout.close()
+    load_proc.communicate()
+
+    if dump_proc.wait() != 0 or load_proc.returncode != 0:
+        raise RuntimeError('Could not clone MySQL database %s to %s'
+                           % (source_name, target_name))
+
+
+def _clone_sqlite(source_name, target_name):
+    if os.path.exists(target_name):
+        os.remove(target_name)
+
+    if sys.platform.startswith('linux'):
+        # Let the file system make a copy-on-write clone (reflink) if it
+        # supports it, this is nearly free even for large databases.
+        try:
+            ret = subprocess.call(['cp', '--reflink=auto',
+                                   source_name, target_name])
+        except OSError:
+            pass
+        else:
+            if ret == 0:
+                return
+
+    shutil.copyfile(source_name, target_name)
+
+
+def copy_sqlite_db(source_name, target_connection):
+    """Copy the SQLite database file *source_name* into a DB-API connection.
+
+    This is used to load a database file into an in-memory database.
+    """
+    source = sqlite3.connect(source_name)
+    try:
+        copy_sqlite_connection(source, target_connection)
+    finally:
+        source.close()
+
+
+def copy_sqlite_connection(source_connection, target_connection):
+    """Copy the database of a DB-API connection into another one."""
+    if hasattr(source_connection, 'backup'):
+        # Python 3.7+: a page level copy.
+        source_connection.backup(target_connection)
+    else:
+        target_connection.executescript(
+            '\n'.join(source_connection.iterdump()))
+
+
+def clone_postgresql_schema(connection, source_schema, target_schema):
+    """Create the schema *target_schema* as a copy of *source_schema*.
+
+    Both schemas are in the database *connection* is connected to. An
+    existing *target_schema* is replaced. The tables are copied with their
+    rows, indexes, constraints and sequences, other objects like views and
+    functions are not.
+    """
+    qn = connection.ops.quote_name
+    cursor = _raw_cursor(connection)
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % qn(target_schema))
+        cursor.execute('CREATE SCHEMA %s' % qn(target_schema))
+
+        cursor.execute("SELECT tablename FROM pg_tables "
+                       "WHERE schemaname = %s ORDER BY tablename",
+                       [source_schema])
+        tables = [row[0] for row in cursor.fetchall()]
+        for table in tables:
+            cursor.execute('CREATE TABLE %s.%s (LIKE %s.%s INCLUDING ALL)' % (
+                qn(target_schema), qn(table), qn(source_schema), qn(table)))
+            cursor.execute('INSERT INTO %s.%s SELECT * FROM %s.%s' % (
+                qn(target_schema), qn(table), qn(source_schema), qn(table)))
+
+        # Column defaults and foreign keys are printed relative to the
+        # search path, so they can be applied to the copies unchanged.
+        cursor.execute('SET LOCAL search_path TO %s' % qn(source_schema))
+        cursor.execute("""
+            SELECT s.relname, t.relname, a.attname, d.deptype
+            FROM pg_class s
+            JOIN pg_namespace n ON n.oid = s.relnamespace
+            LEFT JOIN pg_depend d ON d.objid = s.oid
+                AND d.classid = 'pg_class'::regclass
+                AND d.refclassid = 'pg_class'::regclass
+                AND d.deptype IN ('a', 'i')
+            LEFT JOIN pg_class t ON t.oid = d.refobjid
+            LEFT JOIN pg_attribute a ON a.attrelid = t.oid
+                AND a.attnum = d.refobjsubid
+            WHERE s.relkind = 'S' AND n.nspname = %s""", [source_schema])
+        sequences = cursor.fetchall()
+        cursor.execute("""
+            SELECT c.relname, a.attname, pg_get_expr(d.adbin, d.adrelid)
+            FROM pg_attrdef d
+            JOIN pg_class c ON c.oid = d.adrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = d.adnum
+            WHERE n.nspname = %s AND c.relkind = 'r'
+                AND pg_get_expr(d.adbin, d.adrelid) LIKE 'nextval(%%'""",
+                       [source_schema])
+        defaults = cursor.fetchall()
+        cursor.execute("""
+            SELECT c.relname, con.conname, pg_get_constraintdef(con.oid)
+            FROM pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND con.contype = 'f'""", [source_schema])
+        foreign_keys = cursor.fetchall()
+
+        values = {}
+        for sequence, table, column, deptype in sequences:
+            cursor.execute('SELECT last_value, is_called FROM %s.%s' % (
+                qn(source_schema), qn(sequence)))
+            values[sequence] = cursor.fetchone()
+
+        cursor.execute('SET LOCAL search_path TO %s' % qn(target_schema))
+        for sequence, table, column, deptype in sequences:
+            if deptype == 'i':
+                # Identity columns got their own sequence from LIKE.
+                cursor.execute('SELECT pg_get_serial_sequence(%s, %s)',
+                               [qn(table), column])
+                target_sequence = cursor.fetchone()[0]
+            else:
+                cursor.execute('CREATE SEQUENCE %s' % qn(sequence))
+                if table is not None:
+                    cursor.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (
+                        qn(sequence), qn(table), qn(column)))
+                target_sequence = qn(sequence)
+            last_value, is_called = values[sequence]
+            cursor.execute('SELECT setval(%s, %s, %s)',
+                           [target_sequence, last_value, is_called])
+
+        for table, column, expression in defaults:
+            cursor.execute('ALTER TABLE %s ALTER COLUMN %s SET DEFAULT %s' % (
+                qn(table), qn(column), expression))
+
+        for table, name, definition in foreign_keys:
+            cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (
+                qn(table), qn(name), definition))
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    cursor.execute('COMMIT')
+
+
+def drop_postgresql_schema(connection, schema):
+    cursor = _raw_cursor(connection)
+    cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE'
+                   % connection.ops.quote_name(schema))
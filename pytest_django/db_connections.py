@@ -0,0 +1,128 @@
+"""Keeping the database connections open for the whole test session.
+
+Django closes all database connections after every test using
+transactional_db, and after every request if CONN_MAX_AGE is 0, so the
+next test has to connect again. With --keep-db-connections the connections
+of the test process stay open, and only their session state is reset after
+each test. The connections of databases in a pool of --db-pool are still
+closed, since the next test uses another copy of the database.
+"""
+
+import threading
+
+from . import report
+from .db_clone import is_in_memory_db
+from .db_pool import database_pools
+
+REPORT_SECTION = 'database connections'
+
+
+def _reset_session(connection):
+    """Reset the session state of *connection* after a test.
+
+    Returns False if the connection cannot be re-used and must be closed.
+    """
+    if connection.in_atomic_block:
+        return False
+    # Like close_if_unusable_or_obsolete(): do not take chances.
+    if connection.get_autocommit() != connection.settings_dict['AUTOCOMMIT']:
+        return False
+    if connection.errors_occurred and not connection.is_usable():
+        return False
+
+    if connection.vendor == 'postgresql':
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute('RESET ALL')
+            cursor.execute('DISCARD TEMP')
+        finally:
+            cursor.close()
+        # Sets the time zone again.
+        connection.init_connection_state()
+
+    connection.errors_occurred = False
+    return True
+
+
+class PersistentConnections(object):
+    """Keeps the connections of the test process open between tests.
+
+    While installed, connections opened in the test process do not expire
+    with CONN_MAX_AGE, and :meth:`reset` is called instead of closing them
+    after a test. The connections of other threads, e.g. the ones of the
+    live server, are left alone.
+    """
+
+    def __init__(self):
+        self.connects = 0
+        self.pooled_connects = 0
+        self.kept = 0
+        self._thread = None
+
+    def __bool__(self):
+        return self._thread is not None
+    __nonzero__ = __bool__
+
+    def install(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        self._thread = threading.current_thread()
+        connection_created.connect(self._connection_created)
+        for connection in connections.all():
+            if connection.connection is not None:
+                connection.close_at = None
+
+    def uninstall(self):
+        from django.db.backends.signals import connection_created
+
+        connection_created.disconnect(self._connection_created)
+        self._thread = None
+
+        report.add_entry(REPORT_SECTION, 'connections opened during tests',
+                         str(self.connects))
+        report.add_entry(REPORT_SECTION, 'connects avoided by keeping '
+                         'connections open', str(self.kept))
+        if self.pooled_connects:
+            report.add_entry(REPORT_SECTION,
+                             'connections opened to pooled databases',
+                             str(self.pooled_connects))
+        self.connects = self.pooled_connects = self.kept = 0
+
+    def _connection_created(self, sender, connection, **kwargs):
+        if threading.current_thread() is not self._thread:
+            return
+        if connection.alias in database_pools:
+            self.pooled_connects += 1
+        else:
+            self.connects += 1
+        connection.close_at = None
+
+    def reset(self):
+        """Reset the open connections instead of closing them.
+
+        Connections which cannot be re-used are closed. The connections of
+        pooled databases are left to the pool, which closes them when it
+        switches to the next copy.
+        """
+        from django.db import connections
+
+        for connection in connections.all():
+            if (connection.connection is None or
+                    connection.alias in database_pools or
+                    (connection.vendor == 'sqlite' and
+                     is_in_memory_db(connection.settings_dict['NAME']))):
+                # Django never closes in-memory SQLite databases.
+                continue
+            try:
+                reusable = _reset_session(connection)
+            except Exception:
+                reusable = False
+
+            if reusable:
+                self.kept += 1
+            else:
+                connection.close()
+
+
+persistent_connections = PersistentConnections()
@@ -0,0 +1,947 @@
+"""Test database creation which goes beyond Django's setup_databases().
+
+The plain code path in ``_django_db_setup`` hands everything over to
+Django's test runner. The functions in this module implement the optional
+strategies where pytest-django creates the test databases itself, like
+creating them concurrently, cloning the databases of xdist workers from a
+template or creating some of them on first use.
+"""
+
+import contextlib
+import hashlib
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from . import report
+from .cache import FileLock, get_cache_dir
+from .db_clone import (clone_postgresql_schema, clone_test_db, copy_sqlite_db,
+                       drop_postgresql_schema, is_in_memory_db)
+from .db_reuse import (DatabaseProbe, _get_db_name,
+                       drop_outdated_test_databases, get_test_db_fingerprints,
+                       monkey_patch_creation_for_db_reuse,
+                       monkey_patch_creation_for_db_suffix,
+                       save_test_db_fingerprints)
+from .db_serialize import restore_cached_contents, use_cached_contents
+from .lazy_django import get_django_version
+from .migrations import data_migration_skipper
+
+TEMPLATE_SUFFIX = 'template'
+
+# The schema in which the tables of a new PostgreSQL database are created.
+TEMPLATE_SCHEMA = 'public'
+WORKER_SCHEMA_PREFIX = 'pytest_django_'
+
+REPORT_SECTION = 'test database setup'
+
+# The key in xdist's slaveinput which identifies the current test run.
+TESTRUN_KEY = 'pytest_django_testrun'
+
+
+def get_test_setting(settings_dict, key, default=None):
+    """Return the TEST[key] setting of a database.
+
+    Before Django 1.7 the test settings were defined as TEST_<key>.
+    """
+    value = (settings_dict.get('TEST') or {}).get(key)
+    if value is None:
+        value = settings_dict.get('TEST_' + key)
+    if value is None:
+        return default
+    return value
+
+
+def get_unique_databases_and_mirrors():
+    """Figure out which test databases need to be created.
+
+    Returns a list of ``(db_name, aliases)`` tuples, one per physical test
+    database, and a dict which maps test mirrors to the alias they mirror.
+    Only the first alias of each tuple needs to actually create the
+    database, the other ones point to the same database.
+    """
+    from django.db import connections
+
+    test_databases = []
+    signatures = {}
+    mirrored_aliases = {}
+
+    for alias in connections:
+        connection = connections[alias]
+        mirror = get_test_setting(connection.settings_dict, 'MIRROR')
+        if mirror:
+            mirrored_aliases[alias] = mirror
+            continue
+
+        signature = connection.creation.test_db_signature()
+        if signature in signatures:
+            signatures[signature][1].append(alias)
+        else:
+            item = (connection.settings_dict['NAME'], [alias])
+            signatures[signature] = item
+            test_databases.append(item)
+
+    return test_databases, mirrored_aliases
+
+
+def report_shared_test_databases():
+    """Add the aliases which share the test database of another alias to
+    the report, since no test database is created for them."""
+    test_databases, mirrored_aliases = get_unique_databases_and_mirrors()
+
+    primaries = {}
+    for db_name, aliases in test_databases:
+        for alias in aliases:
+            primaries[alias] = aliases[0]
+
+    shared = {}
+    for db_name, aliases in test_databases:
+        shared[aliases[0]] = list(aliases[1:])
+    for alias, mirror_alias in mirrored_aliases.items():
+        if mirror_alias in primaries:
+            shared[primaries[mirror_alias]].append(alias)
+
+    for primary in sorted(shared):
+        if shared[primary]:
+            report.add_entry(
+                REPORT_SECTION,
+                "aliases using the test database of '%s'" % primary,
+                ', '.join(sorted(shared[primary])))
+
+
+class UnusedAliases(object):
+    """Hides the database aliases which are not used by the tests.
+
+    While installed, the aliases and the test mirrors of them are removed
+    from the database settings, so that no test database is set up for them
+    and no connection to their real database is made. They are also removed
+    from the TEST['DEPENDENCIES'] of the other aliases.
+    """
+
+    def __init__(self):
+        self.removed = {}
+        self._dependencies = []
+
+    def install(self, aliases):
+        from django.core.exceptions import ImproperlyConfigured
+        from django.db import DEFAULT_DB_ALIAS, connections
+
+        aliases = set(aliases)
+        for alias in sorted(aliases):
+            if alias == DEFAULT_DB_ALIAS or alias not in connections:
+                raise ImproperlyConfigured(
+                    "The database alias '%s' in django_unused_databases is "
+                    "not a database alias other than '%s'." % (
+                        alias, DEFAULT_DB_ALIAS))
+
+        # The test mirrors of unused aliases would have no test database.
+        while True:
+            mirrors = set(
+                alias for alias in connections
+                if alias not in aliases and
+                get_test_setting(connections.databases[alias],
+                                 'MIRROR') in aliases)
+            if not mirrors:
+                break
+            aliases.update(mirrors)
+
+        for alias in sorted(aliases):
+            connection = getattr(connections._connections, alias, None)
+            if connection is not None:
+                connection.close()
+                delattr(connections._connections, alias)
+            self.removed[alias] = connections.databases.pop(alias)
+
+        for settings_dict in connections.databases.values():
+            for container, key in ((settings_dict.get('TEST') or {},
+                                    'DEPENDENCIES'),
+                                   (settings_dict, 'TEST_DEPENDENCIES')):
+                dependencies = container.get(key)
+                if dependencies and not aliases.isdisjoint(dependencies):
+                    self._dependencies.append((container, key, dependencies))
+                    container[key] = [alias for alias in dependencies
+                                      if alias not in aliases]
+
+        report.add_entry(REPORT_SECTION, 'unused aliases not set up',
+                         ', '.join(sorted(aliases)))
+
+    def uninstall(self):
+        from django.db import connections
+
+        connections.databases.update(self.removed)
+        self.removed = {}
+        for container, key, dependencies in self._dependencies:
+            container[key] = dependencies
+        self._dependencies = []
+
+
+unused_aliases = UnusedAliases()
+
+
+def setup_databases_with_reuse(config, verbosity, workers=1, lazy=False):
+    """Set up the test databases with Django, honouring --reuse-db.
+
+    With --reuse-db, re-used databases are validated against the schema
+    fingerprint recorded when they were set up.
+
+    With more than one *workers*, the databases are created by
+    :func:`setup_test_databases` and the result has to be passed to
+    :func:`teardown_test_databases`. With *lazy*, a
+    :class:`LazyTestDatabases` instance is returned. Otherwise Django's
+    setup_databases() is used.
+    """
+    from .compat import setup_databases
+
+    reuse_db = config.getvalue('reuse_db')
+    keepdb = reuse_db and not config.getvalue('create_db')
+
+    fingerprints = []
+    if reuse_db:
+        fingerprints = get_test_db_fingerprints()
+
+    # Checks whether the test databases exist, using one connection per
+    # database server.
+    probe = DatabaseProbe()
+    try:
+        db_args = {}
+        cached_contents = []
+        if keepdb:
+            drop_outdated_test_databases(config, fingerprints, verbosity,
+                                         probe)
+            cached_contents = use_cached_contents(config, fingerprints)
+
+            if get_django_version() >= (1, 8):
+                db_args['keepdb'] = True
+            else:
+                monkey_patch_creation_for_db_reuse(probe)
+
+        if lazy:
+            db_cfg = LazyTestDatabases(verbosity, **db_args)
+        elif workers > 1:
+            db_cfg = setup_test_databases(verbosity, workers, **db_args)
+        else:
+            db_cfg = setup_databases(verbosity=verbosity, interactive=False,
+                                     **db_args)
+
+        save_test_db_fingerprints(config, fingerprints, probe)
+        restore_cached_contents(config, fingerprints, cached_contents)
+    finally:
+        probe.close()
+    return db_cfg
+
+
+def can_setup_concurrently():
+    """Whether the test databases can be created from several threads.
+
+    In-memory SQLite databases are gone once the thread which created them
+    closes its connection.
+    """
+    from django.db import connections
+
+    if get_django_version() < (1, 6):
+        return False
+
+    for connection in connections.all():
+        if (connection.vendor == 'sqlite' and
+                is_in_memory_db(connection.creation._get_test_db_name())):
+            return False
+    return True
+
+
+def get_dependencies(test_databases):
+    """Return a dict of {first alias: aliases it depends on}.
+
+    The dependencies are defined by TEST['DEPENDENCIES']. Like in Django,
+    aliases without the setting depend on the default database.
+    """
+    from django.core.exceptions import ImproperlyConfigured
+    from django.db import DEFAULT_DB_ALIAS, connections
+
+    dependencies = {}
+    for db_name, aliases in test_databases:
+        deps = set()
+        if DEFAULT_DB_ALIAS not in aliases:
+            for alias in aliases:
+                deps.update(get_test_setting(
+                    connections[alias].settings_dict, 'DEPENDENCIES',
+                    [DEFAULT_DB_ALIAS]))
+        if not deps.isdisjoint(aliases):
+            raise ImproperlyConfigured(
+                "Circular dependency: databases %r depend on each other, "
+                "but are aliases." % aliases)
+        dependencies[aliases[0]] = deps
+    return dependencies
+
+
+def get_dependency_levels(test_databases):
+    """Split *test_databases* into levels which can be created concurrently.
+
+    The databases of each level only depend on databases of earlier levels.
+    """
+    from django.core.exceptions import ImproperlyConfigured
+
+    dependencies = get_dependencies(test_databases)
+    levels = []
+    resolved = set()
+    pending = list(test_databases)
+    while pending:
+        level = [item for item in pending
+                 if dependencies[item[1][0]].issubset(resolved)]
+        if not level:
+            raise ImproperlyConfigured(
+                "Circular dependency in TEST[DEPENDENCIES]")
+        for db_name, aliases in level:
+            resolved.update(aliases)
+        pending = [item for item in pending if item not in level]
+        levels.append(level)
+
+    return levels
+
+
+@contextlib.contextmanager
+def _shared_connection(connection):
+    """Allow *connection* to be used from another thread."""
+    if hasattr(connection, 'inc_thread_sharing'):
+        # Django 2.2+
+        connection.inc_thread_sharing()
+        try:
+            yield connection
+        finally:
+            connection.dec_thread_sharing()
+        return
+
+    allow_thread_sharing = connection.allow_thread_sharing
+    connection.allow_thread_sharing = True
+    try:
+        yield connection
+    finally:
+        connection.allow_thread_sharing = allow_thread_sharing
+
+
+def _close_thread_connections():
+    from django.db import connections
+
+    # Management commands like migrate use the connections of the current
+    # thread, not the shared one.
+    for connection in connections.all():
+        connection.close()
+
+
+def _map_in_threads(func, connections, workers):
+    """Call *func* with every connection in a pool of *workers* threads.
+
+    The connections are the ones of the calling thread, so the patches
+    applied to them (e.g. by --reuse-db) and the attributes set by *func*
+    (e.g. the serialized database contents) are not lost.
+    """
+    def run(connection):
+        with _shared_connection(connection):
+            start = time.time()
+            try:
+                func(connection)
+            finally:
+                connection.close()
+                _close_thread_connections()
+            return connection.alias, time.time() - start
+
+    for connection in connections:
+        connection.close()
+
+    pool = ThreadPool(min(workers, len(connections)))
+    try:
+        return pool.map(run, connections)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _create_test_db(connection, verbosity, keepdb=False, serialize=None):
+    create_args = {}
+    if keepdb:
+        create_args['keepdb'] = True
+    if get_django_version() >= (1, 7):
+        if serialize is None:
+            serialize = get_test_setting(connection.settings_dict,
+                                         'SERIALIZE', True)
+        create_args['serialize'] = serialize
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True,
+                                       **create_args)
+
+
+def setup_test_databases(verbosity, workers=1, keepdb=False):
+    """Create one test database per physical database.
+
+    Unlike Django's setup_databases(), only the first alias of each test
+    database creates it, the other aliases of the same database and the test
+    mirrors are pointed at it afterwards. With more than one *workers*,
+    databases which do not depend on each other are created at the same
+    time in a pool of threads, and the time it took to create each database
+    is added to the report.
+
+    Returns a list of ``(connection, old_name)`` tuples to be passed to
+    :func:`teardown_test_databases`.
+    """
+    from django.db import connections
+
+    test_databases, mirrored_aliases = get_unique_databases_and_mirrors()
+
+    def create_test_db(connection):
+        _create_test_db(connection, verbosity, keepdb)
+
+    old_names = []
+    for level in get_dependency_levels(test_databases):
+        primaries = [connections[aliases[0]] for db_name, aliases in level]
+        if workers > 1:
+            timings = _map_in_threads(create_test_db, primaries, workers)
+            for alias, seconds in timings:
+                report.add_timing(REPORT_SECTION,
+                                  "created database for alias '%s'" % alias,
+                                  seconds)
+        else:
+            for connection in primaries:
+                create_test_db(connection)
+
+        for db_name, aliases in level:
+            old_names.append((connections[aliases[0]], db_name))
+            for alias in aliases[1:]:
+                _set_as_test_mirror(connections[alias], aliases[0])
+
+    for alias, mirror_alias in mirrored_aliases.items():
+        _set_as_test_mirror(connections[alias], mirror_alias)
+
+    return old_names
+
+
+def teardown_test_databases(old_names, verbosity, workers=1):
+    """Destroy the databases created by setup_test_databases()."""
+    old_name_by_alias = dict((connection.alias, old_name)
+                             for connection, old_name in old_names)
+
+    def destroy_test_db(connection):
+        connection.creation.destroy_test_db(
+            old_name_by_alias[connection.alias], verbosity)
+
+    connections = [connection for connection, old_name in old_names]
+    if workers <= 1:
+        for connection in connections:
+            destroy_test_db(connection)
+        return
+
+    for alias, seconds in _map_in_threads(destroy_test_db, connections,
+                                          workers):
+        report.add_timing(REPORT_SECTION,
+                          "destroyed database for alias '%s'" % alias,
+                          seconds)
+
+
+class LazyTestDatabases(object):
+    """Create the test databases of some aliases when they are first used.
+
+    The default database is created right away, the other ones when a
+    connection to one of their aliases is about to be made for the first
+    time, in any thread. Until :meth:`uninstall` is called, the database
+    wrapper classes of the aliases are patched for this, so that no
+    connection with the original settings of an alias is ever made.
+
+    Databases are created using the connections of the thread which set up
+    the test databases, since the patches applied to them (e.g. for
+    --reuse-db) would be missing on the connections of other threads, like
+    the one of the live server. Whether their contents are serialized is
+    also determined by the settings at the time the test databases are set
+    up, since serialization is only disabled during the setup.
+    """
+
+    def __init__(self, verbosity, keepdb=False):
+        from django.db import DEFAULT_DB_ALIAS, connections
+
+        self.verbosity = verbosity
+        self.keepdb = keepdb
+        self.old_names = []
+
+        # The test database names of all aliases, for --db-slots.
+        self.test_db_names = {}
+
+        test_databases, self._mirrored_aliases = (
+            get_unique_databases_and_mirrors())
+        self._dependencies = get_dependencies(test_databases)
+        self._connections = dict((alias, connections[alias])
+                                 for alias in connections)
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._primaries = {}
+        self._serialize = {}
+        self._patched = []
+
+        eager = []
+        for db_name, aliases in test_databases:
+            connection = self._connections[aliases[0]]
+            test_db_name = connection.creation._get_test_db_name()
+            for alias in aliases:
+                self._primaries[alias] = aliases[0]
+                self.test_db_names[alias] = test_db_name
+            self._pending[aliases[0]] = (db_name, aliases)
+            self._serialize[aliases[0]] = get_test_setting(
+                connection.settings_dict, 'SERIALIZE', True)
+
+            # An in-memory database is gone once the thread which created
+            # it closes its connection.
+            if (DEFAULT_DB_ALIAS in aliases or
+                    (connection.vendor == 'sqlite' and
+                     is_in_memory_db(test_db_name))):
+                eager.append(aliases[0])
+
+        for alias, mirror_alias in self._mirrored_aliases.items():
+            self._primaries[alias] = self._primaries[mirror_alias]
+
+        self._install()
+        try:
+            for alias in eager:
+                self.create(alias, lazily=False)
+        except Exception:
+            self.uninstall()
+            raise
+
+    def is_pending(self, alias):
+        """Whether the test database of *alias* has not been created yet."""
+        return self._primaries.get(alias) in self._pending
+
+    def create(self, alias, lazily=True):
+        """Create the test database of *alias* if it is still pending."""
+        with self._lock:
+            if not self.is_pending(alias):
+                return
+
+            primary = self._primaries[alias]
+            db_name, aliases = self._pending.pop(primary)
+            for dependency in self._dependencies[primary]:
+                self.create(dependency, lazily)
+
+            connection = self._connections[primary]
+            start = time.time()
+            with _shared_connection(connection):
+                # Like the databases created by the session setup.
+                with data_migration_skipper.skipping(
+                        data_migration_skipper.patterns,
+                        data_migration_skipper.cache_dir):
+                    _create_test_db(connection, self.verbosity, self.keepdb,
+                                    self._serialize[primary])
+            if lazily:
+                report.add_timing(
+                    REPORT_SECTION,
+                    "created database for alias '%s' on first use" % primary,
+                    time.time() - start)
+
+            self.old_names.append((connection, db_name))
+            for other_alias in aliases[1:]:
+                _set_as_test_mirror(self._connections[other_alias], primary)
+            for mirror, mirror_alias in self._mirrored_aliases.items():
+                if mirror_alias in aliases:
+                    _set_as_test_mirror(self._connections[mirror],
+                                        mirror_alias)
+
+    def _install(self):
+        # Django < 1.6 connects in _cursor().
+        if get_django_version() >= (1, 6):
+            method_name = 'ensure_connection'
+        else:
+            method_name = '_cursor'
+
+        classes = set(type(connection)
+                      for connection in self._connections.values())
+        for cls in classes:
+            self._patched.append((cls, method_name,
+                                  cls.__dict__.get(method_name)))
+            setattr(cls, method_name,
+                    self._make_connect_method(getattr(cls, method_name)))
+
+    def _make_connect_method(self, original):
+        lazy_databases = self
+
+        def connect(connection, *args, **kwargs):
+            if (connection.connection is None and
+                    lazy_databases.is_pending(connection.alias)):
+                lazy_databases.create(connection.alias)
+            return original(connection, *args, **kwargs)
+        return connect
+
+    def uninstall(self):
+        """Restore the database wrapper classes.
+
+        Databases which are still pending are not created anymore.
+        """
+        for cls, method_name, original in reversed(self._patched):
+            if original is not None:
+                setattr(cls, method_name, original)
+            else:
+                delattr(cls, method_name)
+        self._patched = []
+
+
+@contextlib.contextmanager
+def _adopted_connections(connections_to_adopt):
+    """Use the connections of another thread in the current thread.
+
+    This makes sure that everything done to the connections while setting
+    up the test databases (e.g. the names of the test databases, patches for
+    --reuse-db or in-memory SQLite databases) is seen by the other thread.
+    """
+    from django.db import connections
+
+    sharing = [_shared_connection(connection)
+               for connection in connections_to_adopt]
+    for context in sharing:
+        context.__enter__()
+    for connection in connections_to_adopt:
+        setattr(connections._connections, connection.alias, connection)
+    try:
+        yield
+    finally:
+        for connection in connections_to_adopt:
+            delattr(connections._connections, connection.alias)
+        for context in reversed(sharing):
+            context.__exit__(None, None, None)
+
+
+class BackgroundDatabaseSetup(object):
+    """Set up the test databases in a background thread.
+
+    *setup* is called in the thread and its result is returned by
+    :meth:`claim`. The thread uses the connections of the thread which
+    calls :meth:`start`, which must not use them until the setup is done.
+    """
+
+    def __init__(self, setup):
+        self._setup = setup
+        self._thread = threading.Thread(target=self._run,
+                                        name='pytest-django-db-setup')
+        self._thread.daemon = True
+        self._connections = None
+        self._result = None
+        self._exception = None
+        self._claimed = False
+
+    def start(self):
+        from django.db import connections
+
+        self._connections = connections.all()
+        self._thread.start()
+
+    def _run(self):
+        start = time.time()
+        with _adopted_connections(self._connections):
+            try:
+                self._result = self._setup()
+            except BaseException as e:
+                self._exception = e
+        report.add_timing(REPORT_SECTION,
+                          'set up databases in the background',
+                          time.time() - start)
+
+    def join(self):
+        """Wait for the setup to finish."""
+        if not self._thread.is_alive():
+            return
+        start = time.time()
+        self._thread.join()
+        report.add_timing(REPORT_SECTION,
+                          'waited for the background setup',
+                          time.time() - start)
+
+    def claim(self):
+        """Wait for the setup and return its result.
+
+        An exception raised by the setup is raised again.
+        """
+        self.join()
+        self._claimed = True
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def is_claimed(self):
+        return self._claimed
+
+
+def _set_as_test_mirror(connection, primary_alias):
+    from django.db import connections
+
+    primary_settings_dict = connections[primary_alias].settings_dict
+    if hasattr(connection.creation, 'set_as_test_mirror'):
+        connection.creation.set_as_test_mirror(primary_settings_dict)
+    else:
+        connection.settings_dict['NAME'] = primary_settings_dict['NAME']
+
+
+def _serialize_test_db(connection):
+    creation = connection.creation
+    if (hasattr(creation, 'serialize_db_to_string') and
+            get_test_setting(connection.settings_dict, 'SERIALIZE', True)):
+        connection._test_serialized_contents = (
+            creation.serialize_db_to_string())
+
+
+def setup_databases_from_template(config, suffix, verbosity,
+                                  template_suffix=TEMPLATE_SUFFIX, workers=1):
+    """Set up the test databases of an xdist worker from a template.
+
+    The first worker builds the template databases (e.g. ``test_foo_template``)
+    the normal way and all workers then clone their own database (e.g.
+    ``test_foo_gw0``) from it. A file lock makes sure only one worker builds
+    the template while the other ones wait for it. The template is built
+    with *workers* threads, like in :func:`setup_databases_with_reuse`.
+
+    Returns a list of ``(connection, old_name)`` tuples to be passed to
+    :func:`teardown_cloned_databases`.
+    """
+    from django.db import connections
+
+    test_databases, mirrored_aliases = get_unique_databases_and_mirrors()
+
+    # Figure out all names before setup_databases() changes the settings.
+    clones = []
+    for db_name, aliases in test_databases:
+        settings_dict = connections[aliases[0]].settings_dict
+        clones.append((db_name, aliases,
+                       _get_db_name(settings_dict, template_suffix),
+                       _get_db_name(settings_dict, suffix)))
+
+    template_names = sorted(clone[2] for clone in clones)
+    key = hashlib.sha1('\n'.join(template_names).encode('utf-8'))
+    lock_dir = get_cache_dir(config, 'db-template')
+    built_file = lock_dir.join(key.hexdigest() + '.built')
+    testrun = config.slaveinput.get(TESTRUN_KEY)
+
+    with FileLock(lock_dir.join(key.hexdigest() + '.lock')):
+        if testrun and built_file.check() and built_file.read() == testrun:
+            for db_name, aliases, template_name, target_name in clones:
+                for alias in aliases:
+                    connections[alias].settings_dict['NAME'] = template_name
+        else:
+            monkey_patch_creation_for_db_suffix(template_suffix)
+            setup_databases_with_reuse(config, verbosity, workers)
+            built_file.write(testrun or '')
+
+        monkey_patch_creation_for_db_suffix(suffix)
+
+        old_names = []
+        for db_name, aliases, template_name, target_name in clones:
+            connection = connections[aliases[0]]
+
+            # Nobody may be connected to the template while it is cloned.
+            connection.close()
+            if verbosity >= 1:
+                print("Cloning test database for alias '%s' from '%s'..." % (
+                    connection.alias, template_name))
+            clone_test_db(connection, template_name, target_name)
+
+            for alias in aliases:
+                connections[alias].settings_dict['NAME'] = target_name
+            old_names.append((connection, db_name))
+
+            _serialize_test_db(connection)
+            connection.close()
+
+    for alias, mirror_alias in mirrored_aliases.items():
+        connections[alias].settings_dict['NAME'] = (
+            connections[mirror_alias].settings_dict['NAME'])
+
+    return old_names
+
+
+def teardown_cloned_databases(old_names, verbosity):
+    """Destroy the databases created by setup_databases_from_template()."""
+    for connection, old_name in old_names:
+        connection.creation.destroy_test_db(old_name, verbosity)
+
+
+def can_use_worker_schemas():
+    """Whether all test databases can be shared by schemas of xdist workers."""
+    from django.db import connections
+
+    return all(connection.vendor == 'postgresql'
+               for connection in connections.all())
+
+
+def _set_search_path(connection, schemas):
+    connection.close()
+    options = dict(connection.settings_dict.get('OPTIONS') or {})
+    search_path = '-c search_path=%s' % ','.join(schemas)
+    if options.get('options'):
+        search_path = '%s %s' % (options['options'], search_path)
+    options['options'] = search_path
+    connection.settings_dict['OPTIONS'] = options
+
+
+def _worker_schemas_state(config, shared_names):
+    """Return the lock and the state file of the shared test databases.
+
+    The state file lists the test run which built the databases and the
+    workers which still use them.
+    """
+    key = hashlib.sha1('\n'.join(sorted(shared_names)).encode('utf-8'))
+    lock_dir = get_cache_dir(config, 'db-schemas')
+    return (FileLock(lock_dir.join(key.hexdigest() + '.lock')),
+            lock_dir.join(key.hexdigest() + '.json'))
+
+
+def _read_worker_schemas_state(state_file):
+    if not state_file.check():
+        return None
+    try:
+        return json.loads(state_file.read())
+    except ValueError:
+        return None
+
+
+def setup_worker_schemas(config, suffix, verbosity, workers=1):
+    """Set up the test databases of an xdist worker as PostgreSQL schemas.
+
+    All workers share the same test databases (e.g. ``test_foo``), which
+    the first worker builds the normal way. Every worker then copies the
+    ``public`` schema, where the tables were created, to a schema of its own
+    (e.g. ``pytest_django_gw0``), which is put first on the search path of
+    its connections. A file lock makes sure only one worker builds the
+    shared databases while the other ones wait for it.
+
+    Returns a list of ``(connection, old_name, schema)`` tuples to be passed
+    to :func:`teardown_worker_schemas`.
+    """
+    from django.db import connections
+
+    test_databases, mirrored_aliases = get_unique_databases_and_mirrors()
+    slaveid = config.slaveinput['slaveid']
+    schema = WORKER_SCHEMA_PREFIX + slaveid
+
+    shared = []
+    for db_name, aliases in test_databases:
+        settings_dict = connections[aliases[0]].settings_dict
+        shared.append((db_name, aliases, _get_db_name(settings_dict, suffix)))
+
+    lock, state_file = _worker_schemas_state(
+        config, [shared_name for db_name, aliases, shared_name in shared])
+    testrun = config.slaveinput.get(TESTRUN_KEY)
+
+    with lock:
+        state = _read_worker_schemas_state(state_file)
+        if testrun and state and state['testrun'] == testrun:
+            for db_name, aliases, shared_name in shared:
+                for alias in aliases:
+                    connections[alias].settings_dict['NAME'] = shared_name
+        else:
+            setup_databases_with_reuse(config, verbosity, workers)
+            state = {'testrun': testrun or '', 'workers': []}
+
+        old_names = []
+        for db_name, aliases, shared_name in shared:
+            connection = connections[aliases[0]]
+            if verbosity >= 1:
+                print("Copying test database schema for alias '%s' to "
+                      "'%s'..." % (connection.alias, schema))
+            clone_postgresql_schema(connection, TEMPLATE_SCHEMA, schema)
+
+            for alias in aliases:
+                _set_search_path(connections[alias],
+                                 [schema, TEMPLATE_SCHEMA])
+            old_names.append((connection, db_name, schema))
+
+            _serialize_test_db(connection)
+            connection.close()
+
+        if slaveid not in state['workers']:
+            state['workers'].append(slaveid)
+        state_file.write(json.dumps(state))
+
+    for alias, mirror_alias in mirrored_aliases.items():
+        connections[alias].settings_dict['NAME'] = (
+            connections[mirror_alias].settings_dict['NAME'])
+        connections[alias].settings_dict['OPTIONS'] = (
+            connections[mirror_alias].settings_dict['OPTIONS'])
+
+    return old_names
+
+
+def teardown_worker_schemas(config, old_names, verbosity):
+    """Drop the schemas created by :func:`setup_worker_schemas`.
+
+    The last worker which is done with the shared test databases destroys
+    them.
+    """
+    from django.db import connections
+
+    lock, state_file = _worker_schemas_state(
+        config, [connection.settings_dict['NAME']
+                 for connection, old_name, schema in old_names])
+    slaveid = config.slaveinput['slaveid']
+
+    with lock:
+        for connection, old_name, schema in old_names:
+            drop_postgresql_schema(connection, schema)
+        # PostgreSQL cannot drop databases which are in use.
+        for connection in connections.all():
+            connection.close()
+
+        state = _read_worker_schemas_state(state_file)
+        if state and slaveid in state['workers']:
+            state['workers'].remove(slaveid)
+        if state and state['workers']:
+            state_file.write(json.dumps(state))
+            return
+
+        for connection, old_name, schema in old_names:
+            connection.creation.destroy_test_db(old_name, verbosity)
+        if state_file.check():
+            state_file.remove()
+
+
+def load_sqlite_databases_into_memory(test_databases, mirrored_aliases,
+                                      verbosity):
+    """Switch file based SQLite test databases to in-memory copies.
+
+    *test_databases* and *mirrored_aliases* are the result of
+    get_unique_databases_and_mirrors() from before the test databases were
+    set up. Databases which are shared by several aliases are left alone,
+    since every connection to ``:memory:`` gets its own database.
+
+    Returns a list of ``(connection, file_name)`` tuples to be passed to
+    :func:`restore_sqlite_file_databases`.
+    """
+    from django.db import connections
+
+    mirrored = set(mirrored_aliases.values())
+    loaded = []
+    for db_name, aliases in test_databases:
+        connection = connections[aliases[0]]
+        file_name = connection.settings_dict['NAME']
+        if (connection.vendor != 'sqlite' or is_in_memory_db(file_name) or
+                len(aliases) > 1 or aliases[0] in mirrored):
+            continue
+
+        if verbosity >= 1:
+            print("Loading test database for alias '%s' into memory..."
+                  % connection.alias)
+
+        connection.close()
+        connection.settings_dict['NAME'] = ':memory:'
+        if hasattr(connection, 'ensure_connection'):
+            connection.ensure_connection()
+        else:
+            # Django < 1.6
+            connection._cursor()
+        copy_sqlite_db(file_name, connection.connection)
+        loaded.append((connection, file_name))
+
+    return loaded
+
+
+def restore_sqlite_file_databases(loaded):
+    """Point the connections back to their database files.
+
+    This discards the in-memory databases, changes are not written back.
+    """
+    for connection, file_name in loaded:
+        connection.settings_dict['NAME'] = file_name
+        # Closing is a no-op for in-memory databases, so close the underlying
+        # connection directly.
+        if connection.connection is not None:
+            connection.connection.close()
+            connection.connection = None
@@ -0,0 +1,479 @@
+"""Loading fixture files for the ``fixtures`` argument of the django_db mark.
+
+``loaddata`` reads and deserializes the fixture files again for every test
+and saves the objects one at a time. Here, the deserialized field values are
+cached per file (and modification time) for the whole test session, and the
+objects are inserted with one bulk_create() per model. Objects of models with
+pre_save or post_save receivers are saved one at a time like by loaddata, so
+that the receivers are still called with raw=True.
+
+JSON fixture files which are larger than --fixture-stream-size are not
+cached. They are read and deserialized incrementally instead, and inserted
+in batches, so that only a batch of objects is held in memory at a time.
+"""
+
+from __future__ import with_statement
+
+import io
+import itertools
+import json
+import os
+import sys
+import time
+
+from . import report
+from .lazy_django import get_django_version
+
+REPORT_SECTION = 'fixtures'
+
+# How many objects are inserted at once, and how many characters of a
+# streamed fixture file are read at once.
+INSERT_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class FixtureFile(object):
+    """The deserialized objects of a fixture file.
+
+    *objects* is a list of ``(model, field values, m2m data)`` tuples, in
+    the order of the file. The field values are keyed by attribute name, the
+    m2m data maps field names to lists of primary keys.
+    """
+
+    def __init__(self, path, mtime, objects, parse_time):
+        self.path = path
+        self.mtime = mtime
+        self.objects = objects
+        self.parse_time = parse_time
+
+
+class FixtureStats(object):
+    def __init__(self):
+        self.files = 0
+        self.cached_files = 0
+        self.streamed_files = 0
+        self.load_time = 0.0
+        self.parse_time_saved = 0.0
+        self.shared_loads = 0
+        self.shared_tests = 0
+
+    def add_to_report(self):
+        if not self.files:
+            return
+        report.add_entry(REPORT_SECTION, 'fixture files loaded',
+                         '%d (%d from the cache)'
+                         % (self.files, self.cached_files))
+        report.add_timing(REPORT_SECTION, 'spent loading fixtures',
+                          self.load_time)
+        report.add_timing(REPORT_SECTION,
+                          'saved by not parsing fixture files again',
+                          self.parse_time_saved)
+        if self.streamed_files:
+            report.add_entry(REPORT_SECTION, 'fixture files streamed',
+                             str(self.streamed_files))
+        if self.shared_tests:
+            report.add_entry(REPORT_SECTION, 'tests sharing fixtures',
+                             '%d, with %d fixture loads'
+                             % (self.shared_tests, self.shared_loads))
+
+
+fixture_stats = FixtureStats()
+
+# Maps (path, database alias) to FixtureFile instances.
+_fixture_files = {}
+
+
+def can_load_fixtures_in_bulk():
+    return get_django_version() >= (1, 8)
+
+
+def _fixture_dirs():
+    """The directories searched by loaddata, see its documentation."""
+    from django.apps import apps
+    from django.conf import settings
+
+    dirs = []
+    for app_config in apps.get_app_configs():
+        app_dir = os.path.join(app_config.path, 'fixtures')
+        if os.path.isdir(app_dir):
+            dirs.append(app_dir)
+    dirs.extend(settings.FIXTURE_DIRS)
+    dirs.append('')
+    return [os.path.abspath(os.path.realpath(d)) for d in dirs]
+
+
+def find_fixture_files(label, using):
+    """Return ``(path, format)`` for the fixture files of *label*.
+
+    Returns None if the label uses a compressed format, which is left to
+    loaddata.
+    """
+    from django.core import serializers
+
+    formats = serializers.get_public_serializer_formats()
+    name, ext = os.path.splitext(label)
+    if ext[1:] in formats:
+        candidates = [(label, ext[1:])]
+    elif ext[1:] in ('gz', 'zip', 'bz2'):
+        return None
+    else:
+        candidates = []
+        for fmt in formats:
+            candidates.append(('%s.%s.%s' % (label, using, fmt), fmt))
+            candidates.append(('%s.%s' % (label, fmt), fmt))
+
+    if os.path.isabs(label):
+        dirs = ['']
+    else:
+        dirs = _fixture_dirs()
+
+    found = []
+    for fixture_dir in dirs:
+        for candidate, fmt in candidates:
+            path = os.path.join(fixture_dir, candidate)
+            if os.path.isfile(path):
+                found.append((path, fmt))
+    return found
+
+
+def _get_m2m_through(field):
+    remote_field = getattr(field, 'remote_field', None) or field.rel
+    return remote_field.through
+
+
+def _get_objects(deserialized, using):
+    """Yield ``(model, field values, m2m data)`` for the *deserialized*
+    objects which belong into the database *using*."""
+    from django.db import router
+
+    for obj in deserialized:
+        model = obj.object.__class__
+        if not router.allow_migrate_model(using, model):
+            continue
+        values = dict((field.attname, getattr(obj.object, field.attname))
+                      for field in model._meta.concrete_fields)
+        yield model, values, obj.m2m_data or {}
+
+
+def parse_fixture_file(path, fmt, using):
+    """Deserialize the fixture file *path* for the database *using*."""
+    from django.core import serializers
+
+    start = time.time()
+    with open(path, 'rb') as stream:
+        objects = list(_get_objects(
+            serializers.deserialize(fmt, stream, using=using,
+                                    ignorenonexistent=True), using))
+
+    return FixtureFile(path, os.path.getmtime(path), objects,
+                       time.time() - start)
+
+
+def iter_json_array(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the items of the JSON array read from the text *stream*.
+
+    Only the item which is decoded and about one chunk of the stream are
+    held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    state = 'start'
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError('The JSON array ends unexpectedly.')
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        char = buf[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError('Expected a JSON array.')
+            pos += 1
+            state = 'first'
+        elif state in ('first', 'next') and char == ']':
+            return
+        elif state == 'next':
+            if char != ',':
+                raise ValueError('Expected "," or "]" in the JSON array.')
+            pos += 1
+            state = 'item'
+        else:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = len(buf)
+            if end == len(buf) and not eof:
+                # The item may continue in the next chunk. Read at least as
+                # much as is buffered, so that large items are not decoded
+                # over and over again.
+                chunk = stream.read(max(chunk_size, len(buf) - pos))
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+            state = 'next'
+
+
+def stream_fixture_file(path, using):
+    """Deserialize the JSON fixture file *path* object by object."""
+    from django.core.serializers.base import DeserializationError
+    from django.core.serializers.python import Deserializer
+
+    with io.open(path, encoding='utf-8') as stream:
+        try:
+            for obj in _get_objects(
+                    Deserializer(iter_json_array(stream), using=using,
+                                 ignorenonexistent=True), using):
+                yield obj
+        except ValueError as e:
+            raise DeserializationError("Problem installing fixture '%s': %s"
+                                       % (path, e))
+
+
+def get_fixture_file(path, fmt, using):
+    """Return the cached :class:`FixtureFile` of *path*, parsing it if the
+    file is new or has changed."""
+    key = (path, using)
+    fixture_file = _fixture_files.get(key)
+    if (fixture_file is not None and
+            fixture_file.mtime == os.path.getmtime(path)):
+        fixture_stats.cached_files += 1
+        fixture_stats.parse_time_saved += fixture_file.parse_time
+        return fixture_file
+
+    fixture_file = _fixture_files[key] = parse_fixture_file(path, fmt, using)
+    return fixture_file
+
+
+def _get_batches(objects, size=INSERT_BATCH_SIZE):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _group_by_model(objects):
+    """Split *objects* into runs of consecutive objects of the same model.
+
+    The order of the file is kept, so that rows referenced by foreign keys
+    are still inserted first.
+    """
+    groups = []
+    for obj in objects:
+        if groups and groups[-1][0] is obj[0]:
+            groups[-1][1].append(obj)
+        else:
+            groups.append((obj[0], [obj]))
+    return groups
+
+
+def _has_save_receivers(model):
+    from django.db.models import signals
+
+    return (signals.pre_save.has_listeners(model) or
+            signals.post_save.has_listeners(model))
+
+
+def _save_group(model, group, using):
+    from django.db import DatabaseError, models, transaction
+    from django.db.models import signals
+
+    instances = [model(**values) for model, values, m2m_data in group]
+    saved = False
+    if not _has_save_receivers(model):
+        try:
+            with transaction.atomic(using=using):
+                model._base_manager.db_manager(using).bulk_create(instances)
+            saved = True
+        except (ValueError, DatabaseError):
+            # E.g. multi-table inheritance or rows which exist already, which
+            # loaddata updates.
+            pass
+    if not saved:
+        for instance in instances:
+            models.Model.save_base(instance, using=using, raw=True)
+
+    through_rows = {}
+    for instance, (model, values, m2m_data) in zip(instances, group):
+        for name, pks in m2m_data.items():
+            field = model._meta.get_field(name)
+            through = _get_m2m_through(field)
+            if signals.m2m_changed.has_listeners(through):
+                # Like loaddata, which sends m2m_changed.
+                setattr(instance, name, pks)
+                continue
+            source = through._meta.get_field(field.m2m_field_name()).attname
+            target = through._meta.get_field(
+                field.m2m_reverse_field_name()).attname
+            rows = through_rows.setdefault(through, [])
+            for pk in pks:
+                rows.append(through(**{source: instance.pk, target: pk}))
+    for through, rows in through_rows.items():
+        through._base_manager.db_manager(using).bulk_create(rows)
+
+
+def finish_loading(connection, models):
+    """Check the constraints and reset the sequences of the tables of
+    *models*, after rows were inserted with their primary keys."""
+    from django.core.management.color import no_style
+
+    connection.check_constraints(
+        table_names=[model._meta.db_table for model in models])
+
+    sequence_sql = connection.ops.sequence_reset_sql(no_style(), models)
+    if sequence_sql:
+        cursor = connection.cursor()
+        try:
+            for sql in sequence_sql:
+                cursor.execute(sql)
+        finally:
+            cursor.close()
+
+
+def save_objects(objects, using):
+    """Insert the deserialized *objects* like loaddata does.
+
+    *objects* can be an iterator, they are inserted in batches of
+    :data:`INSERT_BATCH_SIZE`.
+    """
+    from django.db import connections, transaction
+
+    connection = connections[using]
+    loaded_models = set()
+    with transaction.atomic(using=using):
+        with connection.constraint_checks_disabled():
+            for batch in _get_batches(objects):
+                for model, group in _group_by_model(batch):
+                    _save_group(model, group, using)
+                    loaded_models.add(model)
+
+        finish_loading(connection, list(loaded_models))
+
+
+def load_fixtures(labels, using=None, stream_size=None):
+    """Load the fixtures *labels* into the database *using*.
+
+    Like with loaddata, the objects of all fixture files are inserted before
+    the constraints are checked. Fixtures which cannot be loaded in bulk,
+    e.g. compressed ones or ones which are not found (to get loaddata's
+    warning), are passed to loaddata. JSON fixture files larger than
+    *stream_size* bytes are streamed instead of being cached.
+    """
+    from django.core.management import call_command
+    from django.db import DEFAULT_DB_ALIAS
+
+    if using is None:
+        using = DEFAULT_DB_ALIAS
+
+    start = time.time()
+    sources = []
+    for label in labels:
+        fixture_files = None
+        if can_load_fixtures_in_bulk():
+            fixture_files = find_fixture_files(label, using)
+        if not fixture_files:
+            if sources:
+                save_objects(itertools.chain(*sources), using)
+                sources = []
+            call_command('loaddata', label, verbosity=0, database=using)
+            continue
+
+        for path, fmt in fixture_files:
+            fixture_stats.files += 1
+            if (fmt == 'json' and stream_size is not None and
+                    os.path.getsize(path) > stream_size):
+                fixture_stats.streamed_files += 1
+                sources.append(stream_fixture_file(path, using))
+            else:
+                sources.append(get_fixture_file(path, fmt, using).objects)
+
+    if sources:
+        save_objects(itertools.chain(*sources), using)
+    fixture_stats.load_time += time.time() - start
+
+
+def group_items(items, get_key):
+    """Reorder *items* so that the ones with the same key run back to back.
+
+    Every group runs where its first item was. Items for which *get_key*
+    returns None keep their place relative to the groups.
+    """
+    groups = {}
+    ordered = []
+    for item in items:
+        key = get_key(item)
+        if key is None:
+            ordered.append([item])
+            continue
+        if key not in groups:
+            groups[key] = []
+            ordered.append(groups[key])
+        groups[key].append(item)
+    return [item for group in ordered for item in group]
+
+
+class SharedFixtures(object):
+    """Fixtures which are loaded once for consecutive tests.
+
+    Like with module_db, the fixtures are loaded inside an outer atomic
+    block, and the tests run in savepoints inside of it. :meth:`exit` rolls
+    the fixtures back once the next test needs other ones.
+    """
+
+    def __init__(self):
+        self.key = None
+        self._atomic = None
+        self._cursor_manager = None
+
+    def enter(self, fixtures, cursor_manager, stream_size=None):
+        """Load *fixtures* unless they are loaded already."""
+        from django.db import DEFAULT_DB_ALIAS, transaction
+
+        key = tuple(fixtures)
+        fixture_stats.shared_tests += 1
+        if key == self.key:
+            return
+        self.exit()
+
+        atomic = transaction.atomic(using=DEFAULT_DB_ALIAS)
+        atomic.__enter__()
+        try:
+            load_fixtures(fixtures, stream_size=stream_size)
+        except Exception:
+            atomic.__exit__(*sys.exc_info())
+            raise
+        fixture_stats.shared_loads += 1
+        self.key = key
+        self._atomic = atomic
+        self._cursor_manager = cursor_manager
+
+    def exit(self):
+        """Roll back the loaded fixtures."""
+        from django.db import DEFAULT_DB_ALIAS, transaction
+
+        if self._atomic is None:
+            return
+        atomic = self._atomic
+        self.key = self._atomic = None
+        with self._cursor_manager:
+            transaction.set_rollback(True, using=DEFAULT_DB_ALIAS)
+            atomic.__exit__(None, None, None)
+
+
+shared_fixtures = SharedFixtures()
@@ -0,0 +1,208 @@
+"""Pools of clean test databases for tests using transactional_db.
+
+Instead of flushing the test database after every transactional test, the
+test runs on a clean copy of it which is thrown away afterwards. A thread
+replaces the used copies with new ones while the next tests run.
+"""
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from . import report
+from .db_clone import clone_test_db, drop_test_db, is_in_memory_db
+
+REPORT_SECTION = 'test database setup'
+
+# How often a copy is cloned again before it is given up.
+CLONE_ATTEMPTS = 3
+
+
+def can_pool_test_db(connection):
+    """Whether copies of the current database of *connection* can be made."""
+    return (connection.vendor in ('postgresql', 'mysql', 'sqlite') and
+            not is_in_memory_db(connection.settings_dict['NAME']))
+
+
+class DatabasePool(object):
+    """Clean copies of the test database of some aliases.
+
+    *connections* are the connections of all aliases which use the test
+    database, including test mirrors. The copies are cloned from a template,
+    which is a copy of the test database taken when the pool is created.
+    Cloning from the test database itself would copy changes of the running
+    tests, and PostgreSQL cannot clone a database which is in use.
+    """
+
+    def __init__(self, connections, size, verbosity=1):
+        self.connections = connections
+        self.aliases = [connection.alias for connection in connections]
+        self.source_name = connections[0].settings_dict['NAME']
+        self.template_name = '%s_pool_template' % self.source_name
+        self.size = size
+        self.verbosity = verbosity
+        self.waited = 0.0
+        self._names = ['%s_pool%d' % (self.source_name, i + 1)
+                       for i in range(size)]
+        # The number of copies which have not been given up.
+        self._usable = size
+        self._clean = queue.Queue()
+        self._dirty = queue.Queue()
+        self._leased = None
+        self._thread = threading.Thread(target=self._refill,
+                                        name='pytest-django-db-pool')
+        self._thread.daemon = True
+
+    @property
+    def connection(self):
+        return self.connections[0]
+
+    def start(self):
+        if self.verbosity >= 1:
+            print("Creating a pool of %d test databases for alias '%s'..."
+                  % (self.size, self.connection.alias))
+
+        self._close_connections()
+        clone_test_db(self.connection, self.source_name, self.template_name)
+        for name in self._names:
+            self._dirty.put(name)
+        self._thread.start()
+
+    def _refill(self):
+        while True:
+            name = self._dirty.get()
+            if name is None:
+                return
+
+            for attempt in range(CLONE_ATTEMPTS):
+                try:
+                    clone_test_db(self.connection, self.template_name, name)
+                except Exception:
+                    # E.g. the live server is still connected to it.
+                    time.sleep(0.1 * 2 ** attempt)
+                else:
+                    self._clean.put(name)
+                    break
+            else:
+                self._clean.put(None)
+
+    def _close_connections(self):
+        for connection in self.connections:
+            connection.close()
+
+    def _switch_to(self, name):
+        self._close_connections()
+        for connection in self.connections:
+            connection.settings_dict['NAME'] = name
+
+    def lease(self):
+        """Switch the connections to a clean copy of the test database.
+
+        Waits for the refill thread if no clean copy is available.
+        """
+        start = time.time()
+        name = self._clean.get()
+        self.waited += time.time() - start
+        while name is None:
+            # A copy could not be cloned and is given up.
+            self._usable -= 1
+            if not self._usable:
+                raise RuntimeError("No clean test database left in the pool "
+                                   "for alias '%s'." % self.connection.alias)
+            name = self._clean.get()
+
+        self._leased = name
+        self._switch_to(name)
+
+    def release(self):
+        """Switch back to the test database and replace the used copy."""
+        if self._leased is None:
+            return
+        self._switch_to(self.source_name)
+        self._dirty.put(self._leased)
+        self._leased = None
+
+    def close(self):
+        """Stop the refill thread and drop all copies and the template."""
+        self.release()
+        self._dirty.put(None)
+        self._thread.join()
+
+        for name in self._names + [self.template_name]:
+            drop_test_db(self.connection, name)
+
+
+class DatabasePools(object):
+    """The pools created by :func:`create_database_pools`."""
+
+    def __init__(self):
+        self._pools = []
+
+    def __contains__(self, alias):
+        for pool in self._pools:
+            if alias in pool.aliases:
+                return True
+        return False
+
+    def __bool__(self):
+        return bool(self._pools)
+    __nonzero__ = __bool__
+
+    def add(self, pool):
+        self._pools.append(pool)
+
+    def lease(self):
+        for pool in self._pools:
+            pool.lease()
+
+    def release(self):
+        for pool in self._pools:
+            pool.release()
+
+    def close(self):
+        pools, self._pools = self._pools, []
+        for pool in pools:
+            pool.close()
+            report.add_timing(REPORT_SECTION,
+                              "waited for pooled databases for alias '%s'"
+                              % pool.connection.alias, pool.waited)
+
+
+database_pools = DatabasePools()
+
+
+def create_database_pools(size, verbosity=1, skip_alias=None):
+    """Create a pool of *size* copies of every test database.
+
+    Databases which cannot be copied, like in-memory SQLite databases, are
+    left out, as are the ones used by an alias for which *skip_alias*
+    returns True.
+    """
+    from django.db import connections
+
+    by_database = {}
+    databases = []
+    for connection in connections.all():
+        key = (connection.settings_dict['ENGINE'],
+               connection.settings_dict.get('HOST'),
+               connection.settings_dict.get('PORT'),
+               connection.settings_dict['NAME'])
+        if key not in by_database:
+            by_database[key] = []
+            databases.append(key)
+        by_database[key].append(connection)
+
+    for key in databases:
+        group = by_database[key]
+        if (not can_pool_test_db(group[0]) or
+                (skip_alias and
+                 any(skip_alias(connection.alias) for connection in group))):
+            continue
+
+        pool = DatabasePool(group, size, verbosity)
+        pool.start()
+        database_pools.add(pool)
@@ -0,0 +1,454 @@
+"""Resetting the test database after tests using transactional_db.
+
+Django's TransactionTestCase flushes every table after every test. The
+functions in this module implement cheaper ways to get back to the state
+the test database had after it was set up.
+"""
+
+import os
+import re
+import sqlite3
+import tempfile
+
+from .db_clone import copy_sqlite_connection
+from .db_connections import persistent_connections
+from .db_creation import get_test_setting
+from .db_pool import database_pools
+from .lazy_django import get_django_version
+
+_IDENTIFIER = r'(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|[\w$]+)'
+_TABLE = r'(%s(?:\s*\.\s*%s)*)' % (_IDENTIFIER, _IDENTIFIER)
+
+_WRITE_RE = re.compile(
+    r'\s*(?:INSERT|REPLACE|UPDATE|DELETE)'
+    r'(?:\s+(?:OR\s+\w+|IGNORE|LOW_PRIORITY|DELAYED|HIGH_PRIORITY|QUICK|'
+    r'ONLY))*'
+    r'(?:\s+(?:INTO|FROM))?\s+' + _TABLE,
+    re.IGNORECASE)
+_TRUNCATE_RE = re.compile(r'\s*TRUNCATE\s+(?:TABLE\s+)?(?:ONLY\s+)?([^;]*)',
+                          re.IGNORECASE)
+_TABLE_RE = re.compile(_TABLE)
+_READ_ONLY_RE = re.compile(
+    r'\s*(?:SELECT|SAVEPOINT|RELEASE|ROLLBACK|COMMIT|BEGIN|START|END|SET|'
+    r'SHOW|PRAGMA|EXPLAIN|DESCRIBE|DECLARE|FETCH|CLOSE|VALUES)\b',
+    re.IGNORECASE)
+
+
+def _unquote(table):
+    # Only the table name is of interest, not the schema.
+    name = re.findall(_IDENTIFIER, _TABLE_RE.match(table).group(1))[-1]
+    if name[:1] in '"`[':
+        name = name[1:-1]
+    return name
+
+
+def get_written_tables(sql):
+    """Return the names of the tables written to by the statement *sql*.
+
+    Returns an empty list for statements which do not write to tables and
+    None if it is unknown which tables the statement changes, e.g. for DDL
+    statements.
+    """
+    try:
+        match = _WRITE_RE.match(sql)
+    except TypeError:
+        # E.g. psycopg2's sql.Composed
+        return None
+
+    if match:
+        return [_unquote(match.group(1))]
+
+    match = _TRUNCATE_RE.match(sql)
+    if match and 'CASCADE' in sql.upper():
+        return None
+    elif match:
+        tables = [table.strip() for table in match.group(1).split(',')]
+        return [_unquote(table) for table in tables
+                if _TABLE_RE.match(table)]
+
+    if _READ_ONLY_RE.match(sql):
+        return []
+    return None
+
+
+class DirtyTables(object):
+    """Records the tables which were written to, per test database.
+
+    An instance is registered as SQL observer with the cursor manager of
+    the _django_cursor_wrapper fixture.
+    """
+
+    def __init__(self):
+        # Maps test database names to sets of tables. None instead of a set
+        # means that the whole database has to be reset.
+        self._tables = {}
+
+    def __call__(self, sql, db, params=None, many=False):
+        tables = get_written_tables(sql)
+        if tables == []:
+            return
+
+        key = db.settings_dict['NAME']
+        if tables is None:
+            self._tables[key] = None
+        else:
+            dirty = self._tables.setdefault(key, set())
+            if dirty is not None:
+                dirty.update(tables)
+
+    def pop(self, connection):
+        """Return and forget the tables written to through *connection*.
+
+        Returns None if the whole database has to be reset.
+        """
+        return self._tables.pop(connection.settings_dict['NAME'], set())
+
+
+dirty_tables = DirtyTables()
+
+
+def _emit_post_flush_signal(connection):
+    """Send the signal which the flush command sends after flushing.
+
+    Its receivers re-create e.g. content types and permissions. Before
+    Django 1.9 the flush command also loads the initial_data fixtures.
+    """
+    from django.core.management import call_command
+
+    django_version = get_django_version()
+    if django_version >= (1, 9):
+        from django.core.management.sql import emit_post_migrate_signal
+        emit_post_migrate_signal(verbosity=0, interactive=False,
+                                 db=connection.alias)
+        return
+
+    if django_version >= (1, 7):
+        from django.core.management.sql import emit_post_migrate_signal
+        emit_post_migrate_signal(set(), 0, False, connection.alias)
+    else:
+        from django.core.management.sql import emit_post_sync_signal
+        from django.db.models import get_models
+        emit_post_sync_signal(set(get_models()), 0, False, connection.alias)
+
+    call_command('loaddata', 'initial_data', verbosity=0,
+                 database=connection.alias)
+
+
+def get_django_tables(connection):
+    """Return the existing tables of the models in INSTALLED_APPS."""
+    if get_django_version() >= (1, 8):
+        return connection.introspection.django_table_names(
+            only_existing=True, include_views=False)
+    return connection.introspection.django_table_names(only_existing=True)
+
+
+def _execute(connection, statements, finally_statements=()):
+    cursor = connection.cursor()
+    try:
+        for sql in statements:
+            cursor.execute(sql)
+    finally:
+        for sql in finally_statements:
+            cursor.execute(sql)
+        cursor.close()
+
+    if get_django_version() < (1, 6):
+        from django.db import transaction
+        transaction.commit_unless_managed(using=connection.alias)
+
+
+def _fast_flush_sqlite(connection, tables):
+    qn = connection.ops.quote_name
+    script = ['BEGIN;', 'PRAGMA defer_foreign_keys = ON;']
+    script.extend('DELETE FROM %s;' % qn(table) for table in tables)
+    script.append('COMMIT;')
+
+    # executescript() runs all statements in a single call. It commits a
+    # pending transaction first, so it must not be used in an atomic block.
+    _raw_connection(connection).executescript('\n'.join(script))
+
+
+def _raw_connection(connection):
+    """Return the DB-API connection of *connection*, connecting if needed."""
+    if hasattr(connection, 'ensure_connection'):
+        connection.ensure_connection()
+    else:
+        # Django < 1.6
+        connection._cursor()
+    return connection.connection
+
+
+def fast_flush(connection, tables):
+    """Empty *tables* with as few statements as the backend allows.
+
+    The sequences are reset as well on PostgreSQL. Backends without a fast
+    path use the statements of the flush command.
+    """
+    from django.core.management.color import no_style
+
+    qn = connection.ops.quote_name
+    if connection.vendor == 'postgresql':
+        _execute(connection, [
+            'TRUNCATE %s RESTART IDENTITY CASCADE;'
+            % ', '.join(qn(table) for table in tables)])
+    elif connection.vendor == 'mysql':
+        statements = ['SET FOREIGN_KEY_CHECKS = 0;']
+        statements.extend('TRUNCATE %s;' % qn(table) for table in tables)
+        _execute(connection, statements, ['SET FOREIGN_KEY_CHECKS = 1;'])
+    elif connection.vendor == 'sqlite':
+        _fast_flush_sqlite(connection, tables)
+    else:
+        _execute(connection, connection.ops.sql_flush(no_style(), tables, []))
+
+
+def flush_tables(connection, tables, fast=False):
+    """Empty *tables* like the flush command, but only these tables.
+
+    Tables which are not managed by Django are ignored, like by the flush
+    command. The post_migrate signal is sent afterwards to re-create e.g.
+    content types and permissions. With *fast*, the tables are emptied by
+    :func:`fast_flush`.
+    """
+    from django.core.management.color import no_style
+    from django.db import transaction
+
+    django_tables = get_django_tables(connection)
+    by_lower_name = dict((table.lower(), table) for table in django_tables)
+    tables = sorted(set(by_lower_name[table.lower()] for table in tables
+                        if table.lower() in by_lower_name))
+    if not tables:
+        return
+
+    if fast:
+        fast_flush(connection, tables)
+    else:
+        # Truncating a table referenced by a foreign key fails on
+        # PostgreSQL without CASCADE. The referencing tables are emptied as
+        # well then, like by a full flush.
+        statements = connection.ops.sql_flush(no_style(), tables, [],
+                                              allow_cascade=True)
+        with transaction.atomic(
+                using=connection.alias,
+                savepoint=connection.features.can_rollback_ddl):
+            _execute(connection, statements)
+
+    _emit_post_flush_signal(connection)
+
+
+def flush_database(connection, fast=False):
+    """Empty all tables of the database like the flush command.
+
+    With *fast*, the tables are emptied by :func:`fast_flush`.
+    """
+    if fast:
+        flush_tables(connection, get_django_tables(connection), fast=True)
+    else:
+        _flush_database(connection)
+
+
+def _flush_database(connection):
+    from django.core.management import call_command
+
+    call_command('flush', verbosity=0, interactive=False,
+                 database=connection.alias, reset_sequences=False,
+                 allow_cascade=False, inhibit_post_migrate=False)
+
+
+class SqliteSnapshots(object):
+    """Copies of SQLite test databases, taken after they were set up.
+
+    Restoring a copy is cheaper than flushing, and keeps e.g. content types
+    and permissions as they were. Copies are kept per alias, in memory if
+    the sqlite3 module has the backup API (Python 3.7+) and in temporary
+    files otherwise.
+    """
+
+    _ATTACHED_NAME = 'pytest_django_snapshot'
+
+    def __init__(self):
+        self._snapshots = {}
+
+    def __contains__(self, alias):
+        return alias in self._snapshots
+
+    def take(self, connection):
+        raw_connection = _raw_connection(connection)
+        if hasattr(raw_connection, 'backup'):
+            snapshot = sqlite3.connect(':memory:')
+            copy_sqlite_connection(raw_connection, snapshot)
+        else:
+            fd, snapshot = tempfile.mkstemp(prefix='pytest-django-',
+                                            suffix='.sqlite3')
+            os.close(fd)
+            target = sqlite3.connect(snapshot)
+            try:
+                copy_sqlite_connection(raw_connection, target)
+            finally:
+                target.close()
+
+        self.discard(connection.alias)
+        self._snapshots[connection.alias] = snapshot
+
+    def restore(self, connection):
+        """Restore the copy of the database of *connection*.
+
+        Returns False if there is no copy or it could not be restored, the
+        database has to be reset in another way then.
+        """
+        snapshot = self._snapshots.get(connection.alias)
+        if snapshot is None:
+            return False
+
+        raw_connection = _raw_connection(connection)
+        if isinstance(snapshot, str):
+            return self._restore_attached(raw_connection, snapshot)
+
+        snapshot.backup(raw_connection)
+        return True
+
+    def _restore_attached(self, raw_connection, file_name):
+        # Without the backup API, the rows of every table are copied back
+        # from the attached file. This requires an unchanged schema.
+        name = self._ATTACHED_NAME
+        schema_sql = ("SELECT type, name, sql FROM %s.sqlite_master "
+                      "ORDER BY type, name")
+
+        raw_connection.execute("ATTACH DATABASE ? AS %s" % name,
+                               (file_name,))
+        try:
+            schema = raw_connection.execute(schema_sql % 'main').fetchall()
+            if schema != raw_connection.execute(
+                    schema_sql % name).fetchall():
+                return False
+
+            script = ['BEGIN;', 'PRAGMA defer_foreign_keys = ON;']
+            for table_type, table, sql in schema:
+                if table_type != 'table':
+                    continue
+                table = '"%s"' % table.replace('"', '""')
+                script.append('DELETE FROM main.%s;' % table)
+                script.append('INSERT INTO main.%s SELECT * FROM %s.%s;'
+                              % (table, name, table))
+            script.append('COMMIT;')
+            raw_connection.executescript('\n'.join(script))
+        finally:
+            raw_connection.execute("DETACH DATABASE %s" % name)
+        return True
+
+    def discard(self, alias):
+        snapshot = self._snapshots.pop(alias, None)
+        if isinstance(snapshot, str):
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+        elif snapshot is not None:
+            snapshot.close()
+
+    def clear(self):
+        for alias in list(self._snapshots):
+            self.discard(alias)
+
+
+sqlite_snapshots = SqliteSnapshots()
+
+
+def take_sqlite_snapshots(skip_alias=None):
+    """Take a snapshot of every SQLite test database.
+
+    Test mirrors and aliases for which *skip_alias* returns True are left
+    out.
+    """
+    from django.db import connections
+
+    for connection in connections.all():
+        if (connection.vendor != 'sqlite' or
+                get_test_setting(connection.settings_dict, 'MIRROR') or
+                (skip_alias and skip_alias(connection.alias))):
+            continue
+        sqlite_snapshots.take(connection)
+
+
+_reset_test_cases = {}
+
+
+def get_reset_test_case(dirty_tables_only=False, fast=False,
+                        snapshots=False, pools=False, keep_connections=False):
+    """Return a TransactionTestCase which resets the database faster.
+
+    With *dirty_tables_only*, only the tables recorded by
+    :data:`dirty_tables` are flushed (this requires Django 1.8 or newer).
+    With *fast*, tables are emptied by :func:`fast_flush`. With *snapshots*,
+    SQLite databases are restored from :data:`sqlite_snapshots` instead, if
+    there is a snapshot. With *pools*, the tests run on clean copies from
+    :data:`~pytest_django.db_pool.database_pools`, which are not reset at
+    all. With *keep_connections*, the connections are reset by
+    :data:`~pytest_django.db_connections.persistent_connections` instead
+    of being closed after the test.
+    """
+    key = (dirty_tables_only, fast, snapshots, pools, keep_connections)
+    if key in _reset_test_cases:
+        return _reset_test_cases[key]
+
+    from django.db import DEFAULT_DB_ALIAS, connections
+    from django.test import TransactionTestCase
+
+    class ResetTransactionTestCase(TransactionTestCase):
+        def _pre_setup(self):
+            if pools:
+                database_pools.lease()
+            super(ResetTransactionTestCase, self)._pre_setup()
+
+        def _post_teardown(self):
+            try:
+                super(ResetTransactionTestCase, self)._post_teardown()
+                if keep_connections:
+                    persistent_connections.reset()
+            finally:
+                if pools:
+                    database_pools.release()
+
+        def _should_reload_connections(self):
+            if keep_connections:
+                return False
+            return super(ResetTransactionTestCase,
+                         self)._should_reload_connections()
+
+        def _databases(self):
+            if hasattr(self, '_databases_names'):
+                return self._databases_names(include_mirrors=False)
+            # Django < 1.6
+            if getattr(self, 'multi_db', False):
+                return list(connections)
+            return [DEFAULT_DB_ALIAS]
+
+        def _fixture_teardown(self):
+            if (getattr(self, 'serialized_rollback', False) or
+                    getattr(self, 'available_apps', None) is not None):
+                return super(ResetTransactionTestCase,
+                             self)._fixture_teardown()
+
+            for db_name in self._databases():
+                connection = connections[db_name]
+                if pools and db_name in database_pools:
+                    # The copy is thrown away.
+                    dirty_tables.pop(connection)
+                    continue
+
+                if snapshots and sqlite_snapshots.restore(connection):
+                    dirty_tables.pop(connection)
+                    continue
+
+                if not dirty_tables_only:
+                    flush_database(connection, fast)
+                    continue
+
+                tables = dirty_tables.pop(connection)
+                if tables is None:
+                    flush_database(connection, fast)
+                elif tables:
+                    flush_tables(connection, tables, fast)
+
+                # Forget the writes of the flush itself.
+                dirty_tables.pop(connection)
+
+    _reset_test_cases[key] = ResetTransactionTestCase
+    return ResetTransactionTestCase
@@ -3,28 +3,110 @@
 The code in this module is heavily inspired by django-nose:
 https://github.com/jbalogh/django-nose/
 """
+import hashlib
+import json
 import os.path
 import sys
+import time
 import types
 
+from .cache import FileLock, cache_filename, get_cache_dir
+from .db_clone import (_nodb_connection, _raw_cursor, drop_test_db,
+                       is_in_memory_db)
+from .fingerprint import get_schema_fingerprint, only_migrations_added
+from .lazy_django import get_django_version
 
-def test_database_exists_from_previous_run(connection):
-    # Try to open a cursor to the test database
+
+STAMP_PREFIX = 'pytest-django:'
+
+
+class DatabaseProbe(object):
+    """Checks whether test databases exist without connecting to them.
+
+    The catalog of the database server is queried instead, using one
+    connection to the maintenance database per server which is kept open
+    until :meth:`close` is called. Errors like failed authentication or
+    timeouts are raised instead of being taken for a missing database.
+
+    On PostgreSQL, a stamp (e.g. the digest of the schema fingerprint) can
+    be stored with a test database, as a comment on the database.
+    """
+
+    def __init__(self):
+        self._connections = {}
+
+    def _cursor(self, connection):
+        settings_dict = connection.settings_dict
+        key = (settings_dict['ENGINE'], settings_dict.get('HOST'),
+               settings_dict.get('PORT'), settings_dict.get('USER'))
+        if key not in self._connections:
+            self._connections[key] = _nodb_connection(connection)
+        return _raw_cursor(self._connections[key])
+
+    def probe(self, connection, test_db_name):
+        """Return ``(exists, stamp)`` for the test database *test_db_name*.
+
+        *exists* is None if it cannot be told for the backend of
+        *connection*, *stamp* is None if there is no stamp.
+        """
+        if connection.vendor == 'sqlite':
+            return (not is_in_memory_db(test_db_name) and
+                    os.path.exists(test_db_name)), None
+
+        if connection.vendor == 'postgresql':
+            cursor = self._cursor(connection)
+            cursor.execute("SELECT shobj_description(oid, 'pg_database') "
+                           "FROM pg_database WHERE datname = %s",
+                           [test_db_name])
+            row = cursor.fetchone()
+            if row is None:
+                return False, None
+            comment = row[0] or ''
+            if comment.startswith(STAMP_PREFIX):
+                return True, comment[len(STAMP_PREFIX):]
+            return True, None
+
+        if connection.vendor == 'mysql':
+            cursor = self._cursor(connection)
+            cursor.execute("SELECT 1 FROM information_schema.schemata "
+                           "WHERE schema_name = %s", [test_db_name])
+            return cursor.fetchone() is not None, None
+
+        return None, None
+
+    def set_stamp(self, connection, test_db_name, stamp):
+        """Store *stamp* with the test database, if the backend allows it."""
+        if connection.vendor != 'postgresql':
+            return
+        cursor = self._cursor(connection)
+        cursor.execute('COMMENT ON DATABASE %s IS %%s'
+                       % connection.ops.quote_name(test_db_name),
+                       [STAMP_PREFIX + stamp])
+
+    def close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = {}
+
+
+def test_database_exists_from_previous_run(connection, probe=None):
     test_db_name = connection.creation._get_test_db_name()
 
-    # When using a real SQLite backend (via TEST_NAME), check if the file
-    # exists, because it gets created automatically.
-    if connection.settings_dict['ENGINE'] == 'django.db.backends.sqlite3':
-        if not os.path.exists(test_db_name):
-            return False
+    if probe is None:
+        probe = DatabaseProbe()
+        try:
+            exists, stamp = probe.probe(connection, test_db_name)
+        finally:
+            probe.close()
+    else:
+        exists, stamp = probe.probe(connection, test_db_name)
+    if exists is not None:
+        return exists
 
+    # Other backends: try to open a cursor to the test database.
     orig_db_name = connection.settings_dict['NAME']
     connection.settings_dict['NAME'] = test_db_name
 
-    # With SQLite memory databases the db never exists.
-    if connection.settings_dict['NAME'] == ':memory:':
-        return False
-
     try:
         connection.cursor()
         return True
@@ -70,6 +152,11 @@ def _get_db_name(db_settings, suffix):
     return name
 
 
+def join_db_suffixes(*suffixes):
+    """Combine several test database name suffixes into one."""
+    return '_'.join(suffix for suffix in suffixes if suffix) or None
+
+
 def monkey_patch_creation_for_db_suffix(suffix=None):
     from django.db import connections
 
@@ -116,10 +203,182 @@ def create_test_db_with_reuse(self, verbosity=1, autoclobber=False,
     return test_database_name
 
 
-def monkey_patch_creation_for_db_reuse():
+def monkey_patch_creation_for_db_reuse(probe=None):
     from django.db import connections
 
     for connection in connections.all():
-        if test_database_exists_from_previous_run(connection):
+        if test_database_exists_from_previous_run(connection, probe):
             _monkeypatch(connection.creation, 'create_test_db',
                          create_test_db_with_reuse)
+
+
+def _fingerprint_file(config, test_db_name):
+    return get_cache_dir(config, 'reuse-db').join(
+        cache_filename(test_db_name) + '.json')
+
+
+def get_test_db_fingerprints():
+    """Return (connection, test db name, fingerprint) for all test databases.
+
+    This must be called before the test databases are set up, since it
+    relies on the original database settings.
+    """
+    from django.db import connections
+    from .db_creation import get_test_setting
+
+    fingerprints = []
+    seen = set()
+    for connection in connections.all():
+        if get_test_setting(connection.settings_dict, 'MIRROR'):
+            continue
+
+        test_db_name = connection.creation._get_test_db_name()
+        if test_db_name == ':memory:' or test_db_name in seen:
+            continue
+        seen.add(test_db_name)
+
+        fingerprints.append((connection, test_db_name,
+                             get_schema_fingerprint(connection)))
+    return fingerprints
+
+
+def drop_outdated_test_databases(config, fingerprints, verbosity=1,
+                                 probe=None):
+    """Drop re-used test databases which do not match their fingerprint.
+
+    The dropped databases are then created from scratch by
+    setup_databases(). Databases which only lack new migrations are kept,
+    the missing migrations are applied to them by Django 1.8+.
+
+    The digest of the fingerprint is taken from the stamp of the database,
+    if *probe* finds one, and from the fingerprint recorded in the cache
+    directory otherwise.
+    """
+    if probe is None:
+        probe = DatabaseProbe()
+        try:
+            return drop_outdated_test_databases(config, fingerprints,
+                                                verbosity, probe)
+        finally:
+            probe.close()
+
+    for connection, test_db_name, fingerprint in fingerprints:
+        path = _fingerprint_file(config, test_db_name)
+        stored = None
+        if path.check():
+            try:
+                stored = json.loads(path.read())
+            except ValueError:
+                pass
+
+        exists, stamp = probe.probe(connection, test_db_name)
+        if exists is None:
+            exists = test_database_exists_from_previous_run(connection, probe)
+        if not exists:
+            continue
+
+        if stamp is None:
+            digest = stored and stored.get('digest')
+        else:
+            digest = stamp
+            if stored and stored.get('digest') != stamp:
+                # The database was set up by another checkout or machine.
+                stored = None
+        if digest == fingerprint['digest']:
+            continue
+
+        if (stored and get_django_version() >= (1, 8) and
+                only_migrations_added(stored, fingerprint)):
+            if verbosity >= 1:
+                print("Applying new migrations to the test database for "
+                      "alias '%s'..." % connection.alias)
+            continue
+
+        if verbosity >= 1:
+            print("Test database for alias '%s' is out of date, "
+                  "re-creating it..." % connection.alias)
+        connection.creation._destroy_test_db(test_db_name, verbosity)
+
+
+def save_test_db_fingerprints(config, fingerprints, probe=None):
+    """Record the fingerprints of the test databases which were set up.
+
+    With *probe*, the digests are also stored as stamps with the databases
+    which exist (e.g. not the ones which are created lazily).
+    """
+    for connection, test_db_name, fingerprint in fingerprints:
+        _fingerprint_file(config, test_db_name).write(json.dumps(fingerprint))
+        if probe is None or not probe.probe(connection, test_db_name)[0]:
+            continue
+        try:
+            probe.set_stamp(connection, test_db_name, fingerprint['digest'])
+        except Exception:
+            # E.g. the user does not own the database. The fingerprint file
+            # is used then.
+            pass
+
+
+def get_schema_slot(skipped_data_migrations=None):
+    """Return a short identifier for the schema of all test databases.
+
+    It is used as part of the test database names so that a test database
+    can be kept for every schema which is used, e.g. on different branches.
+    The slot is determined before the data migration skipper is installed,
+    so the patterns of the skipped data migrations are passed explicitly.
+    """
+    from django.db import connections
+
+    digests = [get_schema_fingerprint(connections[alias],
+                                      skipped_data_migrations)['digest']
+               for alias in sorted(connections)]
+    return hashlib.sha1(''.join(digests).encode('utf-8')).hexdigest()[:8]
+
+
+def record_schema_slot(config, slot, max_slots, verbosity=1,
+                       test_db_names=None):
+    """Mark *slot* as used and drop the least recently used other slots.
+
+    The test databases of up to *max_slots* slots are kept. *test_db_names*
+    maps aliases to their test database names where these are not yet set
+    in the settings, e.g. for databases which are created lazily.
+    """
+    from django.db import connections
+    from .db_creation import get_test_setting
+
+    cache_dir = get_cache_dir(config)
+    slots_file = cache_dir.join('db-slots.json')
+
+    with FileLock(cache_dir.join('db-slots.lock')):
+        slots = {}
+        if slots_file.check():
+            try:
+                slots = json.loads(slots_file.read())
+            except ValueError:
+                pass
+
+        entry = slots.setdefault(slot, {'databases': []})
+        entry['last_used'] = time.time()
+        for alias in sorted(connections):
+            connection = connections[alias]
+            database = [alias, (test_db_names or {}).get(
+                alias, connection.settings_dict['NAME'])]
+            if (not get_test_setting(connection.settings_dict, 'MIRROR') and
+                    database not in entry['databases']):
+                entry['databases'].append(database)
+
+        by_age = sorted(slots, key=lambda s: slots[s]['last_used'],
+                        reverse=True)
+        for old_slot in by_age[max_slots:]:
+            for alias, test_db_name in slots.pop(old_slot)['databases']:
+                if alias not in connections:
+                    continue
+                if verbosity >= 1:
+                    print("Dropping least recently used test database "
+                          "'%s'..." % test_db_name)
+                drop_test_db(connections[alias], test_db_name)
+
+                fingerprint_file = _fingerprint_file(config, test_db_name)
+                if fingerprint_file.check():
+                    fingerprint_file.remove()
+
+        slots_file.write(json.dumps(slots))
@@ -0,0 +1,112 @@
+"""Serializing the test database contents only for tests which need them.
+
+Django 1.7+ serializes the whole contents of every test database after it
+has been set up, so that TransactionTestCase can restore them after flushing
+when ``serialized_rollback`` is used. pytest-django skips this unless one of
+the selected tests asks for a serialized rollback. With --reuse-db, the
+serialized contents are cached in the pytest cache directory, along with
+the schema fingerprint of the database.
+"""
+
+from __future__ import with_statement
+
+import os
+
+from .cache import cache_filename, get_cache_dir
+from .lazy_django import get_django_version
+
+
+def _will_serialize(connection):
+    from .db_creation import get_test_setting
+
+    return (get_django_version() >= (1, 7) and
+            get_test_setting(connection.settings_dict, 'SERIALIZE', True))
+
+
+def _set_serialize(connection, serialize):
+    """Change the SERIALIZE test setting, returning the old TEST settings."""
+    test_settings = connection.settings_dict.get('TEST')
+    connection.settings_dict['TEST'] = dict(test_settings or {},
+                                            SERIALIZE=serialize)
+    return test_settings
+
+
+def disable_test_db_serialization():
+    """Do not serialize the contents of the test databases.
+
+    Returns a list to be passed to :func:`restore_test_db_serialization`
+    once the test databases are set up.
+    """
+    from django.db import connections
+
+    disabled = []
+    for connection in connections.all():
+        if _will_serialize(connection):
+            disabled.append((connection, _set_serialize(connection, False)))
+    return disabled
+
+
+def restore_test_db_serialization(disabled):
+    """Restore the test settings changed by :func:`use_cached_contents` or
+    :func:`disable_test_db_serialization`."""
+    for connection, test_settings in disabled:
+        if test_settings is None:
+            connection.settings_dict.pop('TEST', None)
+        else:
+            connection.settings_dict['TEST'] = test_settings
+
+
+def _cache_file(config, test_db_name, digest):
+    return get_cache_dir(config, 'serialized-db').join(
+        '%s-%s.json' % (cache_filename(test_db_name), digest))
+
+
+def use_cached_contents(config, fingerprints):
+    """Skip serializing re-used test databases with cached contents.
+
+    *fingerprints* are the ones of :func:`get_test_db_fingerprints`. Returns
+    the ones with cached contents, to be passed to
+    :func:`restore_cached_contents` once the databases are set up.
+    """
+    cached = []
+    for connection, test_db_name, fingerprint in fingerprints:
+        if (_will_serialize(connection) and
+                _cache_file(config, test_db_name,
+                            fingerprint['digest']).check()):
+            cached.append((connection, test_db_name, fingerprint,
+                           _set_serialize(connection, False)))
+    return cached
+
+
+def restore_cached_contents(config, fingerprints, cached):
+    """Set the cached contents and cache the newly serialized ones.
+
+    This is called after the test databases of *fingerprints* have been set
+    up. *cached* is the result of :func:`use_cached_contents`.
+    """
+    restore_test_db_serialization(
+        [(connection, test_settings)
+         for connection, name, fingerprint, test_settings in cached])
+    cached_names = [name for connection, name, fingerprint, test_settings
+                    in cached]
+
+    for connection, test_db_name, fingerprint in fingerprints:
+        path = _cache_file(config, test_db_name, fingerprint['digest'])
+        if test_db_name in cached_names:
+            connection._test_serialized_contents = path.read_text('utf-8')
+            continue
+
+        contents = getattr(connection, '_test_serialized_contents', None)
+        if contents is None:
+            continue
+
+        # Contents for older schemas of the database are no longer needed.
+        for old_path in path.dirpath().listdir(
+                '%s-*.json' % cache_filename(test_db_name)):
+            old_path.remove()
+
+        # Write to a temporary file first, it is read by other test runs.
+        tmp_path = path.new(basename='%s.%d.tmp' % (path.basename,
+                                                    os.getpid()))
+        tmp_path.write_text(contents, 'utf-8')
+        tmp_path.rename(path)
@@ -0,0 +1,277 @@
+"""Dropping test databases after the test session, in the background.
+
+The test databases which are set up without --reuse-db are recorded in a
+ledger in the pytest cache directory. With --async-teardown, the databases
+are only marked to be dropped at the end of the test session, and they are
+dropped by a detached process started by the process which reports the test
+results (the xdist controller, if xdist is used). The ledger also lists the
+databases of test runs which crashed before they could drop them.
+
+The dropping process is started as ``python -m pytest_django.db_teardown``.
+"""
+
+from __future__ import with_statement
+
+import contextlib
+import errno
+import json
+import os
+import subprocess
+import sys
+import time
+
+import py
+
+from .cache import FileLock, get_cache_dir
+from .db_clone import drop_test_db, is_in_memory_db
+
+IN_USE = 'in use'
+TO_DROP = 'drop'
+
+SETTINGS_MODULE_ENV = 'DJANGO_SETTINGS_MODULE'
+CONFIGURATION_ENV = 'DJANGO_CONFIGURATION'
+
+# How often the dropping process tries to drop a database, e.g. while the
+# test process is still connected to it.
+DROP_ATTEMPTS = 5
+
+
+class DropLedger(object):
+    """The test databases which were set up and have not been dropped yet.
+
+    Every entry is a dict with the alias, the test database name, the
+    settings module used to set it up, the id of the process which set it up
+    and its state: :data:`IN_USE` or :data:`TO_DROP`.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._path = cache_dir.join('drop-ledger.json')
+        self._lock = FileLock(cache_dir.join('drop-ledger.lock'))
+
+    def _read(self):
+        if not self._path.check():
+            return []
+        try:
+            return json.loads(self._path.read())
+        except ValueError:
+            return []
+
+    @contextlib.contextmanager
+    def entries(self):
+        """Lock the ledger and yield its entries, which can be changed."""
+        with self._lock:
+            entries = self._read()
+            yield entries
+            self._path.write(json.dumps(entries))
+
+    def has_entries(self, state):
+        with self.entries() as entries:
+            return any(entry['state'] == state for entry in entries)
+
+
+def get_ledger(config):
+    return DropLedger(get_cache_dir(config))
+
+
+def _get_test_databases(skip_alias=None):
+    """Return (alias, test database name) for the current test databases.
+
+    This must be called after the test databases have been set up. The names
+    of SQLite databases are made absolute, so they can be dropped from any
+    directory.
+    """
+    from django.db import connections
+    from .db_creation import get_test_setting
+
+    databases = []
+    seen = set()
+    for connection in connections.all():
+        name = connection.settings_dict['NAME']
+        if (get_test_setting(connection.settings_dict, 'MIRROR') or
+                (skip_alias and skip_alias(connection.alias))):
+            continue
+        if connection.vendor == 'sqlite':
+            if is_in_memory_db(name):
+                continue
+            name = os.path.abspath(name)
+
+        key = (connection.settings_dict['ENGINE'],
+               connection.settings_dict.get('HOST'),
+               connection.settings_dict.get('PORT'), name)
+        if key not in seen:
+            seen.add(key)
+            databases.append((connection.alias, name))
+    return databases
+
+
+def _same_database(entry, name):
+    return entry['name'] in (name, os.path.abspath(name))
+
+
+def cancel_drops(config):
+    """Forget about the test databases which are about to be set up.
+
+    They are created again (or re-used), so they must not be dropped by a
+    dropping process which is still running.
+    """
+    from django.db import connections
+
+    names = [connection.creation._get_test_db_name()
+             for connection in connections.all()]
+    with get_ledger(config).entries() as entries:
+        entries[:] = [entry for entry in entries
+                      if not any(_same_database(entry, name)
+                                 for name in names)]
+
+
+def _set_state(config, state, skip_alias=None):
+    databases = _get_test_databases(skip_alias)
+    with get_ledger(config).entries() as entries:
+        entries[:] = [entry for entry in entries
+                      if not any(_same_database(entry, name)
+                                 for alias, name in databases)]
+        for alias, name in databases:
+            entries.append({
+                'alias': alias,
+                'name': name,
+                'settings_module': os.environ.get(SETTINGS_MODULE_ENV),
+                'pid': os.getpid(),
+                'state': state,
+            })
+
+
+def record_test_databases(config, skip_alias=None):
+    """Add the test databases which have been set up to the ledger."""
+    _set_state(config, IN_USE, skip_alias)
+
+
+def mark_for_drop(config, skip_alias=None):
+    """Mark the test databases to be dropped by the dropping process."""
+    from django.db import connections
+
+    _set_state(config, TO_DROP, skip_alias)
+    # PostgreSQL cannot drop databases which are in use.
+    for connection in connections.all():
+        connection.close()
+
+
+def forget_test_databases(config, skip_alias=None):
+    """Remove the test databases from the ledger, once they are dropped."""
+    databases = _get_test_databases(skip_alias)
+    with get_ledger(config).entries() as entries:
+        entries[:] = [entry for entry in entries
+                      if not any(_same_database(entry, name)
+                                 for alias, name in databases)]
+
+
+def _is_running(pid):
+    if sys.platform == 'win32':
+        # os.kill() would terminate the process.
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def mark_leftovers_for_drop(config):
+    """Mark the databases of crashed test runs to be dropped.
+
+    Returns the number of databases which were marked.
+    """
+    marked = 0
+    with get_ledger(config).entries() as entries:
+        for entry in entries:
+            if entry['state'] == IN_USE and not _is_running(entry['pid']):
+                entry['state'] = TO_DROP
+                marked += 1
+    return marked
+
+
+def can_drop_in_background():
+    """Whether a dropping process can set up the same Django settings."""
+    return bool(os.environ.get(SETTINGS_MODULE_ENV))
+
+
+def start_dropping_process(config):
+    """Start a detached process which drops the marked databases."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+
+    kwargs = {}
+    if sys.platform == 'win32':
+        # DETACHED_PROCESS
+        kwargs['creationflags'] = 0x00000008
+    else:
+        kwargs['preexec_fn'] = os.setsid
+        kwargs['close_fds'] = True
+
+    devnull = open(os.devnull, 'r+b')
+    try:
+        subprocess.Popen(
+            [sys.executable, '-m', 'pytest_django.db_teardown',
+             str(get_cache_dir(config))],
+            stdin=devnull, stdout=devnull, stderr=devnull, env=env, **kwargs)
+    finally:
+        devnull.close()
+
+
+def drop_marked_databases(ledger, settings_module):
+    """Drop the databases marked in *ledger* which use *settings_module*.
+
+    Django must be set up with these settings. Databases which cannot be
+    dropped are tried again a few times, e.g. while the test process still
+    has a connection to them. Databases whose alias is not in the settings
+    (any longer) are kept in the ledger, since they cannot be dropped
+    without its connection settings.
+    """
+    from django.db import connections
+
+    failed = {}
+    unknown = set()
+    while True:
+        with ledger.entries() as entries:
+            candidates = [entry for entry in entries
+                          if entry['state'] == TO_DROP and
+                          entry['settings_module'] == settings_module and
+                          entry['name'] not in unknown and
+                          failed.get(entry['name'], 0) < DROP_ATTEMPTS]
+            if not candidates:
+                return
+
+            entry = candidates[0]
+            if entry['alias'] not in connections:
+                unknown.add(entry['name'])
+                continue
+
+            try:
+                drop_test_db(connections[entry['alias']], entry['name'])
+            except Exception:
+                failed[entry['name']] = failed.get(entry['name'], 0) + 1
+                entry = None
+            if entry is not None:
+                entries.remove(entry)
+
+        if entry is None:
+            time.sleep(1)
+
+
+def main(args):
+    """Drop the marked databases of the cache directory ``args[0]``."""
+    settings_module = os.environ.get(SETTINGS_MODULE_ENV)
+    if os.environ.get(CONFIGURATION_ENV):
+        import configurations.importer
+        configurations.importer.install()
+
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    drop_marked_databases(DropLedger(py.path.local(args[0])),
+                          settings_module)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,198 @@
+"""Fingerprints which describe the schema of a test database.
+
+A fingerprint changes whenever something that influences the schema of a
+freshly created test database changes: the migration files, the installed
+apps, the models of apps without migrations and the database settings.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+from .lazy_django import get_django_version
+from .migrations import data_migration_skipper
+from .partial_schema import partial_schema
+
+FINGERPRINT_VERSION = 1
+
+# The digests of the migration files read during the test session, by path,
+# as (modification time, digest) tuples.
+_file_digests = {}
+
+
+def _sha1(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def _get_app_labels():
+    """Return (label, app module name) for all installed apps."""
+    if get_django_version() >= (1, 7):
+        from django.apps import apps
+        return [(app_config.label, app_config.name)
+                for app_config in apps.get_app_configs()]
+
+    from django.conf import settings
+    return [(app.rsplit('.', 1)[-1], app) for app in settings.INSTALLED_APPS]
+
+
+def _get_migrations_module_name(label, app_name):
+    from django.conf import settings
+
+    if get_django_version() >= (1, 7):
+        from django.db.migrations.loader import MigrationLoader
+        module_name = MigrationLoader.migrations_module(label)
+        if isinstance(module_name, tuple):
+            # Django 1.11+ returns (module_name, explicit).
+            module_name = module_name[0]
+        return module_name
+
+    # South
+    south_modules = getattr(settings, 'SOUTH_MIGRATION_MODULES', {})
+    return south_modules.get(label, app_name + '.migrations')
+
+
+def _get_file_digest(path):
+    """Return the sha1 of the file *path*, reading it again only if it was
+    modified since it was last read."""
+    mtime = os.path.getmtime(path)
+    cached = _file_digests.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        digest = _sha1(f.read())
+    _file_digests[path] = (mtime, digest)
+    return digest
+
+
+def get_migration_files():
+    """Return a dict of {app label: {file name: sha1}} for all migrations.
+
+    Apps without migrations are not contained in the result. The migration
+    files are only read once per test session, unless they are modified.
+    """
+    result = {}
+    for label, app_name in _get_app_labels():
+        module_name = _get_migrations_module_name(label, app_name)
+        if not module_name:
+            continue
+
+        try:
+            __import__(module_name)
+        except ImportError:
+            continue
+
+        module_file = getattr(sys.modules[module_name], '__file__', None)
+        if not module_file:
+            continue
+
+        directory = os.path.dirname(module_file)
+        files = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py') and name != '__init__.py':
+                files[name] = _get_file_digest(os.path.join(directory, name))
+
+        if files:
+            result[label] = files
+
+    return result
+
+
+def _get_models():
+    if get_django_version() >= (1, 7):
+        from django.apps import apps
+        return apps.get_models(include_auto_created=True)
+
+    from django.db.models import get_models
+    return get_models(include_auto_created=True)
+
+
+def get_models_fingerprint(connection, app_labels=None):
+    """Return a hash of the tables and columns of the models in *app_labels*.
+
+    All models are used when *app_labels* is None.
+    """
+    tables = []
+    for model in _get_models():
+        opts = model._meta
+        if app_labels is not None and opts.app_label not in app_labels:
+            continue
+
+        columns = []
+        for field in opts.local_fields:
+            try:
+                db_type = field.db_type(connection=connection)
+            except Exception:
+                db_type = None
+            columns.append([field.column, field.__class__.__name__,
+                            db_type, field.null])
+        tables.append([opts.db_table, columns])
+
+    return _sha1(json.dumps(sorted(tables)))
+
+
+def get_settings_fingerprint(settings_dict):
+    """Return a hash of the settings which describe the database."""
+    keys = ('ENGINE', 'NAME', 'HOST', 'PORT', 'USER', 'OPTIONS', 'TEST',
+            'TEST_NAME', 'TEST_CHARSET', 'TEST_COLLATION')
+    relevant = [(key, repr(settings_dict.get(key))) for key in keys]
+    return _sha1(json.dumps(relevant))
+
+
+def get_schema_fingerprint(connection, skipped_data_migrations=None):
+    """Return the fingerprint of the test database of *connection*.
+
+    The fingerprint is a JSON serializable dict, its ``digest`` item
+    summarizes all the other items. *skipped_data_migrations* are the
+    patterns of the data migrations which are skipped, by default the ones
+    of the data migration skipper.
+    """
+    from django.conf import settings
+
+    if skipped_data_migrations is None:
+        skipped_data_migrations = data_migration_skipper.patterns
+
+    migrations = get_migration_files()
+    unmigrated = set(label for label, _ in _get_app_labels()
+                     if label not in migrations)
+
+    fingerprint = {
+        'version': FINGERPRINT_VERSION,
+        'settings': get_settings_fingerprint(connection.settings_dict),
+        'installed_apps': list(settings.INSTALLED_APPS),
+        'unmigrated_models': get_models_fingerprint(connection, unmigrated),
+        'migrations': migrations,
+    }
+    if skipped_data_migrations:
+        # The data of skipped migrations is missing.
+        fingerprint['skipped_data_migrations'] = sorted(
+            skipped_data_migrations)
+    if partial_schema.models:
+        # Only the tables of these models exist.
+        fingerprint['partial_schema'] = partial_schema.get_model_labels()
+    fingerprint['digest'] = _sha1(json.dumps(fingerprint, sort_keys=True))
+    return fingerprint
+
+
+def only_migrations_added(old, new):
+    """Whether *new* only differs from *old* by additional migrations.
+
+    In that case the test database can be brought up to date by applying
+    the missing migrations.
+    """
+    for key in ('version', 'settings', 'installed_apps', 'unmigrated_models',
+                'skipped_data_migrations', 'partial_schema'):
+        if old.get(key) != new.get(key):
+            return False
+
+    old_migrations = old.get('migrations', {})
+    new_migrations = new.get('migrations', {})
+    for label, files in old_migrations.items():
+        new_files = new_migrations.get(label, {})
+        for name, digest in files.items():
+            if new_files.get(name) != digest:
+                return False
+    return True
@@ -8,12 +8,41 @@ import warnings
 import pytest
 
 from . import live_server_helper
-from .db_reuse import (monkey_patch_creation_for_db_reuse,
-                       monkey_patch_creation_for_db_suffix)
+from .cache import get_cache_dir
+from .cached_fixtures import cached_fixture_stats
+from .db_clone import can_clone_test_db
+from .db_connections import persistent_connections
+from .db_creation import (TEMPLATE_SUFFIX, BackgroundDatabaseSetup,
+                          can_setup_concurrently, can_use_worker_schemas,
+                          get_unique_databases_and_mirrors,
+                          load_sqlite_databases_into_memory,
+                          report_shared_test_databases,
+                          restore_sqlite_file_databases,
+                          setup_databases_from_template,
+                          setup_databases_with_reuse,
+                          setup_worker_schemas, teardown_cloned_databases,
+                          teardown_test_databases, teardown_worker_schemas,
+                          unused_aliases)
+from .db_fixtures import fixture_stats, load_fixtures, shared_fixtures
+from .db_pool import create_database_pools, database_pools
+from .db_reset import (dirty_tables, flush_database, get_reset_test_case,
+                       sqlite_snapshots, take_sqlite_snapshots)
+from .db_reuse import (get_schema_slot, join_db_suffixes,
+                       monkey_patch_creation_for_db_suffix,
+                       record_schema_slot)
+from .db_serialize import (disable_test_db_serialization,
+                           restore_test_db_serialization)
+from .db_teardown import (can_drop_in_background, cancel_drops,
+                          forget_test_databases, mark_for_drop,
+                          record_test_databases)
 from .django_compat import is_django_unittest
 from .lazy_django import get_django_version, skip_if_no_django
+from .migrations import data_migration_skipper
+from .partial_schema import partial_schema
+from .schema_cache import cached_schema
 
-__all__ = ['_django_db_setup', 'db', 'transactional_db', 'admin_user',
+__all__ = ['_django_db_setup', 'db', 'transactional_db', 'module_db',
+           'class_db', 'admin_user',
            'django_user_model', 'django_username_field',
            'client', 'admin_client', 'rf', 'settings', 'live_server',
            '_live_server_helper']
@@ -28,40 +57,300 @@ def _django_db_setup(request,
     """Session-wide database setup, internal to pytest-django"""
     skip_if_no_django()
 
-    from .compat import setup_databases, teardown_databases
+    background_setup = get_background_db_setup(request.config)
+    if background_setup is not None:
+        for finalizer in background_setup.claim():
+            request.addfinalizer(finalizer)
+    else:
+        _hide_unused_aliases(request.config, request.addfinalizer)
+        _setup_databases(request.config, _django_cursor_wrapper,
+                         request.addfinalizer)
+
+    request.addfinalizer(fixture_stats.add_to_report)
+    request.addfinalizer(cached_fixture_stats.add_to_report)
+    # Usually done after the last test sharing fixtures, see
+    # pytest_runtest_teardown().
+    request.addfinalizer(shared_fixtures.exit)
+
+    if _use_persistent_connections(request.config):
+        # In the thread which runs the tests, not in a background setup.
+        persistent_connections.install()
+        request.addfinalizer(persistent_connections.uninstall)
+
+
+def _hide_unused_aliases(config, addfinalizer):
+    """Remove the aliases of the django_unused_databases ini setting for the
+    test session.
+
+    This has to happen before the connections are handed over to a
+    background setup.
+    """
+    aliases = config.getini('django_unused_databases')
+    if aliases:
+        unused_aliases.install(aliases)
+        addfinalizer(unused_aliases.uninstall)
+
+
+def _setup_databases(config, _django_cursor_wrapper, addfinalizer):
+    """Set up the test databases according to the command line options.
+
+    *addfinalizer* is called with the functions which have to be called at
+    the end of the test session, in reverse order.
+    """
+    from .compat import teardown_databases
 
     # xdist
-    if hasattr(request.config, 'slaveinput'):
-        db_suffix = request.config.slaveinput['slaveid']
+    if hasattr(config, 'slaveinput'):
+        xdist_suffix = config.slaveinput['slaveid']
     else:
-        db_suffix = None
-
-    monkey_patch_creation_for_db_suffix(db_suffix)
+        xdist_suffix = None
 
     _handle_south()
 
-    if request.config.getvalue('nomigrations'):
+    # None unless the test databases are set up with migrations.
+    skip_data_migrations = None
+    if config.getvalue('nomigrations'):
         _disable_native_migrations()
+        schema_apps = getattr(config, '_django_schema_apps', None)
+        if schema_apps and get_django_version() >= (1, 8):
+            partial_schema.install(schema_apps)
+            addfinalizer(partial_schema.uninstall)
+    elif get_django_version() >= (1, 7):
+        skip_data_migrations = config.getini('django_skip_data_migrations')
+
+    verbosity = pytest.config.option.verbose
+    max_db_slots = config.getvalue('db_slots')
+    setup_workers = config.getvalue('db_setup_workers')
 
-    db_args = {}
     with _django_cursor_wrapper:
-        if (request.config.getvalue('reuse_db') and
-                not request.config.getvalue('create_db')):
-            if get_django_version() >= (1, 8):
-                db_args['keepdb'] = True
-            else:
-                monkey_patch_creation_for_db_reuse()
-
-        # Create the database
-        db_cfg = setup_databases(verbosity=pytest.config.option.verbose,
-                                 interactive=False, **db_args)
-
-    def teardown_database():
-        with _django_cursor_wrapper:
-            teardown_databases(db_cfg)
+        if setup_workers > 1 and not can_setup_concurrently():
+            setup_workers = 1
+
+        if max_db_slots and config.getvalue('reuse_db'):
+            db_slot = get_schema_slot(skip_data_migrations)
+        else:
+            db_slot = None
+
+        use_worker_schemas = xdist_suffix and _use_worker_schemas(config)
+        if use_worker_schemas:
+            # The workers share the test databases.
+            db_suffix = db_slot
+        else:
+            db_suffix = join_db_suffixes(db_slot, xdist_suffix)
+        monkey_patch_creation_for_db_suffix(db_suffix)
+        if _use_drop_ledger(config):
+            cancel_drops(config)
+
+        if _needs_serialized_contents(config):
+            serialization_disabled = []
+        else:
+            serialization_disabled = disable_test_db_serialization()
+
+        report_shared_test_databases()
+
+        if config.getvalue('sqlite_memory'):
+            sqlite_databases = get_unique_databases_and_mirrors()
+        else:
+            sqlite_databases = None
+
+        # The names of test databases which are created later on.
+        test_db_names = None
+        # Aliases of which no snapshot can be taken yet.
+        is_pending = None
+
+        with data_migration_skipper.skipping(skip_data_migrations,
+                                             get_cache_dir(config)):
+            with cached_schema(config, _django_cursor_wrapper,
+                               verbosity):
+                if use_worker_schemas:
+                    db_cfg = setup_worker_schemas(config, db_suffix,
+                                                  verbosity, setup_workers)
+
+                    def teardown_database():
+                        with _django_cursor_wrapper:
+                            teardown_worker_schemas(config, db_cfg,
+                                                    verbosity)
+                elif xdist_suffix and _use_db_template(config):
+                    db_cfg = setup_databases_from_template(
+                        config, db_suffix, verbosity,
+                        join_db_suffixes(db_slot, TEMPLATE_SUFFIX),
+                        setup_workers)
+
+                    def teardown_database():
+                        with _django_cursor_wrapper:
+                            teardown_cloned_databases(db_cfg, verbosity)
+                elif config.getvalue('lazy_db'):
+                    db_cfg = setup_databases_with_reuse(config, verbosity,
+                                                        lazy=True)
+                    test_db_names = db_cfg.test_db_names
+                    is_pending = db_cfg.is_pending
+                    addfinalizer(db_cfg.uninstall)
+
+                    def teardown_database():
+                        with _django_cursor_wrapper:
+                            teardown_cloned_databases(db_cfg.old_names,
+                                                      verbosity)
+
+                    if sqlite_databases:
+                        # Databases created later on stay on disk.
+                        sqlite_databases = (
+                            [(db_name, aliases)
+                             for db_name, aliases in sqlite_databases[0]
+                             if not db_cfg.is_pending(aliases[0])],
+                            sqlite_databases[1])
+                elif setup_workers > 1:
+                    db_cfg = setup_databases_with_reuse(config, verbosity,
+                                                        setup_workers)
+
+                    def teardown_database():
+                        with _django_cursor_wrapper:
+                            teardown_test_databases(db_cfg, verbosity,
+                                                    setup_workers)
+                else:
+                    # Create the database
+                    db_cfg = setup_databases_with_reuse(config, verbosity)
+
+                    def teardown_database():
+                        with _django_cursor_wrapper:
+                            teardown_databases(db_cfg)
+
+        restore_test_db_serialization(serialization_disabled)
+
+        if db_slot:
+            record_schema_slot(config, db_slot, max_db_slots,
+                               verbosity, test_db_names)
+
+        if not config.getvalue('reuse_db') and _use_drop_ledger(config):
+            record_test_databases(config, is_pending)
+
+        if sqlite_databases:
+            sqlite_files = load_sqlite_databases_into_memory(
+                sqlite_databases[0], sqlite_databases[1], verbosity)
+        else:
+            sqlite_files = []
+
+        if _use_sqlite_snapshots(config):
+            take_sqlite_snapshots(is_pending)
+
+        if _use_db_pools(config):
+            create_database_pools(config.getvalue('db_pool'), verbosity,
+                                  is_pending)
+
+    if not config.getvalue('reuse_db'):
+        if _use_async_teardown(config):
+            addfinalizer(lambda: mark_for_drop(config, is_pending))
+        else:
+            if _use_drop_ledger(config):
+                addfinalizer(
+                    lambda: forget_test_databases(config, is_pending))
+            addfinalizer(teardown_database)
+
+    if sqlite_files:
+        # Finalizers run in reverse order: switch back to the database files
+        # before they are destroyed.
+        addfinalizer(
+            lambda: restore_sqlite_file_databases(sqlite_files))
+
+    if _track_dirty_tables(config):
+        _django_cursor_wrapper.add_observer(dirty_tables)
+        addfinalizer(
+            lambda: _django_cursor_wrapper.remove_observer(dirty_tables))
+
+    if _use_sqlite_snapshots(config):
+        addfinalizer(sqlite_snapshots.clear)
+
+    if _use_db_pools(config):
+        # Before the test databases are destroyed.
+        addfinalizer(database_pools.close)
+
+
+def start_background_db_setup(config, cursor_manager):
+    """Start setting up the test databases in a background thread.
+
+    The _django_db_setup fixture then waits for it instead of setting up
+    the databases itself.
+    """
+    finalizers = []
+    _hide_unused_aliases(config, finalizers.append)
+
+    def setup():
+        _setup_databases(config, cursor_manager, finalizers.append)
+        return finalizers
+
+    background_setup = BackgroundDatabaseSetup(setup)
+    background_setup.cursor_manager = cursor_manager
+    config._django_background_db_setup = background_setup
+    background_setup.start()
+
+
+def get_background_db_setup(config):
+    return getattr(config, '_django_background_db_setup', None)
+
+
+def finish_background_db_setup(config):
+    """Tear down the databases set up in the background if no test did."""
+    background_setup = get_background_db_setup(config)
+    if background_setup is None or background_setup.is_claimed():
+        return
+
+    try:
+        finalizers = background_setup.claim()
+    except Exception:
+        # The setup failed and no test needed it.
+        return
+    for finalizer in reversed(finalizers):
+        finalizer()
+
+
+def _track_dirty_tables(config):
+    return (config.getvalue('track_dirty_tables') and
+            get_django_version() >= (1, 8))
+
+
+def _use_sqlite_snapshots(config):
+    return (config.getvalue('sqlite_snapshot') and
+            get_django_version() >= (1, 5))
 
-    if not request.config.getvalue('reuse_db'):
-        request.addfinalizer(teardown_database)
+
+def _use_async_teardown(config):
+    return config.getvalue('async_teardown') and can_drop_in_background()
+
+
+def _use_drop_ledger(config):
+    """Whether the test databases are recorded in the drop ledger."""
+    return (config.getvalue('async_teardown') or
+            config.getvalue('drop_leftover_dbs'))
+
+
+def _use_db_pools(config):
+    return config.getvalue('db_pool') > 0 and get_django_version() >= (1, 5)
+
+
+def _needs_serialized_contents(config):
+    # Unknown while the tests are collected, e.g. with --db-background-setup.
+    return getattr(config, '_django_serialized_rollback', True)
+
+
+def _use_persistent_connections(config):
+    return (config.getvalue('keep_db_connections') and
+            get_django_version() >= (1, 6))
+
+
+def _use_worker_schemas(config):
+    return config.getvalue('pg_worker_schemas') and can_use_worker_schemas()
+
+
+def _use_db_template(config):
+    """Whether the xdist worker databases should be cloned from a template."""
+    from django.db import connections
+
+    if not config.getvalue('db_template'):
+        return False
+
+    for connection in connections.all():
+        if not can_clone_test_db(connection):
+            return False
+    return True
 
 
 def _django_db_fixture_helper(transactional, request, _django_cursor_wrapper):
@@ -72,15 +361,49 @@ def _django_db_fixture_helper(transactional, request, _django_cursor_wrapper):
         # Do nothing, we get called with transactional=True, too.
         return
 
+    scope_names = [name for name in ('module_db', 'class_db')
+                   if name in request.funcargnames]
+    scope_names.extend(name for name, atomic in _outer_atomics)
+    if transactional and scope_names:
+        pytest.fail('transactional_db cannot be used together with %s, '
+                    'the database is flushed after the test.'
+                    % scope_names[0])
+    elif scope_names:
+        # pytest does not necessarily set up higher scoped fixtures first,
+        # but their database changes must not end up in the savepoint of
+        # the test.
+        for argname in request.funcargnames:
+            fixturedefs = request._arg2fixturedefs.get(argname)
+            if fixturedefs and fixturedefs[-1].scope != 'function':
+                request.getfuncargvalue(argname)
+
     django_case = None
+    marker = request.keywords.get('django_db', None)
 
     _django_cursor_wrapper.enable()
-    request.addfinalizer(_django_cursor_wrapper.disable)
+    request.addfinalizer(_django_cursor_wrapper.restore)
+    partial_schema.observe(request, _django_cursor_wrapper)
 
     if transactional:
         from django import get_version
 
-        if get_version() >= '1.5':
+        fast_flush = request.config.getvalue('fast_flush')
+        track_dirty_tables = _track_dirty_tables(request.config)
+        snapshots = _use_sqlite_snapshots(request.config)
+        # The connections of the live server thread cannot be switched to
+        # another database, so its tests use the test database itself.
+        pools = (bool(database_pools) and
+                 'live_server' not in request.funcargnames)
+        keep_connections = bool(persistent_connections)
+
+        if get_version() >= '1.5' and (fast_flush or track_dirty_tables or
+                                       snapshots or pools or
+                                       keep_connections):
+            django_case = get_reset_test_case(track_dirty_tables, fast_flush,
+                                              snapshots, pools,
+                                              keep_connections)
+
+        elif get_version() >= '1.5':
             from django.test import TransactionTestCase as django_case
 
         else:
@@ -94,19 +417,96 @@ def _django_db_fixture_helper(transactional, request, _django_cursor_wrapper):
                 from django.core.management import call_command
 
                 for db in connections:
+                    if fast_flush:
+                        flush_database(connections[db], fast=True)
+                        continue
                     call_command('flush', interactive=False, database=db,
                                  verbosity=pytest.config.option.verbose)
                 for conn in connections.all():
                     conn.close()
             request.addfinalizer(flushdb)
 
+        if (django_case and getattr(marker, 'serialized_rollback', False) and
+                get_django_version() >= (1, 7)):
+            django_case = _get_serialized_rollback_case(django_case)
+
     else:
         from django.test import TestCase as django_case
 
+    # The shared fixtures are loaded outside of the atomic block of the test,
+    # which must not be nested inside of the atomic block of module_db.
+    share_fixtures = (getattr(request.node, '_django_fixture_set', None) and
+                      not _outer_atomics and _can_share_fixtures())
+    if share_fixtures:
+        shared_fixtures.enter(marker.fixtures, _django_cursor_wrapper,
+                              _fixture_stream_size(request.config))
+
     if django_case:
         case = django_case(methodName='__init__')
         case._pre_setup()
-        # request.addfinalizer(case._post_teardown)
+        request.addfinalizer(case._post_teardown)
+
+    if getattr(marker, 'fixtures', None) and not share_fixtures:
+        load_fixtures(marker.fixtures,
+                      stream_size=_fixture_stream_size(request.config))
+
+
+def _fixture_stream_size(config):
+    return config.getvalue('fixture_stream_size') * 1024 * 1024
+
+
+def _can_share_fixtures():
+    from django.test.testcases import connections_support_transactions
+
+    return (get_django_version() >= (1, 6) and
+            connections_support_transactions())
+
+
+_serialized_rollback_cases = {}
+
+
+def _get_serialized_rollback_case(django_case):
+    """Return a subclass of *django_case* which uses serialized_rollback."""
+    if django_case not in _serialized_rollback_cases:
+        _serialized_rollback_cases[django_case] = type(
+            'SerializedRollback' + django_case.__name__, (django_case,),
+            {'serialized_rollback': True})
+    return _serialized_rollback_cases[django_case]
+
+
+# The outer atomic blocks of module_db and class_db, as (fixture name, atomic)
+# tuples. Tests using db run in savepoints inside of them.
+_outer_atomics = []
+
+
+def _django_db_scope_helper(name, request, _django_cursor_wrapper):
+    if get_django_version() < (1, 6):
+        pytest.fail('%s requires Django 1.6 or newer.' % name)
+
+    from django.db import DEFAULT_DB_ALIAS, transaction
+    from django.test.testcases import connections_support_transactions
+
+    if not connections_support_transactions():
+        pytest.fail('%s requires a database with transaction support.'
+                    % name)
+
+    _django_cursor_wrapper.enable()
+    request.addfinalizer(_django_cursor_wrapper.restore)
+    partial_schema.observe(request, _django_cursor_wrapper)
+
+    # Roll back the shared fixtures before they would be nested inside.
+    shared_fixtures.exit()
+    atomic = transaction.atomic(using=DEFAULT_DB_ALIAS)
+    atomic.__enter__()
+    _outer_atomics.append((name, atomic))
+
+    def rollback():
+        assert _outer_atomics[-1][1] is atomic
+        _outer_atomics.pop()
+        with _django_cursor_wrapper:
+            transaction.set_rollback(True, using=DEFAULT_DB_ALIAS)
+            atomic.__exit__(None, None, None)
+    request.addfinalizer(rollback)
 
 
 def _handle_south():
@@ -195,6 +595,36 @@ def transactional_db(request, _django_db_setup, _django_cursor_wrapper):
     return _django_db_fixture_helper(True, request, _django_cursor_wrapper)
 
 
+@pytest.fixture(scope='module')
+def module_db(request, _django_db_setup, _django_cursor_wrapper):
+    """Require a django test database for the whole module
+
+    Database changes made by module scoped fixtures which request this
+    fixture are shared by all tests of the module. They happen inside a
+    transaction which is rolled back after the last test of the module.
+
+    Database access stays enabled until then. Tests still need to request
+    the ``db`` fixture: each test then runs inside a savepoint which is
+    rolled back after the test. ``transactional_db`` cannot be used in the
+    module.
+
+    Only the default database is wrapped in a transaction. This requires
+    Django 1.6 or newer.
+    """
+    skip_if_no_django()
+    _django_db_scope_helper('module_db', request, _django_cursor_wrapper)
+
+
+@pytest.fixture(scope='class')
+def class_db(request, _django_db_setup, _django_cursor_wrapper):
+    """Require a django test database for the whole class
+
+    This is the class scoped version of ``module_db``.
+    """
+    skip_if_no_django()
+    _django_db_scope_helper('class_db', request, _django_cursor_wrapper)
+
+
 @pytest.fixture()
 def client():
     """A Django test client instance."""
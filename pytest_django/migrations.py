@@ -1,3 +1,28 @@
+"""Django migrations while the test databases are set up.
+
+Data migrations which backfill production data do nothing on an empty test
+database, but still import code and run queries. The RunPython operations of
+the migrations listed in the ``django_skip_data_migrations`` ini setting are
+left out, their schema operations are still applied. How long the RunPython
+operations of every migration take whenever the test databases are set up
+with migrations is recorded in the pytest cache directory, to report the
+time saved by skipping them.
+"""
+
+from __future__ import with_statement
+
+import contextlib
+import fnmatch
+import json
+import threading
+import time
+
+from . import report
+from .cache import FileLock
+
+REPORT_SECTION = 'test database setup'
+
+
 # code snippet copied from https://gist.github.com/NotSqrt/5f3c76cd15e40ef62d09
 class DisableMigrations(object):
 
@@ -6,3 +31,147 @@ class DisableMigrations(object):
 
     def __getitem__(self, item):
         return "notmigrations"
+
+
+def _matches(key, patterns):
+    """Whether the migration *key* (``app_label.name``) matches one of
+    *patterns*, which are app labels or fnmatch patterns for keys."""
+    app_label = key.split('.', 1)[0]
+    return any(pattern == app_label or fnmatch.fnmatchcase(key, pattern)
+               for pattern in patterns)
+
+
+class DataMigrationSkipper(object):
+    """Leaves out the RunPython operations of some migrations.
+
+    While installed, Migration.apply() and RunPython.database_forwards() are
+    patched, for the migrations run by any thread, and the time the
+    RunPython operations of the other migrations take is measured. The
+    patterns are kept after uninstalling, since they describe how the test
+    databases were set up.
+    """
+
+    def __init__(self):
+        self.patterns = None
+        self.cache_dir = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._skipped = {}
+        self._real_apply = None
+        self._real_database_forwards = None
+
+    def install(self, patterns, cache_dir):
+        from django.db.migrations.migration import Migration
+        from django.db.migrations.operations.special import RunPython
+
+        self.patterns = list(patterns)
+        self.cache_dir = cache_dir
+        self._real_apply = Migration.apply
+        self._real_database_forwards = RunPython.database_forwards
+
+        skipper = self
+
+        def apply(migration, *args, **kwargs):
+            return skipper._apply(migration, *args, **kwargs)
+
+        def database_forwards(operation, *args, **kwargs):
+            return skipper._database_forwards(operation, *args, **kwargs)
+
+        Migration.apply = apply
+        RunPython.database_forwards = database_forwards
+
+    def uninstall(self):
+        from django.db.migrations.migration import Migration
+        from django.db.migrations.operations.special import RunPython
+
+        Migration.apply = self._real_apply
+        RunPython.database_forwards = self._real_database_forwards
+        self._real_apply = self._real_database_forwards = None
+        if self._timings or self._skipped:
+            timings = self._save_timings()
+
+        for key in sorted(self._skipped):
+            label = 'saved by skipping data migration %s' % key
+            if key in timings:
+                report.add_timing(REPORT_SECTION, label,
+                                  timings[key] * self._skipped[key])
+            else:
+                report.add_entry(REPORT_SECTION, label,
+                                 'unknown, it was never run')
+
+        self._timings = {}
+        self._skipped = {}
+
+    @contextlib.contextmanager
+    def skipping(self, patterns, cache_dir):
+        """Skip the data migrations matching *patterns* inside the with
+        block, and measure the other ones.
+
+        *patterns* is None if no migrations are run, e.g. with
+        --nomigrations. Nothing happens if the skipper is installed already,
+        e.g. for a database created lazily during the setup.
+        """
+        if patterns is None or self._real_apply is not None:
+            yield
+            return
+
+        self.install(patterns, cache_dir)
+        try:
+            yield
+        finally:
+            self.uninstall()
+
+    def _apply(self, migration, *args, **kwargs):
+        from django.db.migrations.operations.special import RunPython
+
+        key = '%s.%s' % (migration.app_label, migration.name)
+        skip = _matches(key, self.patterns)
+        if skip and any(isinstance(operation, RunPython)
+                        for operation in migration.operations):
+            with self._lock:
+                self._skipped[key] = self._skipped.get(key, 0) + 1
+
+        self._local.migration = (key, skip)
+        self._local.elapsed = 0.0
+        try:
+            result = self._real_apply(migration, *args, **kwargs)
+        finally:
+            self._local.migration = None
+        if not skip and self._local.elapsed:
+            with self._lock:
+                self._timings[key] = self._local.elapsed
+        return result
+
+    def _database_forwards(self, operation, *args, **kwargs):
+        migration = getattr(self._local, 'migration', None)
+        if migration is None:
+            return self._real_database_forwards(operation, *args, **kwargs)
+
+        key, skip = migration
+        if skip:
+            return
+        start = time.time()
+        try:
+            return self._real_database_forwards(operation, *args, **kwargs)
+        finally:
+            self._local.elapsed += time.time() - start
+
+    def _save_timings(self):
+        """Merge the measured timings into the ones of previous test runs
+        and return all of them."""
+        path = self.cache_dir.join('data-migrations.json')
+        with FileLock(self.cache_dir.join('data-migrations.lock')):
+            timings = {}
+            if path.check():
+                try:
+                    timings = json.loads(path.read())
+                except ValueError:
+                    pass
+            if self._timings:
+                timings.update(self._timings)
+                path.write(json.dumps(timings, sort_keys=True))
+        return timings
+
+
+data_migration_skipper = DataMigrationSkipper()
@@ -0,0 +1,156 @@
+"""Creating the tables of only some apps in the test databases.
+
+When every test which uses the database names the apps it needs with the
+``apps`` argument of the django_db mark, and migrations are disabled with
+``--nomigrations``, only the tables of these apps and of the models their
+foreign keys and many-to-many fields refer to are created. A router keeps
+Django from creating the other tables, statements which refer to them fail
+the test instead of causing a database error.
+"""
+
+import re
+
+import pytest
+
+from . import report
+
+REPORT_SECTION = 'test database setup'
+
+
+def _get_related_models(model):
+    """Return the models *model* refers to with its relation fields."""
+    opts = model._meta
+    related = [parent._meta.concrete_model for parent in opts.parents]
+    for field in list(opts.fields) + list(opts.many_to_many):
+        if field.related_model is None:
+            continue
+        related.append(field.related_model._meta.concrete_model)
+        remote_field = getattr(field, 'remote_field', None) or field.rel
+        through = getattr(remote_field, 'through', None)
+        if hasattr(through, '_meta'):
+            related.append(through._meta.concrete_model)
+    return related
+
+
+def get_model_closure(app_labels):
+    """Return the models of the apps *app_labels* and the models they refer
+    to, directly or indirectly.
+
+    Fails the test for labels of apps which are not installed.
+    """
+    from django.apps import apps
+
+    pending = []
+    for label in app_labels:
+        try:
+            app_config = apps.get_app_config(label)
+        except LookupError:
+            pytest.fail('The django_db mark names the app "%s", which is not '
+                        'installed.' % label, pytrace=False)
+        pending.extend(model._meta.concrete_model for model in
+                       app_config.get_models(include_auto_created=True))
+
+    models = set()
+    while pending:
+        model = pending.pop()
+        if model in models:
+            continue
+        models.add(model)
+        pending.extend(_get_related_models(model))
+    return models
+
+
+class PartialSchema(object):
+    """Restricts the tables created in the test databases.
+
+    An instance is a database router while it is installed. It is also an
+    SQL observer, which is only registered with the cursor manager while
+    the tests run (see :meth:`observe`), not while e.g. the test databases
+    are set up.
+    """
+
+    def __init__(self):
+        self.app_labels = []
+        self.models = set()
+        self._allowed = set()
+        self._missing_tables = {}
+        self._missing_re = None
+
+    def get_model_labels(self):
+        """Return the sorted labels of the models whose tables exist."""
+        return sorted('%s.%s' % (model._meta.app_label,
+                                 model._meta.model_name)
+                      for model in self.models)
+
+    def install(self, app_labels):
+        from django.apps import apps
+        from django.db import router
+
+        self.app_labels = list(app_labels)
+        self.models = get_model_closure(self.app_labels)
+        self._allowed = set((model._meta.app_label, model._meta.model_name)
+                            for model in self.models)
+
+        tables = set(model._meta.db_table for model in self.models)
+        all_models = set(model._meta.concrete_model for model in
+                         apps.get_models(include_auto_created=True))
+        self._missing_tables = {}
+        for model in all_models:
+            if model._meta.db_table not in tables:
+                self._missing_tables[model._meta.db_table] = model
+        if self._missing_tables:
+            self._missing_re = re.compile(
+                r'["`\[](%s)["`\]]' % '|'.join(
+                    re.escape(table) for table in
+                    sorted(self._missing_tables, key=len, reverse=True)))
+
+        router.routers.insert(0, self)
+
+        report.add_entry(
+            REPORT_SECTION,
+            'tables created for the apps %s' % ', '.join(self.app_labels),
+            '%d of %d' % (len(tables), len(tables) + len(self._missing_tables)))
+
+    def uninstall(self):
+        from django.db import router
+
+        if self in router.routers:
+            router.routers.remove(self)
+        self.app_labels = []
+        self.models = set()
+        self._allowed = set()
+        self._missing_tables = {}
+        self._missing_re = None
+
+    def observe(self, request, cursor_manager):
+        """Check the statements of the test (or module_db or class_db
+        fixture) of *request* for tables which were not created."""
+        if self._missing_re is None:
+            return
+        cursor_manager.add_observer(self)
+        request.addfinalizer(lambda: cursor_manager.remove_observer(self))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name is None:
+            return None
+        if (app_label, model_name) not in self._allowed:
+            return False
+        return None
+
+    def __call__(self, sql, connection, params, many):
+        __tracebackhide__ = True
+        try:
+            match = self._missing_re.search(sql)
+        except TypeError:
+            # E.g. psycopg2's sql.Composed
+            return
+        if match:
+            opts = self._missing_tables[match.group(1)]._meta
+            pytest.fail(
+                'The table %s of the model %s.%s was not created in the test '
+                'database, add "%s" to the apps of the django_db mark.' % (
+                    opts.db_table, opts.app_label, opts.object_name,
+                    opts.app_label))
+
+
+partial_schema = PartialSchema()
@@ -10,21 +10,30 @@ from functools import reduce
 import os
 import sys
 import types
+import uuid
 
 import py
 import pytest
 
+from . import report
+from .db_creation import TESTRUN_KEY
+from .db_fixtures import group_items, shared_fixtures
+from .db_teardown import (TO_DROP, can_drop_in_background,
+                          drop_marked_databases, get_ledger,
+                          mark_leftovers_for_drop, start_dropping_process)
 from .django_compat import is_django_unittest
 from .fixtures import (_django_db_setup, _live_server_helper, admin_client,
-                       admin_user, client, db, django_user_model,
-                       django_username_field, live_server, rf, settings,
-                       transactional_db)
+                       admin_user, class_db, client, db, django_user_model,
+                       django_username_field, live_server, module_db, rf,
+                       settings, transactional_db)
+from .fixtures import (finish_background_db_setup, get_background_db_setup,
+                       start_background_db_setup)
 from .lazy_django import django_settings_is_configured, skip_if_no_django
 
 # Silence linters for imported fixtures.
-(_django_db_setup, _live_server_helper, admin_client, admin_user, client, db,
- django_user_model, django_username_field, live_server, rf, settings,
- transactional_db)
+(_django_db_setup, _live_server_helper, admin_client, admin_user, class_db,
+ client, db, django_user_model, django_username_field, live_server, module_db,
+ rf, settings, transactional_db)
 
 
 SETTINGS_MODULE_ENV = 'DJANGO_SETTINGS_MODULE'
@@ -53,6 +62,92 @@ def pytest_addoption(parser):
     group._addoption('--nomigrations',
                      action='store_true', dest='nomigrations', default=False,
                      help='Disable Django 1.7 migrations on test setup')
+    group._addoption('--db-slots',
+                     action='store', type='int', dest='db_slots', default=0,
+                     help='With --reuse-db, keep the test databases of up to '
+                          'this many different schemas (e.g. from different '
+                          'branches) and drop the least recently used ones.')
+    group._addoption('--db-template',
+                     action='store_true', dest='db_template', default=False,
+                     help='With xdist, set up the test database once as a '
+                          'template and clone it for every worker.')
+    group._addoption('--pg-worker-schemas',
+                     action='store_true', dest='pg_worker_schemas',
+                     default=False,
+                     help='With xdist and PostgreSQL, share one test database '
+                          'between the workers and give every worker a copy '
+                          'of its schema.')
+    group._addoption('--sqlite-memory',
+                     action='store_true', dest='sqlite_memory', default=False,
+                     help='Load file based SQLite test databases into memory '
+                          'after they have been set up.')
+    group._addoption('--lazy-db',
+                     action='store_true', dest='lazy_db', default=False,
+                     help='Only create the default test database up front, '
+                          'create the other ones when they are first used.')
+    group._addoption('--track-dirty-tables',
+                     action='store_true', dest='track_dirty_tables',
+                     default=False,
+                     help='After tests using transactional_db, only flush '
+                          'the tables which were written to.')
+    group._addoption('--fast-flush',
+                     action='store_true', dest='fast_flush', default=False,
+                     help='Empty the tables after tests using '
+                          'transactional_db with backend specific bulk '
+                          'statements.')
+    group._addoption('--sqlite-snapshot',
+                     action='store_true', dest='sqlite_snapshot',
+                     default=False,
+                     help='After tests using transactional_db, restore '
+                          'SQLite test databases from a copy taken after '
+                          'they were set up instead of flushing them.')
+    group._addoption('--schema-cache',
+                     action='store_true', dest='schema_cache', default=False,
+                     help='Record the SQL which builds the schema of the '
+                          'test databases and replay it for fresh test '
+                          'databases with the same schema.')
+    group._addoption('--db-background-setup',
+                     action='store_true', dest='db_background_setup',
+                     default=False,
+                     help='Start setting up the test databases in a '
+                          'background thread while the tests are '
+                          'collected.')
+    group._addoption('--db-pool',
+                     action='store', type='int', dest='db_pool', default=0,
+                     help='Run tests using transactional_db on clean copies '
+                          'from a pool of this many copies of every test '
+                          'database, instead of flushing.')
+    group._addoption('--keep-db-connections',
+                     action='store_true', dest='keep_db_connections',
+                     default=False,
+                     help='Keep the database connections open between tests '
+                          'and only reset their session state.')
+    group._addoption('--group-fixtures',
+                     action='store_true', dest='group_fixtures',
+                     default=False,
+                     help='Run tests with the same django_db fixtures '
+                          'back to back and load the fixtures only once '
+                          'for them.')
+    group._addoption('--fixture-stream-size',
+                     action='store', type='int', dest='fixture_stream_size',
+                     default=16,
+                     help='Stream JSON fixture files larger than this many '
+                          'megabytes instead of caching their contents.')
+    group._addoption('--async-teardown',
+                     action='store_true', dest='async_teardown',
+                     default=False,
+                     help='Drop the test databases in a detached process '
+                          'after the test session.')
+    group._addoption('--drop-leftover-dbs',
+                     action='store_true', dest='drop_leftover_dbs',
+                     default=False,
+                     help='Drop the test databases left over by crashed '
+                          'test runs.')
+    group._addoption('--db-setup-workers',
+                     action='store', type='int', dest='db_setup_workers',
+                     default=1,
+                     help='Create and destroy independent test databases in '
+                          'this many threads.')
     parser.addini(CONFIGURATION_ENV,
                   'django-configurations class to use by pytest-django.')
     group._addoption('--liveserver', default=None,
@@ -60,6 +155,16 @@ def pytest_addoption(parser):
     parser.addini(SETTINGS_MODULE_ENV,
                   'Django settings module to use by pytest-django.')
 
+    parser.addini('django_skip_data_migrations',
+                  'Apps (app_label) or migrations (app_label.name, may '
+                  'contain wildcards) whose RunPython operations are left '
+                  'out when the test databases are created.',
+                  type='linelist')
+    parser.addini('django_unused_databases',
+                  'Database aliases which are not used by the tests, no '
+                  'test databases are set up for them and their test '
+                  'mirrors.',
+                  type='linelist')
     parser.addini('django_find_project',
                   'Automatically find and add a Django project to the '
                   'Python path.',
@@ -164,10 +269,14 @@ def pytest_load_initial_conftests(early_config, parser, args):
     # Register the marks
     early_config.addinivalue_line(
         'markers',
-        'django_db(transaction=False): Mark the test as using '
-        'the django test database.  The *transaction* argument marks will '
-        "allow you to use real transactions in the test like Django's "
-        'TransactionTestCase.')
+        'django_db(transaction=False, serialized_rollback=False, '
+        'fixtures=None, apps=None): Mark the test as using the django test '
+        'database.  The *transaction* argument will allow you to use real '
+        "transactions in the test like Django's TransactionTestCase. "
+        '*serialized_rollback* restores the initial database contents after '
+        'such a test. *fixtures* are loaded before the test, like the '
+        "fixtures of Django's TestCase. *apps* are the labels of the apps "
+        'whose tables the test needs.')
     early_config.addinivalue_line(
         'markers',
         'urls(modstr): Use a different URLconf for this test, similar to '
@@ -247,11 +356,91 @@ def pytest_report_header(config):
 
 
 @pytest.mark.trylast
-def pytest_configure():
+def pytest_configure(config):
     # Allow Django settings to be configured in a user pytest_configure call,
     # but make sure we call django.setup()
     _setup_django()
 
+    if config.pluginmanager.hasplugin('xdist'):
+        config.pluginmanager.register(XdistHooks(), 'django_xdist_hooks')
+
+    if _use_background_db_setup(config):
+        # The databases are set up in the test environment, as without
+        # --db-background-setup.
+        _setup_test_environment(config)
+        start_background_db_setup(config, _make_cursor_manager())
+
+    if (config.getvalue('drop_leftover_dbs') and
+            django_settings_is_configured() and
+            not hasattr(config, 'slaveinput')):
+        mark_leftovers_for_drop(config)
+
+
+def _use_background_db_setup(config):
+    if (not config.getvalue('db_background_setup') or
+            not django_settings_is_configured() or
+            config.getvalue('collectonly')):
+        return False
+
+    # The xdist controller does not run any tests.
+    is_xdist_controller = (
+        getattr(config.option, 'dist', 'no') != 'no' and
+        not hasattr(config, 'slaveinput'))
+    return not is_xdist_controller
+
+
+class XdistHooks(object):
+    """Hooks which are only registered when pytest-xdist is used."""
+
+    def __init__(self):
+        self.testrun = uuid.uuid4().hex
+
+    def pytest_configure_node(self, node):
+        # Lets the workers tell whether something they share, like a
+        # template database, was already created during this test run.
+        node.slaveinput[TESTRUN_KEY] = self.testrun
+
+    def pytest_testnodedown(self, node, error):
+        slaveoutput = getattr(node, 'slaveoutput', {})
+        report.merge_entries(slaveoutput.get(report.REPORT_KEY, []),
+                             node.gateway.id)
+
+
+@pytest.mark.trylast
+def pytest_sessionfinish(session):
+    # Runs after the session fixtures have been torn down.
+    finish_background_db_setup(session.config)
+    # In case the test environment was set up for a background setup, but
+    # no test was run.
+    _teardown_test_environment(session.config)
+    _drop_marked_databases(session.config)
+
+    if hasattr(session.config, 'slaveoutput'):
+        session.config.slaveoutput[report.REPORT_KEY] = report.get_entries()
+
+
+def _drop_marked_databases(config):
+    """Drop the test databases marked by the test processes."""
+    if (not (config.getvalue('async_teardown') or
+             config.getvalue('drop_leftover_dbs')) or
+            not django_settings_is_configured() or
+            hasattr(config, 'slaveinput')):
+        return
+
+    ledger = get_ledger(config)
+    if not ledger.has_entries(TO_DROP):
+        return
+
+    if config.getvalue('async_teardown') and can_drop_in_background():
+        start_dropping_process(config)
+    else:
+        drop_marked_databases(ledger,
+                              os.environ.get(SETTINGS_MODULE_ENV))
+
+
+def pytest_terminal_summary(terminalreporter):
+    report.write_summary(terminalreporter)
+
 
 def _method_is_defined_at_leaf(cls, method_name):
     super_method = None
@@ -306,6 +495,115 @@ def _restore_class_methods(cls):
         cls.tearDownClass = tearDownClass
 
 
+@pytest.mark.trylast
+def pytest_collection_modifyitems(session, config, items):
+    # Runs after other plugins deselected items, e.g. with -k.
+    config._django_serialized_rollback = any(
+        _uses_serialized_rollback(item) for item in items)
+    config._django_schema_apps = _get_schema_apps(items)
+
+    if config.getvalue('group_fixtures'):
+        for item in items:
+            item._django_fixture_set = _get_fixture_set(item)
+        items[:] = group_items(items, _get_fixture_group)
+
+
+@pytest.mark.trylast
+def pytest_runtest_teardown(item, nextitem):
+    # Runs after the fixtures of the test were torn down.
+    if (shared_fixtures.key is not None and
+            getattr(nextitem, '_django_fixture_set', None) !=
+            shared_fixtures.key):
+        shared_fixtures.exit()
+
+
+def _uses_serialized_rollback(item):
+    """Whether the test *item* needs the serialized database contents."""
+    marker = item.keywords.get('django_db', None)
+    if marker:
+        try:
+            validate_django_db(marker)
+        except TypeError:
+            # The error is reported when the test is run.
+            return False
+        # Like in _django_db_fixture_helper(), serialized_rollback applies
+        # to every test using a transactional database.
+        if marker.serialized_rollback and (
+                marker.transaction or _requests_transactional_db(item)):
+            return True
+
+    # A TransactionTestCase with serialized_rollback
+    cls = getattr(item, 'cls', None)
+    return getattr(cls, 'serialized_rollback', False) is True
+
+
+def _requests_transactional_db(item):
+    """Whether the test *item* uses a transactional database through the
+    fixtures it requests."""
+    fixturenames = getattr(item, 'fixturenames', ())
+    return 'transactional_db' in fixturenames or 'live_server' in fixturenames
+
+
+def _get_schema_apps(items):
+    """The labels of the apps whose tables the test *items* need.
+
+    Returns None if one of the tests which use the database does not name
+    its apps with the django_db mark.
+    """
+    if not django_settings_is_configured():
+        return None
+
+    apps = set()
+    for item in items:
+        marker = item.keywords.get('django_db', None)
+        if marker:
+            try:
+                validate_django_db(marker)
+            except TypeError:
+                return None
+            if marker.apps is None:
+                return None
+            apps.update(marker.apps)
+        elif (is_django_unittest(item) or
+              '_django_db_setup' in getattr(item, 'fixturenames', ())):
+            return None
+    return sorted(apps)
+
+
+def _get_fixture_set(item):
+    """The fixtures which the test *item* can share with other tests.
+
+    Only tests using db (not transactional_db, module_db or class_db) can
+    share their fixtures.
+    """
+    marker = item.keywords.get('django_db', None)
+    if not marker or is_django_unittest(item):
+        return None
+    try:
+        validate_django_db(marker)
+    except TypeError:
+        return None
+    if marker.transaction or not marker.fixtures:
+        return None
+
+    fixturenames = getattr(item, 'fixturenames', ())
+    for name in ('transactional_db', 'live_server', 'module_db', 'class_db'):
+        if name in fixturenames:
+            return None
+    return tuple(marker.fixtures)
+
+
+def _get_fixture_group(item):
+    """The group of *item* for --group-fixtures.
+
+    Tests are only grouped within their module or class, so that module and
+    class scoped fixtures are not set up again.
+    """
+    if item._django_fixture_set is None:
+        return None
+    return (item.parent.nodeid, item._django_fixture_set)
+
+
 def pytest_runtest_setup(item):
     if django_settings_is_configured() and is_django_unittest(item):
         cls = item.cls
@@ -326,11 +624,42 @@ def _django_test_environment(request):
     """
     if django_settings_is_configured():
         _setup_django()
-        from django.conf import settings
-        from .compat import setup_test_environment, teardown_test_environment
-        settings.DEBUG = False
-        setup_test_environment()
-        request.addfinalizer(teardown_test_environment)
+        _setup_test_environment(request.config)
+        request.addfinalizer(
+            lambda: _teardown_test_environment(request.config))
+
+
+def _setup_test_environment(config):
+    """Set up Django's test environment unless it is set up already."""
+    if getattr(config, '_django_test_environment', False):
+        return
+
+    from django.conf import settings
+    from .compat import setup_test_environment
+    settings.DEBUG = False
+    setup_test_environment()
+    config._django_test_environment = True
+
+
+def _teardown_test_environment(config):
+    if not getattr(config, '_django_test_environment', False):
+        return
+
+    from .compat import teardown_test_environment
+    teardown_test_environment()
+    config._django_test_environment = False
+
+
+def _make_cursor_manager():
+    # util -> utils rename in Django 1.7
+    try:
+        import django.db.backends.utils
+        utils_module = django.db.backends.utils
+    except ImportError:
+        import django.db.backends.util
+        utils_module = django.db.backends.util
+
+    return CursorManager(utils_module)
 
 
 @pytest.fixture(autouse=True, scope='session')
@@ -344,15 +673,13 @@ def _django_cursor_wrapper(request):
     if not django_settings_is_configured():
         return None
 
-    # util -> utils rename in Django 1.7
-    try:
-        import django.db.backends.utils
-        utils_module = django.db.backends.utils
-    except ImportError:
-        import django.db.backends.util
-        utils_module = django.db.backends.util
-
-    manager = CursorManager(utils_module)
+    background_setup = get_background_db_setup(request.config)
+    if background_setup is not None:
+        # Blocking database access would make the setup fail.
+        background_setup.join()
+        manager = background_setup.cursor_manager
+    else:
+        manager = _make_cursor_manager()
     manager.disable()
     request.addfinalizer(manager.restore)
     return manager
@@ -527,7 +854,13 @@ class CursorManager(object):
     def __init__(self, dbutil):
         self._dbutil = dbutil
         self._history = []
+        self._observers = []
         self._real_wrapper = dbutil.CursorWrapper
+        self._real_debug_wrapper = dbutil.CursorDebugWrapper
+        self._observing_wrapper = self._make_observing_wrapper(
+            self._real_wrapper)
+        self._observing_debug_wrapper = self._make_observing_wrapper(
+            self._real_debug_wrapper)
 
     def _save_active_wrapper(self):
         return self._history.append(self._dbutil.CursorWrapper)
@@ -538,10 +871,60 @@ class CursorManager(object):
         pytest.fail('Database access not allowed, '
                     'use the "django_db" mark to enable it.')
 
+    def _make_observing_wrapper(self, base):
+        manager = self
+
+        class ObservingCursorWrapper(base):
+            def execute(self, sql, params=None):
+                manager._notify_observers(sql, self.db, params)
+                return super(ObservingCursorWrapper, self).execute(sql, params)
+
+            def executemany(self, sql, param_list):
+                manager._notify_observers(sql, self.db, param_list, True)
+                return super(ObservingCursorWrapper, self).executemany(
+                    sql, param_list)
+
+        return ObservingCursorWrapper
+
+    def _notify_observers(self, sql, db, params, many=False):
+        for observer in list(self._observers):
+            observer(sql, db, params, many)
+
+    def _enabled_wrapper(self):
+        if self._observers:
+            return self._observing_wrapper
+        return self._real_wrapper
+
+    def _update_wrappers(self):
+        if self._is_enabled_wrapper(self._dbutil.CursorWrapper):
+            self._dbutil.CursorWrapper = self._enabled_wrapper()
+        if self._observers:
+            self._dbutil.CursorDebugWrapper = self._observing_debug_wrapper
+        else:
+            self._dbutil.CursorDebugWrapper = self._real_debug_wrapper
+
+    def _is_enabled_wrapper(self, wrapper):
+        return wrapper in (self._real_wrapper, self._observing_wrapper)
+
+    def add_observer(self, observer):
+        """Call *observer* for every statement executed by Django's cursors.
+
+        It is called with the SQL, the Django connection, the parameters and
+        whether these are a list of parameters for executemany(), before the
+        statement is executed. Observers are also called for debug cursors,
+        e.g. inside assertNumQueries().
+        """
+        self._observers.append(observer)
+        self._update_wrappers()
+
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+        self._update_wrappers()
+
     def enable(self):
         """Enable access to the Django database."""
         self._save_active_wrapper()
-        self._dbutil.CursorWrapper = self._real_wrapper
+        self._dbutil.CursorWrapper = self._enabled_wrapper()
 
     def disable(self):
         """Disable access to the Django database."""
@@ -549,7 +932,11 @@ class CursorManager(object):
         self._dbutil.CursorWrapper = self._blocking_wrapper
 
     def restore(self):
-        self._dbutil.CursorWrapper = self._history.pop()
+        wrapper = self._history.pop()
+        if self._is_enabled_wrapper(wrapper):
+            # Observers may have been added or removed in the meantime.
+            wrapper = self._enabled_wrapper()
+        self._dbutil.CursorWrapper = wrapper
 
     def __enter__(self):
         self.enable()
@@ -561,11 +948,20 @@ class CursorManager(object):
 def validate_django_db(marker):
     """Validate the django_db marker.
 
-    It checks the signature and creates the `transaction` attribute on
-    the marker which will have the correct value.
+    It checks the signature and creates the `transaction`,
+    `serialized_rollback`, `fixtures` and `apps` attributes on the marker
+    which will have the correct value.
     """
-    def apifun(transaction=False):
+    def apifun(transaction=False, serialized_rollback=False, fixtures=None,
+               apps=None):
         marker.transaction = transaction
+        marker.serialized_rollback = serialized_rollback
+        if fixtures is not None and not isinstance(fixtures, (list, tuple)):
+            fixtures = [fixtures]
+        marker.fixtures = fixtures or []
+        if apps is not None and not isinstance(apps, (list, tuple)):
+            apps = [apps]
+        marker.apps = apps
     apifun(*marker.args, **marker.kwargs)
 
 
@@ -0,0 +1,49 @@
+"""Numbers about the test database setup, shown in the terminal summary.
+
+Entries are grouped by section and are plain tuples of strings, so the ones
+recorded by xdist workers can be sent to the controller.
+"""
+
+# The key in xdist's slaveoutput which holds the entries of a worker.
+REPORT_KEY = 'pytest_django_report'
+
+_entries = []
+
+
+def add_entry(section, label, text):
+    """Add a line ``label: text`` to *section* of the summary."""
+    _entries.append((section, label, text))
+
+
+def add_timing(section, label, seconds):
+    add_entry(section, label, '%.2fs' % seconds)
+
+
+def get_entries():
+    return list(_entries)
+
+
+def merge_entries(entries, prefix=None):
+    """Add the entries of an xdist worker, with *prefix* before the labels."""
+    for section, label, text in entries:
+        if prefix:
+            label = '[%s] %s' % (prefix, label)
+        add_entry(section, label, text)
+
+
+def write_summary(terminalreporter):
+    if not _entries:
+        return
+
+    sections = []
+    lines = {}
+    for section, label, text in _entries:
+        if section not in lines:
+            sections.append(section)
+            lines[section] = []
+        lines[section].append('%s: %s' % (label, text))
+
+    for section in sections:
+        terminalreporter.write_sep('-', 'pytest-django: %s' % section)
+        for line in lines[section]:
+            terminalreporter.write_line(line)
@@ -0,0 +1,266 @@
+"""Building test database schemas by replaying SQL from a previous run.
+
+Running all migrations (or syncdb for every model) is often the slowest part
+of creating a test database. The first time a schema is built, the
+statements executed by the migrate command are recorded, including the rows
+inserted by post_migrate handlers like the ones for content types and
+permissions. Later, empty test databases with the same schema are built by
+executing the recorded statements in a single transaction instead.
+"""
+
+from __future__ import with_statement
+
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import re
+import sys
+import time
+
+from . import report
+from .cache import get_cache_dir
+from .fingerprint import get_schema_fingerprint
+from .lazy_django import get_django_version
+
+REPORT_SECTION = 'test database setup'
+
+# Bumped whenever the format of the recorded statements changes.
+SCHEMA_CACHE_VERSION = 1
+
+_SAVEPOINT_RE = re.compile(r'\s*SAVEPOINT\s+(\S+)', re.IGNORECASE)
+_ROLLBACK_TO_RE = re.compile(r'\s*ROLLBACK\s+TO\s+(?:SAVEPOINT\s+)?(\S+)',
+                             re.IGNORECASE)
+_TRANSACTION_RE = re.compile(
+    r'\s*(?:RELEASE|BEGIN|COMMIT|END|START\s+TRANSACTION|ROLLBACK)\b',
+    re.IGNORECASE)
+
+_SCHEMA_COMMANDS = ('migrate', 'syncdb')
+
+
+def get_schema_key(connection):
+    """Return a key for the schema of a fresh test database of *connection*.
+
+    Unlike the fingerprint used by --reuse-db, this does not depend on the
+    database name, so that e.g. all xdist workers share the same recording.
+    """
+    fingerprint = get_schema_fingerprint(connection)
+    key = {
+        'version': SCHEMA_CACHE_VERSION,
+        'python': sys.version_info[0],
+        'django': list(get_django_version()),
+        'engine': connection.settings_dict['ENGINE'],
+        'installed_apps': fingerprint['installed_apps'],
+        'unmigrated_models': fingerprint['unmigrated_models'],
+        'migrations': fingerprint['migrations'],
+    }
+    if 'skipped_data_migrations' in fingerprint:
+        key['skipped_data_migrations'] = fingerprint[
+            'skipped_data_migrations']
+    if 'partial_schema' in fingerprint:
+        key['partial_schema'] = fingerprint['partial_schema']
+    return hashlib.sha1(
+        json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SchemaRecorder(object):
+    """Records the statements executed on some connections.
+
+    An instance is registered as SQL observer with the cursor manager of
+    the _django_cursor_wrapper fixture. Statements rolled back to a savepoint
+    are dropped again, transaction control statements are left out since
+    the recording is replayed in a single transaction.
+    """
+
+    def __init__(self):
+        # Maps aliases to lists of (sql, params, many) tuples. None instead of
+        # a list means that something was executed which cannot be recorded.
+        self._statements = {}
+        self._savepoints = {}
+
+    def start(self, alias):
+        self._statements[alias] = []
+        self._savepoints[alias] = []
+
+    def stop(self, alias):
+        """Stop recording *alias* and return its statements or None."""
+        self._savepoints.pop(alias, None)
+        return self._statements.pop(alias, None)
+
+    def __call__(self, sql, db, params=None, many=False):
+        statements = self._statements.get(db.alias)
+        if statements is None:
+            return
+
+        if not isinstance(sql, (str, type(u''))):
+            # E.g. psycopg2's sql.Composed
+            self._statements[db.alias] = None
+            return
+
+        savepoints = self._savepoints[db.alias]
+        match = _SAVEPOINT_RE.match(sql)
+        if match:
+            savepoints.append((match.group(1), len(statements)))
+            return
+
+        match = _ROLLBACK_TO_RE.match(sql)
+        if match:
+            for name, position in reversed(savepoints):
+                if name == match.group(1):
+                    del statements[position:]
+                    break
+            return
+
+        if _TRANSACTION_RE.match(sql):
+            return
+
+        if many:
+            if not isinstance(params, (list, tuple)):
+                # Recording an iterator would exhaust it.
+                self._statements[db.alias] = None
+                return
+            params = list(params)
+        statements.append((sql, params, many))
+
+
+def _cache_file(config, key):
+    return get_cache_dir(config, 'schema-sql').join(key + '.pickle')
+
+
+def _load_statements(path):
+    try:
+        with open(str(path), 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _save_statements(path, statements):
+    # Write to a temporary file first, other xdist workers may be reading.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(statements, f, 2)
+        os.rename(tmp_path, str(path))
+    except Exception:
+        # E.g. parameters which cannot be pickled: just do not cache them.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _is_empty(connection):
+    cursor = connection.cursor()
+    try:
+        return not connection.introspection.table_names(cursor)
+    finally:
+        cursor.close()
+
+
+def replay_statements(connection, statements):
+    """Execute recorded *statements* on *connection* in one transaction."""
+    from django.db import transaction
+
+    if hasattr(transaction, 'atomic'):
+        context = transaction.atomic(
+            using=connection.alias,
+            savepoint=connection.features.can_rollback_ddl)
+    else:
+        # Django < 1.6
+        context = transaction.commit_on_success(using=connection.alias)
+
+    with context:
+        cursor = connection.cursor()
+        try:
+            for sql, params, many in statements:
+                if many:
+                    cursor.executemany(sql, params)
+                elif params is None:
+                    cursor.execute(sql)
+                else:
+                    cursor.execute(sql, params)
+        finally:
+            cursor.close()
+
+
+class SchemaCache(object):
+    """Replaces the schema commands run while creating test databases.
+
+    While installed, migrate (or syncdb) on an empty database replays the
+    statements recorded for its schema, or runs as usual and records its
+    statements if there are none yet.
+    """
+
+    def __init__(self, config, cursor_manager, verbosity):
+        self.config = config
+        self.cursor_manager = cursor_manager
+        self.verbosity = verbosity
+        self._recorder = SchemaRecorder()
+        self._real_call_command = None
+
+    def install(self):
+        import django.core.management
+
+        self._real_call_command = django.core.management.call_command
+        django.core.management.call_command = self._call_command
+        self.cursor_manager.add_observer(self._recorder)
+
+    def uninstall(self):
+        import django.core.management
+
+        self.cursor_manager.remove_observer(self._recorder)
+        django.core.management.call_command = self._real_call_command
+
+    def _call_command(self, name, *args, **options):
+        from django.db import DEFAULT_DB_ALIAS, connections
+
+        connection = connections[options.get('database', DEFAULT_DB_ALIAS)]
+        if name not in _SCHEMA_COMMANDS or not _is_empty(connection):
+            return self._real_call_command(name, *args, **options)
+
+        path = _cache_file(self.config, get_schema_key(connection))
+        statements = None
+        if path.check():
+            statements = _load_statements(path)
+
+        start = time.time()
+        if statements is not None:
+            if self.verbosity >= 2:
+                print("Replaying the cached schema of the test database for "
+                      "alias '%s'..." % connection.alias)
+            replay_statements(connection, statements)
+            report.add_timing(REPORT_SECTION,
+                              "replayed cached schema for alias '%s'"
+                              % connection.alias, time.time() - start)
+            return
+
+        self._recorder.start(connection.alias)
+        try:
+            result = self._real_call_command(name, *args, **options)
+        finally:
+            statements = self._recorder.stop(connection.alias)
+
+        if statements is not None:
+            _save_statements(path, statements)
+        report.add_timing(REPORT_SECTION,
+                          "recorded schema for alias '%s'" % connection.alias,
+                          time.time() - start)
+        return result
+
+
+@contextlib.contextmanager
+def cached_schema(config, cursor_manager, verbosity):
+    """Use a :class:`SchemaCache` while the test databases are set up.
+
+    This does nothing unless --schema-cache is given.
+    """
+    if not config.getvalue('schema_cache'):
+        yield
+        return
+
+    schema_cache = SchemaCache(config, cursor_manager, verbosity)
+    schema_cache.install()
+    try:
+        yield
+    finally:
+        schema_cache.uninstall()
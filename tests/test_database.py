@@ -1,10 +1,17 @@
 from __future__ import with_statement
 
+import io
+
 import pytest
 from django.db import connection, transaction
 from django.test.testcases import connections_support_transactions
 
+from pytest_django.db_fixtures import iter_json_array
+from pytest_django.db_reset import get_written_tables
+from pytest_django.lazy_django import get_django_version
 from pytest_django_test.app.models import Item
+from pytest_django_test.db_helpers import (get_db_engine,
+                                           skip_if_sqlite_in_memory)
 
 
 def noop_transactions():
@@ -164,6 +171,750 @@ class TestDatabaseMarker:
         assert not noop_transactions()
 
 
+@pytest.mark.skipif(get_django_version() < (1, 6),
+                    reason='class_db requires Django 1.6 or newer')
+class TestClassDb:
+    "Tests for the class_db fixture."
+
+    @pytest.fixture(autouse=True, scope='class')
+    def transactions_required(self, _django_db_setup, _django_cursor_wrapper):
+        with _django_cursor_wrapper:
+            if not connections_support_transactions():
+                pytest.skip('transactions required for this test')
+
+    @pytest.fixture(scope='class')
+    def item(self, class_db):
+        return Item.objects.create(name='class item')
+
+    @pytest.mark.django_db
+    def test_change(self, item):
+        Item.objects.create(name='spam')
+        assert Item.objects.count() == 2
+
+    @pytest.mark.django_db
+    def test_change_rolled_back(self, item):
+        # Relies on the order: test_change created an object.
+        assert list(Item.objects.all()) == [item]
+
+    def test_savepoint(self, db, item):
+        assert connection.in_atomic_block
+        assert len(connection.savepoint_ids) == 1
+
+
+@pytest.mark.django_db
+def test_class_db_rolled_back():
+    # Relies on the order: TestClassDb created an object.
+    assert Item.objects.count() == 0
+
+
+@pytest.mark.skipif(get_django_version() < (1, 6),
+                    reason='module_db requires Django 1.6 or newer')
+def test_module_db(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.fixture(scope='module')
+        def item(module_db):
+            return Item.objects.create(name='module item')
+
+        @pytest.mark.django_db
+        def test_change(item):
+            Item.objects.create(name='spam')
+            assert Item.objects.count() == 2
+
+        @pytest.mark.django_db
+        def test_change_rolled_back(item):
+            assert list(Item.objects.all()) == [item]
+
+        @pytest.mark.django_db(transaction=True)
+        def test_transactional(item):
+            pass
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v')
+    result.stdout.fnmatch_lines([
+        '*test_change PASSED*',
+        '*test_change_rolled_back PASSED*',
+        '*test_transactional ERROR*',
+        '*transactional_db cannot be used together with module_db*',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 8),
+                    reason='--track-dirty-tables requires Django 1.8 or newer')
+def test_track_dirty_tables(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.contenttypes.models import ContentType
+        from django.db import connection
+
+        from .app.models import Item
+
+        @pytest.mark.django_db(transaction=True)
+        def test_1_untracked_write():
+            # Bypasses Django's cursor wrapper.
+            connection.ensure_connection()
+            connection.connection.cursor().execute(
+                "INSERT INTO app_item (name) VALUES ('untracked')")
+
+        @pytest.mark.django_db(transaction=True)
+        def test_2_tables_not_written_are_kept():
+            assert Item.objects.count() == 1
+            Item.objects.create(name='tracked')
+
+        @pytest.mark.django_db(transaction=True)
+        def test_3_written_tables_are_flushed():
+            assert Item.objects.count() == 0
+            assert ContentType.objects.filter(model='item').exists()
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--track-dirty-tables')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_1_untracked_write PASSED*',
+        '*test_2_tables_not_written_are_kept PASSED*',
+        '*test_3_written_tables_are_flushed PASSED*',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 5),
+                    reason='Django < 1.5 flushes in the flushdb finalizer')
+def test_fast_flush(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.contenttypes.models import ContentType
+
+        from .app.models import Item
+
+        @pytest.mark.django_db(transaction=True)
+        def test_1_write():
+            Item.objects.create(name='spam')
+
+        @pytest.mark.django_db(transaction=True)
+        def test_2_flushed():
+            assert Item.objects.count() == 0
+            assert ContentType.objects.filter(model='item').exists()
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--fast-flush')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_1_write PASSED*',
+        '*test_2_flushed PASSED*',
+    ])
+
+
+_fast_flush_models = '''
+    from django.db import models
+
+    class Item(models.Model):
+        name = models.CharField(max_length=100)
+
+    class Tag(models.Model):
+        item = models.ForeignKey(Item)
+'''
+
+
+@pytest.mark.skipif(get_django_version() < (1, 5),
+                    reason='Django < 1.5 flushes in the flushdb finalizer')
+def test_fast_flush_postgresql(django_testdir):
+    "TRUNCATE resets the sequences and empties the referencing tables."
+    if get_db_engine() != 'postgresql_psycopg2':
+        pytest.skip('Checks the TRUNCATE statement of PostgreSQL')
+
+    django_testdir.create_app_file(_fast_flush_models, 'models.py')
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from pytest_django.db_reset import fast_flush
+
+        from .app.models import Item, Tag
+
+        @pytest.mark.django_db(transaction=True)
+        def test_1_write():
+            Tag.objects.create(item=Item.objects.create(name='spam'))
+
+        @pytest.mark.django_db(transaction=True)
+        def test_2_flushed():
+            assert Tag.objects.count() == 0
+            assert Item.objects.create(name='spam').pk == 1
+
+        @pytest.mark.django_db(transaction=True)
+        def test_3_cascade():
+            Tag.objects.create(item=Item.objects.create(name='spam'))
+            fast_flush(connection, [Item._meta.db_table])
+            assert Item.objects.count() == 0
+            assert Tag.objects.count() == 0
+            assert Item.objects.create(name='spam').pk == 1
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--fast-flush')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_1_write PASSED*',
+        '*test_2_flushed PASSED*',
+        '*test_3_cascade PASSED*',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 5),
+                    reason='Django < 1.5 flushes in the flushdb finalizer')
+def test_fast_flush_mysql(django_testdir):
+    "Referenced tables are truncated with the foreign key checks disabled."
+    if get_db_engine() != 'mysql':
+        pytest.skip('Checks the TRUNCATE statements of MySQL')
+
+    django_testdir.create_app_file(_fast_flush_models, 'models.py')
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from pytest_django.db_reset import fast_flush
+
+        from .app.models import Item, Tag
+
+        def _foreign_key_checks():
+            cursor = connection.cursor()
+            cursor.execute('SELECT @@FOREIGN_KEY_CHECKS')
+            return cursor.fetchone()[0]
+
+        @pytest.mark.django_db(transaction=True)
+        def test_1_write():
+            Tag.objects.create(item=Item.objects.create(name='spam'))
+
+        @pytest.mark.django_db(transaction=True)
+        def test_2_flushed():
+            assert Tag.objects.count() == 0
+            assert Item.objects.create(name='spam').pk == 1
+            assert _foreign_key_checks() == 1
+
+        @pytest.mark.django_db(transaction=True)
+        def test_3_referenced_table():
+            Tag.objects.create(item=Item.objects.create(name='spam'))
+            fast_flush(connection, [Item._meta.db_table])
+            assert Item.objects.count() == 0
+            assert Tag.objects.count() == 1
+            assert _foreign_key_checks() == 1
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--fast-flush')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_1_write PASSED*',
+        '*test_2_flushed PASSED*',
+        '*test_3_referenced_table PASSED*',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 5),
+                    reason='Django < 1.5 flushes in the flushdb finalizer')
+def test_sqlite_snapshot(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.contenttypes.models import ContentType
+
+        from .app.models import Item
+
+        content_type_ids = []
+
+        @pytest.mark.django_db(transaction=True)
+        def test_1_write():
+            Item.objects.create(name='spam')
+            content_type = ContentType.objects.get(model='item')
+            content_type_ids.append(content_type.pk)
+            content_type.delete()
+
+        @pytest.mark.django_db(transaction=True)
+        def test_2_restored():
+            assert Item.objects.count() == 0
+            content_type = ContentType.objects.get(model='item')
+            assert content_type.pk == content_type_ids[0]
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--sqlite-snapshot')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_1_write PASSED*',
+        '*test_2_restored PASSED*',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 5),
+                    reason='Django < 1.5 flushes in the flushdb finalizer')
+def test_db_pool(django_testdir):
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from .app.models import Item
+
+        @pytest.mark.parametrize('i', range(4))
+        @pytest.mark.django_db(transaction=True)
+        def test_transactional(i):
+            assert '_pool' in connection.settings_dict['NAME']
+            assert Item.objects.count() == 0
+            Item.objects.create(name='spam')
+
+        @pytest.mark.django_db
+        def test_not_pooled():
+            assert '_pool' not in connection.settings_dict['NAME']
+            assert Item.objects.count() == 0
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--db-pool=2')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_transactional?3? PASSED*',
+        '*test_not_pooled PASSED*',
+        "*waited for pooled databases for alias 'default': *s",
+    ])
+    assert not django_testdir.tmpdir.listdir('*_pool*')
+
+
+@pytest.mark.skipif(get_django_version() < (1, 6),
+                    reason='Requires Django 1.6 or newer')
+def test_keep_db_connections(django_testdir):
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from .app.models import Item
+
+        connections_used = []
+
+        @pytest.mark.parametrize('i', range(3))
+        @pytest.mark.django_db(transaction=True)
+        def test_transactional(i):
+            assert Item.objects.count() == 0
+            Item.objects.create(name='spam')
+            connections_used.append(connection.connection)
+
+        def test_same_connection():
+            assert len(connections_used) == 3
+            assert connections_used[0] is connections_used[2]
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--keep-db-connections')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_same_connection PASSED*',
+        '*connections opened during tests: *',
+        '*connects avoided by keeping connections open: 3',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 5),
+                    reason='Django < 1.5 flushes in the flushdb finalizer')
+@pytest.mark.django_project(extra_settings="""
+    ROOT_URLCONF = 'tpkg.app.urls'
+    STATIC_URL = '/static/'
+""")
+def test_db_pool_live_server(django_testdir):
+    "The live server thread keeps using the test database."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_app_file('''
+        from django.http import HttpResponse
+
+        from .models import Item
+
+        def item_count(request):
+            return HttpResponse('%d' % Item.objects.count())
+    ''', 'views.py')
+    django_testdir.create_app_file('''
+        from django.conf.urls import url
+
+        from tpkg.app import views
+
+        urlpatterns = [url(r'^item_count/$', views.item_count)]
+    ''', 'urls.py')
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from pytest_django_test.compat import force_text, urlopen
+
+        from .app.models import Item
+
+        @pytest.fixture(autouse=True)
+        def keep_connections():
+            # The connection of the live server thread is kept open.
+            connection.settings_dict['CONN_MAX_AGE'] = None
+
+        @pytest.mark.parametrize('i', range(3))
+        def test_live_server(i, live_server):
+            assert '_pool' not in connection.settings_dict['NAME']
+            Item.objects.create(name='spam')
+            response = urlopen(live_server + '/item_count/').read()
+            assert force_text(response) == '1'
+
+        @pytest.mark.django_db(transaction=True)
+        def test_transactional():
+            assert '_pool' in connection.settings_dict['NAME']
+            assert Item.objects.count() == 0
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--db-pool=2')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_live_server?2? PASSED*',
+        '*test_transactional PASSED*',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 6),
+                    reason='Requires Django 1.6 or newer')
+def test_keep_db_connections_with_db_pool(django_testdir):
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.parametrize('i', range(3))
+        @pytest.mark.django_db(transaction=True)
+        def test_transactional(i):
+            assert Item.objects.count() == 0
+            Item.objects.create(name='spam')
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--keep-db-connections',
+                                                 '--db-pool=2')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_transactional?2? PASSED*',
+        '*connections opened during tests: 0',
+        '*connects avoided by keeping connections open: 0',
+        '*connections opened to pooled databases: 3',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 7),
+                    reason='Django < 1.7 does not serialize the database')
+def test_serialized_rollback(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        @pytest.mark.django_db
+        def test_not_serialized():
+            assert not hasattr(connection, '_test_serialized_contents')
+
+        @pytest.mark.django_db(transaction=True, serialized_rollback=True)
+        def test_serialized():
+            assert hasattr(connection, '_test_serialized_contents')
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '-k', 'not_serialized')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_not_serialized PASSED*'])
+
+    result = django_testdir.runpytest_subprocess('-v', '-k',
+                                                 'not not_serialized')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_serialized PASSED*'])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 7),
+                    reason='Django < 1.7 does not serialize the database')
+def test_serialized_rollback_transactional_db_fixture(django_testdir):
+    "serialized_rollback also applies to the transactional_db fixture."
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        @pytest.mark.django_db(serialized_rollback=True)
+        def test_serialized(transactional_db):
+            assert hasattr(connection, '_test_serialized_contents')
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_serialized PASSED*'])
+
+
+def test_fixtures(django_testdir):
+    django_testdir.create_app_file('''
+        [
+            {"pk": 1, "model": "app.item", "fields": {"name": "spam"}},
+            {"pk": 2, "model": "app.item", "fields": {"name": "eggs"}},
+            {"pk": 1, "model": "auth.group", "fields": {"name": "staff"}},
+            {"pk": 1, "model": "auth.user", "fields": {
+                "username": "fred", "password": "",
+                "date_joined": "2015-01-01T00:00:00", "groups": [1]}}
+        ]
+    ''', 'fixtures/items.json')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.auth.models import User
+
+        from .app.models import Item
+
+        def _check():
+            assert sorted(Item.objects.values_list('name', flat=True)) == [
+                'eggs', 'spam']
+            user = User.objects.get(username='fred')
+            assert [group.name for group in user.groups.all()] == ['staff']
+            assert Item.objects.create(name='ham').pk == 3
+
+        @pytest.mark.django_db(fixtures=['items'])
+        def test_fixtures():
+            _check()
+
+        @pytest.mark.django_db(transaction=True, fixtures='items.json')
+        def test_fixtures_transactional():
+            _check()
+
+        @pytest.mark.django_db
+        def test_no_fixtures():
+            assert Item.objects.count() == 0
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_fixtures PASSED*',
+        '*test_fixtures_transactional PASSED*',
+        '*test_no_fixtures PASSED*',
+    ])
+    if get_django_version() >= (1, 8):
+        result.stdout.fnmatch_lines([
+            '*fixture files loaded: 2 (1 from the cache)',
+        ])
+
+
+def test_fixtures_streamed(django_testdir):
+    django_testdir.create_app_file('''
+        [
+            {"pk": 1, "model": "app.item", "fields": {"name": "spam"}},
+            {"pk": 2, "model": "app.item", "fields": {"name": "eggs"}}
+        ]
+    ''', 'fixtures/items.json')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db(fixtures=['items'])
+        def test_fixtures():
+            assert sorted(Item.objects.values_list('name', flat=True)) == [
+                'eggs', 'spam']
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v',
+                                                 '--fixture-stream-size=0')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_fixtures PASSED*'])
+    if get_django_version() >= (1, 8):
+        result.stdout.fnmatch_lines(['*fixture files streamed: 1'])
+
+
+def test_fixtures_save_signals(django_testdir):
+    "The save signals are sent with raw=True, like by loaddata."
+    django_testdir.create_app_file('''
+        [
+            {"pk": 1, "model": "app.item", "fields": {"name": "spam"}},
+            {"pk": 2, "model": "app.item", "fields": {"name": "eggs"}}
+        ]
+    ''', 'fixtures/items.json')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db.models.signals import post_save, pre_save
+
+        from .app.models import Item
+
+        sent = []
+
+        def receiver(signal, sender, instance, raw, **kwargs):
+            sent.append((signal is pre_save, instance.name, raw))
+
+        pre_save.connect(receiver, sender=Item)
+        post_save.connect(receiver, sender=Item)
+
+        @pytest.mark.django_db(fixtures=['items'])
+        def test_fixtures():
+            assert sent == [(True, 'spam', True), (False, 'spam', True),
+                            (True, 'eggs', True), (False, 'eggs', True)]
+            assert Item.objects.count() == 2
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_fixtures PASSED*'])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1024])
+def test_iter_json_array(chunk_size):
+    text = u' [ {"a": [1, 2], "b": "x]"} ,\n12345, "y" , {}]\n'
+    items = iter_json_array(io.StringIO(text), chunk_size=chunk_size)
+    assert list(items) == [{'a': [1, 2], 'b': 'x]'}, 12345, 'y', {}]
+
+    assert list(iter_json_array(io.StringIO(u'[]'), chunk_size)) == []
+
+
+@pytest.mark.parametrize('text', [u'', u'{}', u'[{}', u'[{} {}]', u'[{"a": ]'])
+def test_iter_json_array_invalid(text):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text), chunk_size=2))
+
+
+def test_group_fixtures(django_testdir):
+    django_testdir.create_app_file('''
+        [{"pk": 1, "model": "app.item", "fields": {"name": "spam"}}]
+    ''', 'fixtures/spam.json')
+    django_testdir.create_app_file('''
+        [{"pk": 1, "model": "app.item", "fields": {"name": "eggs"}}]
+    ''', 'fixtures/eggs.json')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        def _check(name):
+            assert list(Item.objects.values_list('name', flat=True)) == [name]
+            Item.objects.create(name='ham')
+
+        @pytest.mark.django_db(fixtures=['spam'])
+        def test_spam_1():
+            _check('spam')
+
+        @pytest.mark.django_db(fixtures=['eggs'])
+        def test_eggs_1():
+            _check('eggs')
+
+        @pytest.mark.django_db(fixtures=['spam'])
+        def test_spam_2():
+            _check('spam')
+
+        @pytest.mark.django_db
+        def test_no_fixtures():
+            assert Item.objects.count() == 0
+
+        @pytest.mark.django_db(transaction=True, fixtures=['eggs'])
+        def test_eggs_transactional():
+            _check('eggs')
+
+        @pytest.mark.django_db(fixtures=['eggs'])
+        def test_eggs_2():
+            _check('eggs')
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--group-fixtures')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_spam_1 PASSED*',
+        '*test_spam_2 PASSED*',
+        '*test_eggs_1 PASSED*',
+        '*test_eggs_2 PASSED*',
+        '*test_no_fixtures PASSED*',
+        '*test_eggs_transactional PASSED*',
+    ])
+    if get_django_version() >= (1, 6):
+        result.stdout.fnmatch_lines([
+            '*tests sharing fixtures: 4, with 2 fixture loads',
+        ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 6),
+                    reason='module_db requires Django 1.6 or newer')
+def test_group_fixtures_module_db(django_testdir):
+    "Tests are only grouped within their module and not inside module_db."
+    django_testdir.create_app_file('''
+        [{"pk": 10, "model": "app.item", "fields": {"name": "spam"}}]
+    ''', 'fixtures/spam.json')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.fixture(scope='module')
+        def shop(module_db):
+            return Item.objects.create(name='shop')
+
+        def _names():
+            return list(Item.objects.order_by('name').values_list(
+                'name', flat=True))
+
+        def test_shop(shop, db):
+            assert _names() == ['shop']
+
+        @pytest.mark.django_db(fixtures=['spam'])
+        def test_spam_1():
+            assert _names() == ['shop', 'spam']
+
+        def test_other(db):
+            assert _names() == ['shop']
+
+        @pytest.mark.django_db(fixtures=['spam'])
+        def test_spam_2():
+            assert _names() == ['shop', 'spam']
+
+        @pytest.mark.django_db(fixtures=['spam'])
+        def test_spam_3():
+            assert _names() == ['shop', 'spam']
+    ''', 'test_a.py')
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db(fixtures=['spam'])
+        def test_spam_4():
+            assert list(Item.objects.values_list('name', flat=True)) == [
+                'spam']
+    ''', 'test_b.py')
+
+    result = django_testdir.runpytest_subprocess('-v', '--group-fixtures')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_a.py::test_shop PASSED*',
+        '*test_a.py::test_spam_1 PASSED*',
+        '*test_a.py::test_spam_2 PASSED*',
+        '*test_a.py::test_spam_3 PASSED*',
+        '*test_a.py::test_other PASSED*',
+        '*test_b.py::test_spam_4 PASSED*',
+    ])
+
+
+@pytest.mark.parametrize('sql, tables', [
+    ('SELECT * FROM "app_item"', []),
+    ('SAVEPOINT "s1"', []),
+    ('INSERT INTO "app_item" ("name") VALUES (%s)', ['app_item']),
+    ('UPDATE "public"."app_item" SET "name" = %s', ['app_item']),
+    ('DELETE FROM `app_item` WHERE `id` = %s', ['app_item']),
+    ('TRUNCATE "app_item", "auth_user";', ['app_item', 'auth_user']),
+    ('TRUNCATE "app_item" CASCADE;', None),
+    ('CREATE TABLE "foo" ("id" integer)', None),
+])
+def test_dirty_tables_parsing(sql, tables):
+    assert get_written_tables(sql) == tables
+
+
 def test_unittest_interaction(django_testdir):
     "Test that (non-Django) unittests cannot access the DB."
 
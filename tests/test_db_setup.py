@@ -1,11 +1,19 @@
+import os
 import sys
+import time
 
 import pytest
 
+from pytest_django import fingerprint
+from pytest_django.db_reuse import DatabaseProbe
+from pytest_django.db_teardown import (TO_DROP, DropLedger,
+                                       drop_marked_databases)
 from pytest_django.lazy_django import get_django_version
 from pytest_django_test.db_helpers import (db_exists, drop_database,
-                                           mark_database, mark_exists,
-                                           skip_if_sqlite_in_memory)
+                                           get_db_engine, mark_database,
+                                           mark_exists,
+                                           skip_if_sqlite_in_memory,
+                                           TEST_DB_NAME)
 
 skip_on_python32 = pytest.mark.skipif(sys.version_info[:2] == (3, 2),
                                       reason='xdist is flaky with Python 3.2')
@@ -30,6 +38,23 @@ def test_db_reuse_simple(django_testdir):
     ])
 
 
+@pytest.mark.django_db
+def test_database_probe():
+    "The probe finds the test database through the server catalog."
+    skip_if_sqlite_in_memory()
+
+    from django.db import connection
+
+    probe = DatabaseProbe()
+    try:
+        test_db_name = connection.settings_dict['NAME']
+        assert probe.probe(connection, test_db_name)[0] is True
+        assert probe.probe(connection, test_db_name + '_missing') == (
+            False, None)
+    finally:
+        probe.close()
+
+
 def test_db_reuse(django_testdir):
     """
     Test the re-use db functionality. This test requires a PostgreSQL server
@@ -85,6 +110,804 @@ def test_db_reuse(django_testdir):
     assert not mark_exists()
 
 
+def test_db_reuse_recreates_outdated_db(django_testdir):
+    "Changed models without migrations must not be re-used with --reuse-db."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_db_can_be_accessed():
+            assert Item.objects.count() == 0
+    ''')
+
+    drop_database()
+    result = django_testdir.runpytest_subprocess('-v', '--reuse-db')
+    assert result.ret == 0
+
+    mark_database()
+    result = django_testdir.runpytest_subprocess('-v', '--reuse-db')
+    assert result.ret == 0
+    assert mark_exists()
+
+    django_testdir.create_app_file('''
+        from django.db import models
+
+        class Item(models.Model):
+            name = models.CharField(max_length=100)
+            description = models.TextField(default='')
+    ''', 'models.py')
+
+    result = django_testdir.runpytest_subprocess('-v', '-s', '--reuse-db')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*is out of date, re-creating it*'])
+    assert not mark_exists()
+
+
+@pytest.mark.skipif(get_django_version() < (1, 8),
+                    reason='Django < 1.8 cannot migrate a re-used database')
+def test_db_reuse_applies_new_migrations(django_testdir):
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_db_can_be_accessed():
+            assert Item.objects.count() == 0
+    ''')
+    django_testdir.mkpydir('tpkg/app/migrations')
+    django_testdir.create_app_file('''
+        from django.db import migrations, models
+
+        class Migration(migrations.Migration):
+
+            dependencies = []
+
+            operations = [
+                migrations.CreateModel(
+                    name='Item',
+                    fields=[
+                        ('id', models.AutoField(serialize=False,
+                                                auto_created=True,
+                                                primary_key=True)),
+                        ('name', models.CharField(max_length=100)),
+                    ],
+                ),
+            ]
+    ''', 'migrations/0001_initial.py')
+
+    drop_database()
+    result = django_testdir.runpytest_subprocess('-v', '--reuse-db')
+    assert result.ret == 0
+    mark_database()
+
+    django_testdir.create_app_file('''
+        from django.db import migrations
+
+        def print_it(apps, schema_editor):
+            print("mark_new_migration_run")
+
+        class Migration(migrations.Migration):
+
+            dependencies = [('app', '0001_initial')]
+
+            operations = [migrations.RunPython(print_it)]
+    ''', 'migrations/0002_print.py')
+
+    result = django_testdir.runpytest_subprocess('-v', '-s', '--reuse-db')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*Applying new migrations*',
+                                 '*mark_new_migration_run*'])
+    assert mark_exists()
+
+
+def test_migration_file_digests_cached(tmpdir, monkeypatch):
+    "Migration files are only read again once they are modified."
+    reads = []
+    real_sha1 = fingerprint._sha1
+
+    def sha1(data):
+        reads.append(data)
+        return real_sha1(data)
+
+    monkeypatch.setattr(fingerprint, '_sha1', sha1)
+    monkeypatch.setattr(fingerprint, '_file_digests', {})
+    path = tmpdir.join('0001_initial.py')
+    path.write('# first')
+    digest = fingerprint._get_file_digest(str(path))
+    assert fingerprint._get_file_digest(str(path)) == digest
+    assert reads == [b'# first']
+
+    path.write('# second')
+    path.setmtime(path.mtime() + 10)
+    assert fingerprint._get_file_digest(str(path)) != digest
+    assert reads == [b'# first', b'# second']
+
+
+@pytest.mark.skipif(get_django_version() < (1, 7),
+                    reason='Migrations require Django 1.7 or newer')
+def test_skip_data_migrations(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_items():
+            print('items=%d' % Item.objects.count())
+    ''')
+    django_testdir.mkpydir('tpkg/app/migrations')
+    django_testdir.create_app_file('''
+        from django.db import migrations, models
+
+        def backfill(apps, schema_editor):
+            apps.get_model('app', 'Item').objects.create(name='backfilled')
+
+        class Migration(migrations.Migration):
+
+            dependencies = []
+
+            operations = [
+                migrations.CreateModel(
+                    name='Item',
+                    fields=[
+                        ('id', models.AutoField(serialize=False,
+                                                auto_created=True,
+                                                primary_key=True)),
+                        ('name', models.CharField(max_length=100)),
+                    ],
+                ),
+                migrations.RunPython(backfill),
+            ]
+    ''', 'migrations/0001_initial.py')
+
+    # The timings are recorded before the setting is used.
+    result = django_testdir.runpytest_subprocess('-s')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*items=1*'])
+
+    django_testdir.makeini('''
+        [pytest]
+        django_skip_data_migrations = app.0001_*
+    ''')
+    result = django_testdir.runpytest_subprocess('-s')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*items=0*',
+        '*saved by skipping data migration app.0001_initial: *s',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 7),
+                    reason='Migrations require Django 1.7 or newer')
+def test_skip_data_migrations_db_slots(django_testdir):
+    "Skipping data migrations changes the slot of the test databases."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_items():
+            print('items=%d' % Item.objects.count())
+            print('db_name=%s' % connection.settings_dict['NAME'])
+    ''')
+    django_testdir.mkpydir('tpkg/app/migrations')
+    django_testdir.create_app_file('''
+        from django.db import migrations, models
+
+        def backfill(apps, schema_editor):
+            apps.get_model('app', 'Item').objects.create(name='backfilled')
+
+        class Migration(migrations.Migration):
+
+            dependencies = []
+
+            operations = [
+                migrations.CreateModel(
+                    name='Item',
+                    fields=[
+                        ('id', models.AutoField(serialize=False,
+                                                auto_created=True,
+                                                primary_key=True)),
+                        ('name', models.CharField(max_length=100)),
+                    ],
+                ),
+                migrations.RunPython(backfill),
+            ]
+    ''', 'migrations/0001_initial.py')
+
+    def run_and_get_db_name(items):
+        result = django_testdir.runpytest_subprocess('-s', '--reuse-db',
+                                                     '--db-slots=2')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(['*items=%d*' % items])
+        (line, ) = [line for line in result.stdout.lines
+                    if 'db_name=' in line]
+        return line.split('db_name=')[1].split()[0]
+
+    first_db_name = run_and_get_db_name(items=1)
+
+    django_testdir.makeini('''
+        [pytest]
+        django_skip_data_migrations = app
+    ''')
+    second_db_name = run_and_get_db_name(items=0)
+    assert second_db_name != first_db_name
+    assert run_and_get_db_name(items=0) == second_db_name
+
+
+@pytest.mark.skipif(get_django_version() < (1, 8),
+                    reason='Partial schemas require Django 1.8 or newer')
+def test_partial_schema(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.auth.models import Group
+
+        from .app.models import Item
+
+        @pytest.mark.django_db(apps=['app'])
+        def test_items():
+            Item.objects.create(name='foo')
+            assert Item.objects.count() == 1
+
+        @pytest.mark.django_db(transaction=True, apps='app')
+        def test_items_transactional():
+            Item.objects.create(name='foo')
+            assert Item.objects.count() == 1
+
+        @pytest.mark.django_db(apps=['app'])
+        def test_groups():
+            Group.objects.count()
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--nomigrations')
+    assert result.ret == 1
+    result.stdout.fnmatch_lines([
+        '*test_items PASSED*',
+        '*test_items_transactional PASSED*',
+        '*test_groups FAILED*',
+        '*tables created for the apps app: 1 of *',
+        '*The table auth_group of the model auth.Group was not created in '
+        'the test database, add "auth" to the apps of the django_db mark.*',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 8),
+                    reason='Partial schemas require Django 1.8 or newer')
+def test_partial_schema_observer(django_testdir):
+    "Only the statements of tests and module_db fixtures are checked."
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.auth.models import Group
+
+        from pytest_django.partial_schema import partial_schema
+
+        from .app.models import Item
+
+        @pytest.fixture(scope='module')
+        def groups(module_db):
+            return Group.objects.count()
+
+        @pytest.mark.django_db(apps=['app'])
+        def test_db(_django_cursor_wrapper):
+            assert partial_schema in _django_cursor_wrapper._observers
+            assert Item.objects.count() == 0
+
+        def test_no_db(_django_cursor_wrapper):
+            assert partial_schema not in _django_cursor_wrapper._observers
+
+        @pytest.mark.django_db(apps=['app'])
+        def test_groups(groups):
+            pass
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--nomigrations')
+    assert result.ret == 1
+    result.stdout.fnmatch_lines([
+        '*test_db PASSED*',
+        '*test_no_db PASSED*',
+        '*test_groups ERROR*',
+        '*The table auth_group of the model auth.Group was not created in '
+        'the test database, add "auth" to the apps of the django_db mark.*',
+    ])
+
+
+def test_db_reuse_slots(django_testdir):
+    "Every schema gets its own test database, old ones get dropped."
+    skip_if_sqlite_in_memory()
+    if get_db_engine() != 'sqlite3':
+        pytest.skip('Checks for the test database files')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_db_can_be_accessed():
+            assert Item.objects.count() == 0
+            print('db_name=%s' % connection.settings_dict['NAME'])
+    ''')
+
+    def run_and_get_db_name():
+        result = django_testdir.runpytest_subprocess('-s', '--reuse-db',
+                                                     '--db-slots=1')
+        assert result.ret == 0
+        (line, ) = [line for line in result.stdout.lines
+                    if 'db_name=' in line]
+        return line.split('db_name=')[1].split()[0]
+
+    first_db_name = run_and_get_db_name()
+    assert first_db_name.startswith(TEST_DB_NAME + '_')
+    assert os.path.exists(first_db_name)
+    assert run_and_get_db_name() == first_db_name
+
+    django_testdir.create_app_file('''
+        from django.db import models
+
+        class Item(models.Model):
+            name = models.CharField(max_length=100)
+            description = models.TextField(default='')
+    ''', 'models.py')
+
+    second_db_name = run_and_get_db_name()
+    assert second_db_name != first_db_name
+    assert os.path.exists(second_db_name)
+    assert not os.path.exists(first_db_name)
+
+
+def test_sqlite_memory(django_testdir):
+    "The tests use an in-memory copy, the database file is not changed."
+    skip_if_sqlite_in_memory()
+    if get_db_engine() != 'sqlite3':
+        pytest.skip('Only applies to SQLite')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from .app.models import Item
+
+        @pytest.mark.django_db(transaction=True)
+        def test_db_is_in_memory():
+            assert connection.settings_dict['NAME'] == ':memory:'
+            assert Item.objects.count() == 0
+            Item.objects.create(name='foo')
+    ''')
+
+    for i in range(2):
+        result = django_testdir.runpytest_subprocess(
+            '-v', '--reuse-db', '--sqlite-memory')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(['*test_db_is_in_memory PASSED*'])
+
+    assert db_exists()
+
+
+@pytest.mark.django_project(extra_settings="""
+    DATABASES['second'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'second_db',
+        'TEST': {'NAME': 'test_second_db', 'DEPENDENCIES': []},
+        'TEST_NAME': 'test_second_db',
+    }
+""")
+def test_db_setup_workers(django_testdir):
+    "Independent databases are created and destroyed concurrently."
+    skip_if_sqlite_in_memory()
+    if get_db_engine() != 'sqlite3':
+        pytest.skip('The second database uses SQLite')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_both_databases():
+            assert Item.objects.count() == 0
+            assert Item.objects.using('second').count() == 0
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--db-setup-workers=2')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_both_databases PASSED*'])
+    for action in ('created', 'destroyed'):
+        for alias in ('default', 'second'):
+            result.stdout.fnmatch_lines([
+                "*%s database for alias '%s': *s" % (action, alias)])
+    assert not os.path.exists('test_second_db')
+
+
+@pytest.mark.django_project(extra_settings="""
+    DATABASES['second'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'second_db',
+        'TEST': {'NAME': 'test_second_db'},
+        'TEST_NAME': 'test_second_db',
+    }
+""")
+def test_lazy_db(django_testdir):
+    "Other databases than the default one are created on first use."
+    skip_if_sqlite_in_memory()
+    if get_db_engine() != 'sqlite3':
+        pytest.skip('The second database uses SQLite')
+
+    django_testdir.create_test_module('''
+        import os
+
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_default_only():
+            assert Item.objects.count() == 0
+            assert not os.path.exists('test_second_db')
+
+        @pytest.mark.django_db
+        def test_second():
+            assert Item.objects.using('second').count() == 0
+            assert os.path.exists('test_second_db')
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--lazy-db')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_default_only PASSED*',
+        '*test_second PASSED*',
+        "*created database for alias 'second' on first use: *s",
+    ])
+    assert not os.path.exists('test_second_db')
+    # The real database was never connected to.
+    assert not os.path.exists('second_db')
+
+
+@pytest.mark.skipif(get_django_version() < (1, 6),
+                    reason='Requires Django 1.6 or newer')
+@pytest.mark.django_project(extra_settings="""
+    DATABASES['second'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'second_db',
+        'TEST': {'NAME': 'test_second_db'},
+        'TEST_NAME': 'test_second_db',
+    }
+""")
+def test_lazy_db_first_use_in_atomic(django_testdir):
+    "A database is created when it is first used by an atomic block."
+    skip_if_sqlite_in_memory()
+    if get_db_engine() != 'sqlite3':
+        pytest.skip('The second database uses SQLite')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import transaction
+
+        from .app.models import Item
+
+        @pytest.mark.django_db(transaction=True)
+        def test_atomic():
+            with transaction.atomic(using='second'):
+                Item.objects.using('second').create(name='spam')
+            assert Item.objects.using('second').count() == 1
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--lazy-db')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_atomic PASSED*',
+        "*created database for alias 'second' on first use: *s",
+    ])
+    assert not os.path.exists('second_db')
+
+
+@pytest.mark.skipif(get_django_version() < (1, 7),
+                    reason='Django < 1.7 does not serialize the database')
+@pytest.mark.django_project(extra_settings="""
+    DATABASES['second'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'second_db',
+        'TEST': {'NAME': 'test_second_db'},
+        'TEST_NAME': 'test_second_db',
+    }
+""")
+def test_lazy_db_not_serialized(django_testdir):
+    "Databases created on first use are not serialized either."
+    skip_if_sqlite_in_memory()
+    if get_db_engine() != 'sqlite3':
+        pytest.skip('The second database uses SQLite')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connections
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_second():
+            assert Item.objects.using('second').count() == 0
+            connection = connections['second']
+            assert not hasattr(connection, '_test_serialized_contents')
+            assert connection.settings_dict['TEST'].get('SERIALIZE', True)
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--lazy-db')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_second PASSED*',
+        "*created database for alias 'second' on first use: *s",
+    ])
+
+
+@pytest.mark.django_project(extra_settings="""
+    DATABASES['second'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'second_db',
+        'TEST': {'NAME': 'test_second_db'},
+        'TEST_NAME': 'test_second_db',
+    }
+""")
+def test_lazy_db_with_schema_cache(django_testdir):
+    "Databases created on first use work while SQL observers are active."
+    skip_if_sqlite_in_memory()
+    if get_db_engine() != 'sqlite3':
+        pytest.skip('The second database uses SQLite')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_second():
+            Item.objects.using('second').create(name='foo')
+            assert Item.objects.using('second').count() == 1
+    ''')
+
+    for i in range(2):
+        # --track-dirty-tables keeps an SQL observer active in the tests.
+        result = django_testdir.runpytest_subprocess(
+            '-v', '--lazy-db', '--schema-cache', '--track-dirty-tables')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*test_second PASSED*',
+            "*created database for alias 'second' on first use: *s",
+        ])
+
+
+def test_db_background_setup(django_testdir):
+    "The databases are set up while collecting and torn down if unused."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        def test_no_db():
+            pass
+
+        @pytest.mark.django_db
+        def test_db():
+            assert Item.objects.count() == 0
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v',
+                                                 '--db-background-setup')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_no_db PASSED*',
+        '*test_db PASSED*',
+        '*set up databases in the background: *s',
+    ])
+    assert not db_exists()
+
+    result = django_testdir.runpytest_subprocess(
+        '-v', '--db-background-setup', '-k', 'test_no_db')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_no_db PASSED*'])
+    assert not db_exists()
+
+
+@pytest.mark.skipif(get_django_version() < (1, 7),
+                    reason='Migrations require Django 1.7 or newer')
+def test_db_background_setup_test_environment(django_testdir):
+    "The databases are set up in the test environment."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_db():
+            assert Item.objects.get().name == (
+                'django.core.mail.backends.locmem.EmailBackend')
+    ''')
+    django_testdir.mkpydir('tpkg/app/migrations')
+    django_testdir.create_app_file('''
+        from django.conf import settings
+        from django.db import migrations, models
+
+        def record_email_backend(apps, schema_editor):
+            apps.get_model('app', 'Item').objects.create(
+                name=settings.EMAIL_BACKEND)
+
+        class Migration(migrations.Migration):
+
+            dependencies = []
+
+            operations = [
+                migrations.CreateModel(
+                    name='Item',
+                    fields=[
+                        ('id', models.AutoField(serialize=False,
+                                                auto_created=True,
+                                                primary_key=True)),
+                        ('name', models.CharField(max_length=100)),
+                    ],
+                ),
+                migrations.RunPython(record_email_backend),
+            ]
+    ''', 'migrations/0001_initial.py')
+
+    result = django_testdir.runpytest_subprocess('-v',
+                                                 '--db-background-setup')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_db PASSED*'])
+
+
+def test_async_teardown(django_testdir):
+    "The test database is dropped by a detached process."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_db():
+            assert Item.objects.count() == 0
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--async-teardown')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_db PASSED*'])
+
+    for i in range(100):
+        if not db_exists():
+            break
+        time.sleep(0.1)
+    assert not db_exists()
+
+
+def test_drop_leftover_dbs(django_testdir):
+    "The databases of crashed test runs are dropped on request."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import os
+
+        import pytest
+
+        def test_no_db():
+            pass
+
+        @pytest.mark.django_db
+        def test_crash():
+            os._exit(1)
+    ''')
+
+    # Only runs using the option record their databases.
+    result = django_testdir.runpytest_subprocess('-v', '--drop-leftover-dbs')
+    assert result.ret == 1
+    assert db_exists()
+
+    result = django_testdir.runpytest_subprocess('-v', '-k', 'test_no_db')
+    assert result.ret == 0
+    assert db_exists()
+
+    result = django_testdir.runpytest_subprocess('-v', '-k', 'test_no_db',
+                                                 '--drop-leftover-dbs')
+    assert result.ret == 0
+    assert not db_exists()
+
+
+def test_drop_marked_databases_unknown_alias(tmpdir):
+    "Databases of aliases which are not in the settings stay in the ledger."
+    ledger = DropLedger(tmpdir)
+    with ledger.entries() as entries:
+        entries.append({'alias': 'gone', 'name': 'test_gone',
+                        'settings_module': 'settings', 'pid': 1,
+                        'state': TO_DROP})
+
+    drop_marked_databases(ledger, 'settings')
+    assert ledger.has_entries(TO_DROP)
+
+
+def test_schema_cache(django_testdir):
+    "The schema is recorded by the first run and replayed by the next one."
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.contenttypes.models import ContentType
+
+        from .app.models import Item
+
+        @pytest.mark.django_db
+        def test_schema():
+            assert Item.objects.count() == 0
+            Item.objects.create(name='foo')
+            assert ContentType.objects.filter(model='item').exists()
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--schema-cache')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_schema PASSED*',
+        "*recorded schema for alias 'default': *s",
+    ])
+
+    result = django_testdir.runpytest_subprocess('-v', '--schema-cache')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*test_schema PASSED*',
+        "*replayed cached schema for alias 'default': *s",
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 8),
+                    reason='Requires Django 1.8 or newer')
+def test_serialized_contents_cache(django_testdir):
+    "The serialized contents of a re-used database are cached."
+    skip_if_sqlite_in_memory()
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        @pytest.mark.django_db(transaction=True, serialized_rollback=True)
+        def test_serialized():
+            assert connection._test_serialized_contents != '[]'
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v', '--reuse-db')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*test_serialized PASSED*'])
+
+    cache_files = list(django_testdir.tmpdir.visit('*.json'))
+    cache_files = [path for path in cache_files
+                   if path.dirpath().basename == 'serialized-db']
+    assert len(cache_files) == 1
+
+    # The next run takes the contents from the cache.
+    cache_files[0].write('[]')
+    result = django_testdir.runpytest_subprocess('-v', '--reuse-db')
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*test_serialized FAILED*'])
+
+
 class TestSqlite:
 
     db_name_17 = 'test_db_name_django17'
@@ -190,6 +1013,186 @@ def test_xdist_with_reuse(django_testdir):
     result.stdout.fnmatch_lines(['*PASSED*test_d*'])
 
 
+@skip_on_python32
+def test_xdist_with_db_template(django_testdir):
+    skip_if_sqlite_in_memory()
+
+    drop_database('template')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from .app.models import Item
+
+        def _check(settings):
+            db_name = settings.DATABASES['default']['NAME']
+            assert db_name.endswith('_gw0') or db_name.endswith('_gw1')
+
+            assert Item.objects.count() == 0
+            Item.objects.create(name='foo')
+            assert Item.objects.count() == 1
+
+        @pytest.mark.django_db
+        def test_a(settings):
+            _check(settings)
+
+        @pytest.mark.django_db
+        def test_b(settings):
+            _check(settings)
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-vv', '-n2', '-s',
+                                                 '--db-template')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*PASSED*test_a*'])
+    result.stdout.fnmatch_lines(['*PASSED*test_b*'])
+
+    # Only the template is kept, the worker databases are removed.
+    assert db_exists('template')
+    assert not db_exists('gw0')
+    assert not db_exists('gw1')
+
+
+@skip_on_python32
+def test_xdist_with_pg_worker_schemas(django_testdir):
+    if get_db_engine() != 'postgresql_psycopg2':
+        pytest.skip('Worker schemas are only used with PostgreSQL')
+
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.db import connection
+
+        from .app.models import Item
+
+        def _check():
+            cursor = connection.cursor()
+            cursor.execute('SELECT current_schema()')
+            schema = cursor.fetchone()[0]
+            assert schema in ('pytest_django_gw0', 'pytest_django_gw1')
+
+            assert Item.objects.count() == 0
+            Item.objects.create(name='foo')
+            assert Item.objects.count() == 1
+
+        @pytest.mark.django_db
+        def test_a():
+            _check()
+
+        @pytest.mark.django_db(transaction=True)
+        def test_b():
+            _check()
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-vv', '-n2', '-s',
+                                                 '--pg-worker-schemas')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*PASSED*test_a*'])
+    result.stdout.fnmatch_lines(['*PASSED*test_b*'])
+
+    # The workers shared the test database, which the last one removed.
+    assert not db_exists()
+    assert not db_exists('gw0')
+    assert not db_exists('gw1')
+
+
+class TestSqliteMirrors:
+
+    db_settings = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'db_name',
+        },
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'replica_db_name',
+        },
+        'other': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': '/tmp/should-not-be-used',
+        },
+        'other_replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': '/tmp/should-not-be-used-either',
+        },
+    }
+    from django import VERSION
+    if VERSION > (1, 7):
+        db_settings['replica']['TEST'] = {'MIRROR': 'default'}
+        db_settings['other_replica']['TEST'] = {'MIRROR': 'other'}
+    else:
+        db_settings['replica']['TEST_MIRROR'] = 'default'
+        db_settings['other_replica']['TEST_MIRROR'] = 'other'
+
+    def test_unused_aliases_and_mirrors(self, django_testdir):
+        django_testdir.create_test_module('''
+            import pytest
+            from django.db import connections
+
+            @pytest.mark.django_db
+            def test_a():
+                assert sorted(connections) == ['default', 'replica']
+                assert (connections['replica'].settings_dict['NAME'] ==
+                        connections['default'].settings_dict['NAME'])
+        ''')
+        django_testdir.makeini('''
+            [pytest]
+            django_unused_databases = other
+        ''')
+
+        result = django_testdir.runpytest_subprocess('-v')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*test_a PASSED*',
+            "*unused aliases not set up: other, other_replica*",
+            "*aliases using the test database of 'default': replica*",
+        ])
+
+
+class TestSqliteUnusedDependency:
+
+    db_settings = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'db_name',
+        },
+        'reports': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'reports_db_name',
+        },
+        'other': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': '/tmp/should-not-be-used',
+        },
+    }
+    from django import VERSION
+    if VERSION > (1, 7):
+        db_settings['reports']['TEST'] = {'DEPENDENCIES': ['other']}
+    else:
+        db_settings['reports']['TEST_DEPENDENCIES'] = ['other']
+
+    def test_dependency_on_unused_alias(self, django_testdir):
+        django_testdir.create_test_module('''
+            import pytest
+            from django.db import connections
+
+            @pytest.mark.django_db
+            def test_a():
+                assert sorted(connections) == ['default', 'reports']
+        ''')
+        django_testdir.makeini('''
+            [pytest]
+            django_unused_databases = other
+        ''')
+
+        result = django_testdir.runpytest_subprocess('-v')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*test_a PASSED*',
+            "*unused aliases not set up: other*",
+        ])
+
+
 class TestSqliteWithXdist:
 
     pytestmark = skip_on_python32
@@ -6,8 +6,11 @@ fixtures are tested in test_database.
 
 from __future__ import with_statement
 
+import sqlite3
+
 import pytest
 from django.conf import settings as real_settings
+from django.db import connection
 from django.test.client import Client, RequestFactory
 from django.test.testcases import connections_support_transactions
 
@@ -301,3 +304,166 @@ class Migration(migrations.Migration):
     result = django_testdir.runpytest_subprocess('-s')
     result.stdout.fnmatch_lines(['*1 passed*'])
     assert result.ret == 0
+
+
+def test_cached_fixture(django_testdir):
+    django_testdir.create_test_module('''
+        import pytest
+
+        from pytest_django.cached_fixtures import django_db_cached_fixture
+
+        from .app.models import Item
+
+        @django_db_cached_fixture
+        def items():
+            items = []
+            for i in range(3):
+                item = Item.objects.create(name='item')
+                item.name = 'item%d' % i
+                item.save()
+                items.append(item)
+            return {'items': items, 'names': ['item0', 'item1', 'item2']}
+
+        @django_db_cached_fixture
+        def deleting():
+            Item.objects.create(name='spam')
+            Item.objects.all().delete()
+
+        def _check(items):
+            assert [item.name for item in items['items']] == items['names']
+            assert list(Item.objects.order_by('pk')) == items['items']
+            Item.objects.create(name='other')
+
+        def test_items_1(items):
+            _check(items)
+
+        def test_items_2(items):
+            _check(items)
+
+        @pytest.mark.django_db(transaction=True)
+        def test_items_transactional(items):
+            _check(items)
+
+        def test_deleting(deleting):
+            assert Item.objects.count() == 0
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v')
+    assert result.ret == 0
+    if get_django_version() >= (1, 8):
+        result.stdout.fnmatch_lines([
+            '*not cached: tpkg.test_the_test.deleting: it deletes rows',
+            '*fixtures recorded: 1',
+            '*fixtures replayed: 2',
+        ])
+
+    result = django_testdir.runpytest_subprocess('-v')
+    assert result.ret == 0
+    if get_django_version() >= (1, 8):
+        result.stdout.fnmatch_lines([
+            '*fixtures recorded: 0',
+            '*fixtures replayed: 3',
+        ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 8),
+                    reason='cached fixtures require Django 1.8 or newer')
+@pytest.mark.skipif(connection.vendor == 'sqlite' and
+                    sqlite3.sqlite_version_info >= (3, 26) and
+                    get_django_version() < (2, 1, 5),
+                    reason='The auth migrations of this Django version leave '
+                           'broken foreign keys with this SQLite version')
+def test_cached_fixture_many_to_many(django_testdir):
+    django_testdir.create_test_module('''
+        from django.contrib.auth.models import Group
+
+        from pytest_django.cached_fixtures import django_db_cached_fixture
+
+        @django_db_cached_fixture
+        def staff(django_user_model):
+            group = Group.objects.create(name='staff')
+            for name in ('fred', 'wilma'):
+                group.user_set.add(
+                    django_user_model.objects.create(username=name))
+            return group
+
+        def test_staff_1(staff):
+            assert sorted(staff.user_set.values_list(
+                'username', flat=True)) == ['fred', 'wilma']
+
+        def test_staff_2(staff):
+            assert sorted(staff.user_set.values_list(
+                'username', flat=True)) == ['fred', 'wilma']
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*fixtures recorded: 1',
+        '*fixtures replayed: 1',
+    ])
+
+
+@pytest.mark.skipif(get_django_version() < (1, 8),
+                    reason='cached fixtures require Django 1.8 or newer')
+@pytest.mark.skipif(connection.vendor == 'sqlite' and
+                    sqlite3.sqlite_version_info >= (3, 26) and
+                    get_django_version() < (2, 1, 5),
+                    reason='The auth migrations of this Django version leave '
+                           'broken foreign keys with this SQLite version')
+def test_cached_fixture_dependency_pk_changes(django_testdir):
+    "Foreign keys to the objects of other fixtures follow their primary keys."
+    django_testdir.create_test_module('''
+        import pytest
+
+        from django.contrib.auth.models import Group
+
+        from pytest_django.cached_fixtures import django_db_cached_fixture
+
+        uses = []
+
+        @pytest.fixture
+        def owner(db, django_user_model):
+            # Like on PostgreSQL, where sequences are not rolled back.
+            uses.append(None)
+            for i in range(len(uses)):
+                django_user_model.objects.create(username='filler%d' % i)
+            return django_user_model.objects.create(username='owner')
+
+        @pytest.fixture
+        def member(db, django_user_model):
+            uses.append(None)
+            return django_user_model.objects.create(
+                username='member%d' % len(uses)).username
+
+        @django_db_cached_fixture
+        def team(owner):
+            group = Group.objects.create(name='team')
+            group.user_set.add(owner)
+            return {'group': group, 'owner': owner}
+
+        @django_db_cached_fixture
+        def other_team(member, django_user_model):
+            group = Group.objects.create(name='other team')
+            group.user_set.add(django_user_model.objects.get(username=member))
+            return group
+
+        @pytest.mark.parametrize('i', range(3))
+        def test_team(team, owner, i):
+            assert team['owner'] == owner
+            assert list(team['group'].user_set.all()) == [owner]
+
+        @pytest.mark.parametrize('i', range(2))
+        def test_other_team(other_team, member, i):
+            assert [user.username for user in other_team.user_set.all()] == [
+                member]
+    ''')
+
+    result = django_testdir.runpytest_subprocess('-v')
+    assert result.ret == 0
+    # other_team refers to a user which is not one of its arguments and
+    # which changed.
+    result.stdout.fnmatch_lines([
+        '*fixtures recorded: 2',
+        '*fixtures replayed: 2',
+    ])